@@ -0,0 +1,42 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from datetime import date
+from typing import Optional
+
+from app.api import deps
+from app.services import dashboard_service
+from app.db.base import User
+
+router = APIRouter()
+
+
+@router.get("/snapshot", summary="Todos los widgets del dashboard en una sola llamada")
+def get_dashboard_snapshot(
+    db: Session = Depends(deps.get_db),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    store_name: Optional[str] = Query(None),
+    search: Optional[str] = Query(None),
+    current_user: User = Depends(deps.get_current_user),
+):
+    # El snapshot abre su propia transacción: leemos el rol antes
+    is_admin = current_user.role == "admin"
+
+    data = dashboard_service.get_dashboard_snapshot(
+        db=db,
+        start_date=start_date,
+        end_date=end_date,
+        store_name=store_name,
+        search_query=search,
+    )
+
+    # FILTRO DE SEGURIDAD (CENSURA): mismo criterio que /api/kpi/main
+    if not is_admin:
+        kpis = data["kpis"]
+        kpis["total_revenue"] = 0
+        kpis["total_fees"] = 0
+        kpis["total_coupons"] = 0
+        kpis["driver_payout"] = 0
+        kpis["company_profit"] = 0
+
+    return data
@@ -1,14 +1,16 @@
 from fastapi import APIRouter, Depends, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 from typing import List, Optional
 from datetime import date
 from fastapi.responses import StreamingResponse, JSONResponse
 import io
+import redis
 from tasks.scraper.order_scraper import OrderScraper
 from app.api import deps
-from app.db.base import Order, OrderStatusLog, Store, Customer, User, Driver, OrderItem
-from app.services import analysis_service
+from app.db.base import Order, Store, User, Driver
+from app.services import analysis_service, search_service, export_service
+from app.services import trend_service, ingest_stream
+from app.db.utils import get_db_session
 from tasks.scraper.drone_scraper import DroneScraper
 from tasks.celery_tasks import process_drone_data
 from fastapi import HTTPException
@@ -18,13 +20,11 @@ router = APIRouter()
 
 # --- HELPER INTERNO ---
 def apply_filters(query, start_date, end_date, store_name, search):
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
+    # local_date: día VET indexado (evita el escaneo secuencial de 'orders')
     if start_date:
-        query = query.filter(local_date >= start_date)
+        query = query.filter(Order.local_date >= start_date)
     if end_date:
-        query = query.filter(local_date <= end_date)
+        query = query.filter(Order.local_date <= end_date)
     if store_name:
         # --- NORMALIZACIÓN SRE: Si viene en formato 'Empresa - Sucursal', extraemos la sucursal ---
         real_store_name = (
@@ -34,14 +34,10 @@ def apply_filters(query, start_date, end_date, store_name, search):
         query = query.join(Store, Order.store_id == Store.id).filter(
             Store.name == real_store_name
         )
-    if search:
-        term = search.strip()
-        if term.isdigit():
-            query = query.filter(Order.external_id.like(f"{term}%"))
-        else:
-            query = query.join(
-                Customer, Order.customer_id == Customer.id, isouter=True
-            ).filter(Customer.name.ilike(f"%{term}%"))
+    # Buscador: prefijo para IDs numéricos, trigram para texto
+    ids = search_service.matching_order_ids(search)
+    if ids is not None:
+        query = query.filter(Order.id.in_(ids))
     return query
 
 
@@ -58,72 +54,43 @@ def get_recent_orders(
     query = apply_filters(query, start_date, end_date, store_name, search)
 
     # Límite de 50 para velocidad
-    orders = query.order_by(Order.created_at.desc()).limit(50).all()
-
-    data_response = []
-    for o in orders:
-        # 1. Tiempos
-        last_log = (
-            db.query(OrderStatusLog)
-            .filter(OrderStatusLog.order_id == o.id)
-            .order_by(OrderStatusLog.timestamp.desc())
-            .first()
-        )
-        state_start = last_log.timestamp if last_log else o.created_at
-
-        # 2. Lealtad
-        order_count = 0
-        if o.customer_id:
-            order_count = (
-                db.query(func.count(Order.id))
-                .filter(Order.customer_id == o.customer_id)
-                .scalar()
-            )
+    return analysis_service.get_recent_orders(db, query, limit=50)
 
-        # 3. Driver
-        driver_info = {"name": "No Asignado", "phone": None}
-        if o.driver:
-            driver_info["name"] = o.driver.name
-            driver_info["phone"] = getattr(o.driver, "phone", None)
-
-        # 4. ITEMS (ESTO ES LO QUE FALTABA PARA VER LA LISTA)
-        db_items = db.query(OrderItem).filter(OrderItem.order_id == o.id).all()
-        items_list = [
-            {
-                "name": i.name,
-                "quantity": i.quantity,
-                "unit_price": i.unit_price,
-                "total_price": i.total_price,
-            }
-            for i in db_items
-        ]
-
-        has_audit_record = True if o.audits and len(o.audits) > 0 else False
-
-        data_response.append(
-            {
-                "id": o.id,
-                "external_id": o.external_id,
-                "current_status": o.current_status,
-                "order_type": o.order_type,
-                "total_amount": o.total_amount,
-                "store_name": (
-                    f"{o.store.company_name} - {o.store.name}"
-                    if o.store and o.store.company_name
-                    else (o.store.name if o.store else "Sin Tienda")
-                ),
-                "customer_name": o.customer.name if o.customer else "Anónimo",
-                "customer_phone": o.customer.phone if o.customer else None,
-                "customer_orders_count": order_count,
-                "driver": driver_info,
-                "created_at": o.created_at,
-                "state_start_at": state_start,
-                "duration_text": o.duration,
-                "items": items_list,  # <--- AQUÍ SE ENVÍA LA DATA AL FRONT
-                "has_audit": has_audit_record,
-            }
-        )
-    return data_response
+
+@router.get("/orders/export", summary="Exportación masiva de pedidos (CSV / NDJSON)")
+def export_orders(
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    store_name: Optional[str] = Query(None),
+    search: Optional[str] = Query(None),
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    include: str = Query(
+        "", description="Grupos opcionales separados por coma: store,driver,items,stages"
+    ),
+    current_user: User = Depends(deps.get_current_user),
+):
+    try:
+        groups = export_service.parse_groups(include)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def stream():
+        # Sesión propia: la del request (Depends) se cierra antes de terminar el streaming
+        with get_db_session() as export_db:
+            query = export_service.export_query(export_db, groups)
+            query = apply_filters(query, start_date, end_date, store_name, search)
+            if format == "ndjson":
+                yield from export_service.stream_ndjson(query)
+            else:
+                yield from export_service.stream_csv(query)
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    filename = f"pedidos_{start_date or 'inicio'}_{end_date or 'hoy'}.{format}"
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 
 # --- ENDPOINTS DELEGADOS AL SERVICIO (Igual que antes) ---
@@ -135,8 +102,13 @@ def get_heatmap_endpoint(
     start_date: Optional[date] = Query(None),
     end_date: Optional[date] = Query(None),
     store_name: Optional[str] = Query(None),
+    zoom: Optional[int] = Query(
+        None, ge=1, le=20, description="Zoom del mapa: agrega los puntos por celdas"
+    ),
 ):
-    return analysis_service.get_heatmap_data(db, start_date, end_date, store_name)
+    return analysis_service.get_heatmap_data(
+        db, start_date, end_date, store_name, zoom=zoom
+    )
 
 
 @router.get("/trends")
@@ -152,6 +124,21 @@ def get_trends_data(
     )
 
 
+@router.get("/trends/intraday", summary="Tendencia por hora o por 15 minutos")
+def get_intraday_trends_data(
+    db: Session = Depends(deps.get_db),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    store_name: Optional[str] = Query(None),
+    granularity: int = Query(60, description="Minutos por bucket: 15 o 60"),
+):
+    if granularity not in trend_service.GRANULARITIES:
+        raise HTTPException(status_code=400, detail="Granularidad válida: 15 o 60.")
+    return analysis_service.get_intraday_trends(
+        db, start_date, end_date, store_name, granularity=granularity
+    )
+
+
 @router.get("/top-products")
 def get_top_products_data(
     db: Session = Depends(deps.get_db),
@@ -178,6 +165,18 @@ def get_driver_leaderboard_data(
     )
 
 
+@router.get("/driver-utilization", summary="Actividad diaria de un repartidor")
+def get_driver_utilization_data(
+    driver_name: str = Query(..., min_length=1),
+    db: Session = Depends(deps.get_db),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+):
+    return analysis_service.get_driver_utilization(
+        db, driver_name, start_date, end_date
+    )
+
+
 @router.get("/top-stores")
 def get_top_stores_data(
     db: Session = Depends(deps.get_db),
@@ -334,7 +333,7 @@ def resync_single_order(
         data = drone.scrape_detail(order_id, mode="full")
 
         # 2. Guardado seguro (La función process_drone_data respeta el historial)
-        process_drone_data(db, data)
+        process_drone_data(db, data, force=True)
 
         drone.close_driver()
         return {"status": "success", "message": f"Pedido #{order_id} sincronizado."}
@@ -342,3 +341,12 @@ def resync_single_order(
     except Exception as e:
         drone.close_driver()
         return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@router.get("/ingest/stream-stats", summary="Rezago del stream de ingesta")
+def ingest_stream_stats(current_user: User = Depends(deps.get_current_user)):
+    """Mensajes sin leer, pendientes de confirmar y en descarte (ver ingest_stream)."""
+    try:
+        return ingest_stream.stream_stats()
+    except redis.RedisError as e:
+        raise HTTPException(status_code=503, detail=f"Redis no disponible: {e}")
@@ -16,12 +16,13 @@ def get_main_kpis(
     end_date: Optional[date] = Query(None),
     store_name: Optional[str] = Query(None),
     search: Optional[str] = Query(None),
+    mode: str = Query("sql", pattern="^(sql|python)$", description="Motor de agregación"),
     current_user: User = Depends(deps.get_current_user) # Obtenemos el usuario
 ):
     # 1. Obtener la data cruda
     data = kpi_service.get_main_kpis(
         db=db, start_date=start_date, end_date=end_date, 
-        store_name=store_name, search_query=search
+        store_name=store_name, search_query=search, mode=mode
     )
 
     # 2. FILTRO DE SEGURIDAD (CENSURA)
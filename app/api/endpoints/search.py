@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+
+from app.api import deps
+from app.services import search_service
+from app.db.base import User
+
+router = APIRouter()
+
+
+@router.get("", summary="Buscar pedidos por ID o Cliente")
+def search_orders(
+    q: str = Query(..., min_length=1, description="ID de pedido o nombre de cliente"),
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(deps.get_db),
+    current_user: User = Depends(deps.get_current_user),
+):
+    results = search_service.search_orders(db, q, limit=limit)
+    return {
+        "query": q,
+        "order_ids": [r["id"] for r in results],
+        "results": results,
+    }
@@ -1,6 +1,7 @@
 from sqlalchemy import (
     Column,
     Integer,
+    SmallInteger,
     String,
     Float,
     DateTime,
@@ -8,6 +9,7 @@ from sqlalchemy import (
     ForeignKey,
     Enum,
     Boolean,
+    Index,
 )
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
@@ -23,10 +25,16 @@ class OrderTypeEnum(str, enum.Enum):
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_store_local_date", "store_id", "local_date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     external_id = Column(String, unique=True, index=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Día en hora de Venezuela (created_at -4h). Se llena al ingerir para poder
+    # filtrar por rango de fechas con índice en vez de envolver created_at.
+    local_date = Column(Date, nullable=True, index=True)
 
     # Datos financieros
     total_amount = Column(Float, nullable=True)
@@ -39,7 +47,12 @@ class Order(Base):
 
     # --- NUEVOS CAMPOS DE ANÁLISIS ---
     payment_method = Column(String, nullable=True)  # Ej: Pago Móvil, Zelle
+    # 1 efectivo, 2 punto de venta, 3 digital (order_metrics.payment_code_of)
+    payment_code = Column(SmallInteger, nullable=True)
     cancellation_reason = Column(String, nullable=True)  # Ej: Problemas con el pago
+    # Código del clasificador (cancellation_service) y texto original del Legacy
+    cancellation_code = Column(SmallInteger, nullable=True, index=True)
+    cancellation_reason_raw = Column(String, nullable=True)
     canceled_by = Column(String, nullable=True)  # Ej: customer, admin
 
     # --- CAMPO CORREGIDO (AMPLIADO) ---
@@ -64,6 +77,8 @@ class Order(Base):
     # ...
     # --- NUEVO CAMPO V6 ---
     distance_km = Column(Float, default=0.0)  # Distancia Tienda -> Cliente
+    # Huella (SHA-1) del último payload ingerido: si se repite, no se escribe nada
+    payload_hash = Column(String(40), nullable=True)
     # ...
 
     # RELACIÓN NUEVA
@@ -76,13 +91,18 @@ class Order(Base):
 
     # Relaciones (Foreing Keys)
     store_id = Column(Integer, ForeignKey("stores.id"), nullable=True)
-    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True)
+    customer_id = Column(
+        Integer, ForeignKey("customers.id"), nullable=True, index=True
+    )
     driver_id = Column(Integer, ForeignKey("drivers.id"), nullable=True)
 
     # Relaciones (Objetos)
     status_logs = relationship(
         "OrderStatusLog", back_populates="order", cascade="all, delete-orphan"
     )
+    stage_durations = relationship(
+        "OrderStageDuration", back_populates="order", cascade="all, delete-orphan"
+    )
     store = relationship("Store", back_populates="orders")
     customer = relationship("Customer", back_populates="orders")
     driver = relationship("Driver", back_populates="orders")
@@ -90,6 +110,13 @@ class Order(Base):
 
 class OrderStatusLog(Base):
     __tablename__ = "order_status_logs"
+    # Un log por estatus y pedido (los rebotes se descartan al escribir)
+    __table_args__ = (
+        Index(
+            "uq_order_status_logs_order_status", "order_id", "status", unique=True
+        ),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
     status = Column(String, nullable=False)
@@ -97,6 +124,22 @@ class OrderStatusLog(Base):
     order = relationship("Order", back_populates="status_logs")
 
 
+class OrderStageDuration(Base):
+    """
+    Tiempo (segundos) que un pedido pasó en cada estatus.
+    Se escribe al registrar cada transición; 'canceled_life_time' guarda la
+    vida total de los pedidos cancelados.
+    """
+
+    __tablename__ = "order_stage_durations"
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True)
+    stage = Column(String, nullable=False)
+    seconds = Column(Float, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    order = relationship("Order", back_populates="stage_durations")
+
+
 class Store(Base):
     __tablename__ = "stores"
     id = Column(Integer, primary_key=True, index=True)
@@ -122,8 +165,27 @@ class OrderItem(Base):
     unit_price = Column(Float)
     total_price = Column(Float)
     barcode = Column(String, nullable=True)
+    # Dimensión de producto (ver product_service.product_key)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=True, index=True)
 
     order = relationship("Order", back_populates="items")
+    product = relationship("Product")
+
+
+class Product(Base):
+    """
+    Dimensión de productos: una fila por código de barras (o nombre normalizado
+    si el item no trae código). is_promotional se calcula una sola vez al crearla.
+    """
+
+    __tablename__ = "products"
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_key = Column(String, unique=True, nullable=False)
+    barcode = Column(String, nullable=True)
+    name = Column(String, nullable=True)
+    is_promotional = Column(Boolean, default=False, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 
 # -------------------
@@ -217,3 +279,140 @@ class StoreHoliday(Base):
     description = Column(String, nullable=True)  # Ej: "Semana Santa"
 
     store = relationship("Store")
+
+
+class OrderDailyFact(Base):
+    """
+    Rollup diario de pedidos: una fila por (día VET, tienda, tipo, estatus).
+    Lo mantiene process_drone_data y se reconstruye con rebuild_daily_facts.py
+    """
+
+    __tablename__ = "order_daily_facts"
+    __table_args__ = (
+        Index("ix_order_daily_facts_date_store", "local_date", "store_id"),
+        Index(
+            "uq_order_daily_facts_slice",
+            "local_date",
+            "store_id",
+            "order_type",
+            "status",
+            unique=True,
+            postgresql_nulls_not_distinct=True,
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    local_date = Column(Date, nullable=False)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=True)
+    order_type = Column(Enum(OrderTypeEnum), nullable=True)
+    status = Column(String, nullable=True)
+
+    orders_count = Column(Integer, default=0)
+    total_revenue = Column(Float, default=0.0)
+    delivery_fees = Column(Float, default=0.0)  # Tarifa real (bruta o neta)
+    coupons = Column(Float, default=0.0)
+    service_fees = Column(Float, default=0.0)
+    product_sales = Column(Float, default=0.0)
+
+    # Tiempos: suma + conteo para poder promediar entre filas
+    delivery_time_sum = Column(Float, default=0.0)  # delivery_time_minutes
+    delivery_time_count = Column(Integer, default=0)
+    kpi_duration_sum = Column(Float, default=0.0)  # Cadena de respaldo del KPI
+    kpi_duration_count = Column(Integer, default=0)
+
+    first_order_at = Column(DateTime, nullable=True)
+
+    store = relationship("Store")
+
+
+class CustomerStat(Base):
+    """
+    Estadísticas de vida por cliente (lealtad y ranking histórico).
+    Las mantiene process_drone_data y se reconstruyen con rebuild_customer_stats.py
+    """
+
+    __tablename__ = "customer_stats"
+
+    customer_id = Column(Integer, ForeignKey("customers.id"), primary_key=True)
+    order_count = Column(Integer, default=0)  # Todos los pedidos (incluye cancelados)
+    delivered_count = Column(Integer, default=0)
+    total_spent = Column(Float, default=0.0, index=True)  # Solo entregados
+    # Indexado: MIN(first_order_at) decide si el top de clientes es histórico
+    first_order_at = Column(DateTime, nullable=True, index=True)
+    last_order_at = Column(DateTime, nullable=True)
+
+    customer = relationship("Customer")
+
+
+class DriverDailyStat(Base):
+    """
+    Actividad diaria por repartidor: una fila por (día VET, driver, tienda).
+    La mantiene process_drone_data y se reconstruye con rebuild_driver_stats.py
+    """
+
+    __tablename__ = "driver_daily_stats"
+    __table_args__ = (
+        Index("ix_driver_daily_stats_driver_date", "driver_id", "local_date"),
+        Index("ix_driver_daily_stats_date_store", "local_date", "store_id"),
+        Index(
+            "uq_driver_daily_stats_slice",
+            "local_date",
+            "driver_id",
+            "store_id",
+            unique=True,
+            postgresql_nulls_not_distinct=True,
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    local_date = Column(Date, nullable=False)
+    driver_id = Column(Integer, ForeignKey("drivers.id"), nullable=False)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=True)
+
+    orders_count = Column(Integer, default=0)  # Todos los pedidos asignados
+    deliveries = Column(Integer, default=0)
+    canceled_count = Column(Integer, default=0)
+    # Etapa 'on_the_way' (order_stage_durations): suma + conteo para promediar
+    on_the_way_seconds = Column(Float, default=0.0)
+    on_the_way_count = Column(Integer, default=0)
+
+    first_order_at = Column(DateTime, nullable=True)
+    last_order_at = Column(DateTime, nullable=True)
+
+    driver = relationship("Driver")
+    store = relationship("Store")
+
+
+class OrderTrendBucket(Base):
+    """
+    Tendencia intradía: una fila por (granularidad, inicio del bucket VET, tienda).
+    Solo buckets cerrados; se escriben una vez (close_trend_buckets) y no se
+    recalculan. El bucket abierto se agrega en vivo desde 'orders'.
+    """
+
+    __tablename__ = "order_trend_buckets"
+    __table_args__ = (
+        Index("ix_order_trend_buckets_gran_start", "granularity", "bucket_start"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    granularity = Column(SmallInteger, nullable=False)  # Minutos: 15 o 60
+    bucket_start = Column(DateTime, nullable=False)  # Hora local VET
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=True)
+
+    orders_count = Column(Integer, default=0)
+    total_revenue = Column(Float, default=0.0)
+    # Delivery entregados: suma + conteo para poder promediar entre filas
+    delivery_time_sum = Column(Float, default=0.0)
+    delivery_time_count = Column(Integer, default=0)
+
+    store = relationship("Store")
+
+
+class TrendWatermark(Base):
+    """Hasta dónde (exclusivo, hora VET) están persistidos los buckets de cada granularidad."""
+
+    __tablename__ = "trend_watermarks"
+
+    granularity = Column(SmallInteger, primary_key=True)
+    closed_until = Column(DateTime, nullable=False)
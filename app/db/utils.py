@@ -1,5 +1,46 @@
 from contextlib import contextmanager
-from app.db.session import SessionLocal
+from contextvars import ContextVar
+from typing import List, Optional
+from sqlalchemy import event, func, select
+from app.db.session import SessionLocal, engine
+
+# Contador de consultas SQL del contexto actual (None = no se está midiendo)
+_query_counter: ContextVar[Optional[List[int]]] = ContextVar(
+    "query_counter", default=None
+)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+@contextmanager
+def count_queries():
+    """
+    Cuenta las consultas SQL ejecutadas dentro del bloque.
+    Uso: with count_queries() as counter: ...; counter[0] -> total.
+    Es una lista mutable para que los hilos del threadpool (que copian el
+    contexto) sumen sobre el mismo contador.
+    """
+    counter = [0]
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+
+def advisory_xact_lock(db, key: str):
+    """
+    Candado de Postgres atado a la transacción de 'db' (se suelta en el
+    commit/rollback). Serializa a quienes recalculan la misma porción de un
+    rollup: el segundo espera y su DELETE ya ve lo que insertó el primero.
+    """
+    db.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+
 
 @contextmanager
 def get_db_session():
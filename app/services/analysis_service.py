@@ -1,11 +1,33 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, cast, Date, case, and_, or_, text
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import func, desc, cast, Float, case, and_, or_, text, select
+from sqlalchemy import union_all
+from sqlalchemy.dialects import postgresql
 from typing import List, Dict, Any, Optional
 from datetime import date, datetime, timedelta
-from app.db.base import OrderItem
+from app.db.base import OrderItem, Product
 import re
+from collections import Counter
 
 from app.db.base import Order, OrderStatusLog, Driver, Store, Customer
+from app.db.base import OrderStageDuration, CustomerStat, DriverDailyStat
+from app.services import rollup_service, stage_service, search_service
+from app.services import cancellation_service, trend_service, query_planner
+from app.services.cache_service import cached
+from app.services.order_metrics import local_today, local_date_of
+
+# Orden de estados operativos (Importante para las barras de tiempo)
+BOTTLENECK_STEPS = ["pending", "processing", "confirmed", "driver_assigned", "on_the_way"]
+# Pickup no pasa por confirmación ni repartidor
+PICKUP_STEPS = ["pending", "processing"]
+
+# Bordes del histograma de duraciones por etapa (1 min ... 8 h, en segundos)
+_BUCKET_MINUTES = (0, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360, 480)
+DURATION_BUCKET_EDGES = [m * 60 for m in _BUCKET_MINUTES]
+
+# Zoom de Leaflet para el heatmap agregado por celdas
+HEATMAP_DEFAULT_ZOOM = 12
+HEATMAP_MIN_ZOOM = 3
+HEATMAP_MAX_ZOOM = 18
 
 
 def _normalize_store_filter(store_name: Optional[str]) -> Optional[str]:
@@ -17,18 +39,38 @@ def _normalize_store_filter(store_name: Optional[str]) -> Optional[str]:
 
 # --- HELPER: BÚSQUEDA GLOBAL ---
 def apply_search(query, search_query: str):
-    if search_query:
-        return query.join(
-            Customer, Order.customer_id == Customer.id, isouter=True
-        ).filter(
-            or_(
-                Order.external_id.ilike(f"%{search_query}%"),
-                Customer.name.ilike(f"%{search_query}%"),
-            )
-        )
+    # Semi-join contra los IDs del buscador (índices trigram, sin JOIN a customers)
+    ids = search_service.matching_order_ids(search_query)
+    if ids is not None:
+        return query.filter(Order.id.in_(ids))
     return query
 
 
+def filtered_orders_cte(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    search_query: Optional[str] = None,
+):
+    """
+    IDs de los pedidos que pasan el filtro del dashboard (fechas, tienda y búsqueda).
+    El snapshot lo comparte entre widgets en lugar de repetir el filtro en cada uno.
+    """
+    stmt = select(Order.id)
+    if start_date:
+        stmt = stmt.where(Order.local_date >= start_date)
+    if end_date:
+        stmt = stmt.where(Order.local_date <= end_date)
+    if store_name:
+        stmt = stmt.join(Store, Order.store_id == Store.id).where(
+            Store.name == _normalize_store_filter(store_name)
+        )
+    ids = search_service.matching_order_ids(search_query)
+    if ids is not None:
+        stmt = stmt.where(Order.id.in_(ids))
+    return stmt.cte("filtered_orders")
+
+
 def _parse_duration_string(duration_str: str) -> int:
     if not duration_str:
         return 0
@@ -46,17 +88,22 @@ def _parse_duration_string(duration_str: str) -> int:
 # --- FUNCIONES DE ANÁLISIS ---
 
 
+@cached
 def get_daily_trends(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ) -> Dict[str, List]:
-    # Usamos timezone para agrupar por el día CORRECTO en Venezuela
-    date_col = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
+    # Sin búsqueda libre: order_daily_facts (se mantiene al ingerir, incluye hoy)
+    plan = query_planner.plan_query("get_daily_trends", search_query)
+    if plan.uses_rollup:
+        return _get_daily_trends_rollup(db, start_date, end_date, store_name)
+
+    # Agrupamos por el día CORRECTO en Venezuela (precalculado al ingerir)
+    date_col = Order.local_date
 
     query = db.query(
         date_col.label("date"),
@@ -77,20 +124,58 @@ def get_daily_trends(
         ).label("avg_time"),
     )
 
-    if start_date:
-        query = query.filter(date_col >= start_date)
-    if end_date:
-        query = query.filter(date_col <= end_date)
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        if start_date:
+            query = query.filter(date_col >= start_date)
+        if end_date:
+            query = query.filter(date_col <= end_date)
+
+        if store_name:
+            # USA EL NORMALIZADOR AQUÍ:
+            real_name = _normalize_store_filter(store_name)
+            query = query.join(Store, Order.store_id == Store.id).filter(
+                Store.name == real_name
+            )
+        query = apply_search(query, search_query)
+
+    results = query.group_by(date_col).order_by(date_col).all()
+
+    return {
+        "labels": [r.date.strftime("%Y-%m-%d") for r in results],
+        "revenue": [float(r.total_revenue or 0) for r in results],
+        "orders": [int(r.total_orders) for r in results],
+        "avg_times": [round(float(r.avg_time or 0), 1) for r in results],
+    }
+
+
+def _get_daily_trends_rollup(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+) -> Dict[str, List]:
+    f = rollup_service.daily_facts_source(start_date, end_date)
+    timed = and_(f.c.status == "delivered", f.c.order_type == "Delivery")
+
+    query = db.query(
+        f.c.local_date.label("date"),
+        func.sum(f.c.orders_count).label("total_orders"),
+        func.sum(f.c.total_revenue).label("total_revenue"),
+        (
+            func.sum(f.c.delivery_time_sum).filter(timed)
+            / func.nullif(func.sum(f.c.delivery_time_count).filter(timed), 0)
+        ).label("avg_time"),
+    ).select_from(f)
 
     if store_name:
-        # USA EL NORMALIZADOR AQUÍ:
         real_name = _normalize_store_filter(store_name)
-        query = query.join(Store, Order.store_id == Store.id).filter(
+        query = query.join(Store, f.c.store_id == Store.id).filter(
             Store.name == real_name
         )
-    query = apply_search(query, search_query)
 
-    results = query.group_by(date_col).order_by(date_col).all()
+    results = query.group_by(f.c.local_date).order_by(f.c.local_date).all()
 
     return {
         "labels": [r.date.strftime("%Y-%m-%d") for r in results],
@@ -100,16 +185,79 @@ def get_daily_trends(
     }
 
 
+@cached
+def get_intraday_trends(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    granularity: int = 60,
+) -> Dict[str, List]:
+    """
+    Tendencia por hora o por 15 minutos. Buckets anteriores a la marca desde
+    order_trend_buckets; el resto (bucket abierto incluido) en vivo.
+    """
+    today = local_today()
+    since = datetime.combine(start_date or today, datetime.min.time())
+    until = datetime.combine(
+        (end_date or today) + timedelta(days=1), datetime.min.time()
+    )
+
+    watermark = trend_service.get_watermark(db, granularity) or since
+    split = min(max(watermark, since), until)
+    if since < split < until:
+        path = query_planner.ROLLUP_LIVE
+    else:
+        path = query_planner.ROLLUP if split == until else query_planner.LIVE
+    query_planner.record_path("get_intraday_trends", path)
+
+    parts = []
+    if since < split:
+        parts.append(trend_service.stored_buckets_select(granularity, since, split))
+    if split < until:
+        parts.append(trend_service.raw_buckets_select(granularity, split, until))
+    b = (parts[0] if len(parts) == 1 else union_all(*parts)).subquery("buckets")
+
+    query = db.query(
+        b.c.bucket_start.label("bucket"),
+        func.sum(b.c.orders_count).label("total_orders"),
+        func.sum(b.c.total_revenue).label("total_revenue"),
+        (
+            func.sum(b.c.delivery_time_sum)
+            / func.nullif(func.sum(b.c.delivery_time_count), 0)
+        ).label("avg_time"),
+    ).select_from(b)
+
+    if store_name:
+        real_name = _normalize_store_filter(store_name)
+        query = query.join(Store, b.c.store_id == Store.id).filter(
+            Store.name == real_name
+        )
+
+    results = query.group_by(b.c.bucket_start).order_by(b.c.bucket_start).all()
+
+    return {
+        "granularity": granularity,
+        "labels": [r.bucket.strftime("%Y-%m-%d %H:%M") for r in results],
+        "revenue": [float(r.total_revenue or 0) for r in results],
+        "orders": [int(r.total_orders) for r in results],
+        "avg_times": [round(float(r.avg_time or 0), 1) for r in results],
+    }
+
+
+@cached
 def get_driver_leaderboard(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ):
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
+    # Sin búsqueda libre: se lee el rollup driver_daily_stats (incluye hoy)
+    plan = query_planner.plan_query("get_driver_leaderboard", search_query)
+    if plan.uses_rollup:
+        return _get_driver_leaderboard_rollup(db, start_date, end_date, store_name)
 
     query = db.query(
         Driver.name,
@@ -118,29 +266,118 @@ def get_driver_leaderboard(
         func.min(Order.created_at).label("first_delivery"),
     ).join(Order, Order.driver_id == Driver.id)
 
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        if start_date:
+            query = query.filter(Order.local_date >= start_date)
+        if end_date:
+            query = query.filter(Order.local_date <= end_date)
+        if store_name:
+            # USA EL NORMALIZADOR AQUÍ:
+            real_name = _normalize_store_filter(store_name)
+            query = query.join(Store, Order.store_id == Store.id).filter(
+                Store.name == real_name
+            )
+
+        query = apply_search(query, search_query)
+
+    results = (
+        query.group_by(Driver.name)
+        .order_by(desc("total_orders"), Driver.name)
+        .limit(50)
+        .all()
+    )
+    return _driver_activity(results)
+
+
+def _get_driver_leaderboard_rollup(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+):
+    stat = DriverDailyStat
+    query = db.query(
+        Driver.name,
+        func.sum(stat.orders_count).label("total_orders"),
+        func.max(stat.last_order_at).label("last_delivery"),
+        func.min(stat.first_order_at).label("first_delivery"),
+    ).join(Driver, stat.driver_id == Driver.id)
+
     if start_date:
-        query = query.filter(local_date >= start_date)
+        query = query.filter(stat.local_date >= start_date)
     if end_date:
-        query = query.filter(local_date <= end_date)
+        query = query.filter(stat.local_date <= end_date)
     if store_name:
-        # USA EL NORMALIZADOR AQUÍ:
         real_name = _normalize_store_filter(store_name)
-        query = query.join(Store, Order.store_id == Store.id).filter(
+        query = query.join(Store, stat.store_id == Store.id).filter(
             Store.name == real_name
         )
 
-    query = apply_search(query, search_query)
-
     results = (
         query.group_by(Driver.name)
         .order_by(desc("total_orders"), Driver.name)
         .limit(50)
         .all()
     )
+    return _driver_activity(results)
+
+
+@cached
+def get_driver_utilization(
+    db: Session,
+    driver_name: str,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+) -> Dict[str, Any]:
+    """Línea de tiempo diaria de un repartidor (pedidos y tiempo en ruta)."""
+    stat = DriverDailyStat
+    query = (
+        db.query(
+            stat.local_date.label("date"),
+            func.sum(stat.orders_count).label("orders"),
+            func.sum(stat.deliveries).label("deliveries"),
+            func.sum(stat.canceled_count).label("canceled"),
+            func.sum(stat.on_the_way_seconds).label("on_the_way_seconds"),
+            func.sum(stat.on_the_way_count).label("on_the_way_count"),
+        )
+        .join(Driver, stat.driver_id == Driver.id)
+        .filter(Driver.name == driver_name)
+    )
+    if start_date:
+        query = query.filter(stat.local_date >= start_date)
+    if end_date:
+        query = query.filter(stat.local_date <= end_date)
+
+    results = query.group_by(stat.local_date).order_by(stat.local_date).all()
+
+    return {
+        "driver": driver_name,
+        "labels": [r.date.strftime("%Y-%m-%d") for r in results],
+        "orders": [int(r.orders) for r in results],
+        "deliveries": [int(r.deliveries) for r in results],
+        "canceled": [int(r.canceled) for r in results],
+        "on_the_way_hours": [
+            round(float(r.on_the_way_seconds) / 3600, 2) for r in results
+        ],
+        "avg_on_the_way_minutes": [
+            (
+                round(float(r.on_the_way_seconds) / r.on_the_way_count / 60, 1)
+                if r.on_the_way_count
+                else 0.0
+            )
+            for r in results
+        ],
+    }
+
 
+def _driver_activity(results):
+    """Promedio diario y estado de actividad para las filas del leaderboard."""
     data = []
     now = datetime.utcnow()
     for row in results:
+        total_orders = int(row.total_orders)
         days_inactive = -1
         daily_avg = 0.0
         status = "unknown"
@@ -148,10 +385,10 @@ def get_driver_leaderboard(
             days_active = (now - row.first_delivery).days
             if days_active < 1:
                 days_active = 1
-            daily_avg = row.total_orders / days_active
+            daily_avg = total_orders / days_active
         if row.last_delivery:
             days_inactive = (now - row.last_delivery).days
-            if row.total_orders < 20:
+            if total_orders < 20:
                 status = "new"
             elif days_inactive <= 2:
                 status = "active"
@@ -162,7 +399,7 @@ def get_driver_leaderboard(
         data.append(
             {
                 "name": row.name,
-                "orders": row.total_orders,
+                "orders": total_orders,
                 "days_inactive": days_inactive,
                 "daily_avg": round(daily_avg, 1),
                 "status": status,
@@ -171,13 +408,20 @@ def get_driver_leaderboard(
     return data
 
 
+@cached
 def get_top_stores(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ):
+    # Sin búsqueda libre: conteos desde el rollup diario
+    plan = query_planner.plan_query("get_top_stores", search_query)
+    if plan.uses_rollup:
+        return _get_top_stores_rollup(db, start_date, end_date, store_name)
+
     # Subquery para fecha inicio
     start_date_subquery = (
         db.query(Order.store_id, func.min(Order.created_at).label("first_order_date"))
@@ -197,24 +441,24 @@ def get_top_stores(
         .join(start_date_subquery, Store.id == start_date_subquery.c.store_id)
     )
 
-    # Filtros
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
-    if start_date:
-        query = query.filter(local_date >= start_date)
-    if end_date:
-        query = query.filter(local_date <= end_date)
-
     # QUIRÚRGICO: Eliminar tiendas sin nombre
     query = query.filter(Store.name != None)
 
-    # 1. Aplicamos el filtro normalizado
-    if store_name:
-        real_name = _normalize_store_filter(store_name)
-        query = query.filter(Store.name == real_name)
+    # Filtros
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        if start_date:
+            query = query.filter(Order.local_date >= start_date)
+        if end_date:
+            query = query.filter(Order.local_date <= end_date)
+
+        # 1. Aplicamos el filtro normalizado
+        if store_name:
+            real_name = _normalize_store_filter(store_name)
+            query = query.filter(Store.name == real_name)
 
-    query = apply_search(query, search_query)
+        query = apply_search(query, search_query)
 
     # 2. IMPORTANTE: Agregamos company_name al group_by para poder usarlo
     results = (
@@ -243,10 +487,58 @@ def get_top_stores(
         for row in results
     ]
 
+
+def _get_top_stores_rollup(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+):
+    # Primera venta histórica por tienda (todo el rollup, hoy incluido)
+    history = rollup_service.daily_facts_source()
+    first_seen = (
+        db.query(
+            history.c.store_id,
+            func.min(history.c.first_order_at).label("first_order_date"),
+        )
+        .group_by(history.c.store_id)
+        .subquery()
+    )
+
+    f = rollup_service.daily_facts_source(start_date, end_date)
+    query = (
+        db.query(
+            Store.name,
+            Store.company_name,
+            func.sum(f.c.orders_count).label("total_orders"),
+            first_seen.c.first_order_date,
+        )
+        .select_from(f)
+        .join(Store, f.c.store_id == Store.id)
+        .join(first_seen, Store.id == first_seen.c.store_id)
+        .filter(Store.name != None)
+    )
+
+    if store_name:
+        real_name = _normalize_store_filter(store_name)
+        query = query.filter(Store.name == real_name)
+
+    results = (
+        query.group_by(
+            Store.name,
+            Store.company_name,
+            first_seen.c.first_order_date,
+        )
+        .order_by(desc("total_orders"))
+        .all()
+    )
+
     return [
         {
-            "name": row.name,
-            "orders": row.total_orders,
+            "name": (
+                f"{row.company_name} - {row.name}" if row.company_name else row.name
+            ),
+            "orders": int(row.total_orders),
             "first_seen": (
                 row.first_order_date.strftime("%d/%m/%Y")
                 if row.first_order_date
@@ -257,159 +549,221 @@ def get_top_stores(
     ]
 
 
-def get_heatmap_data(
-    db: Session,
-    start_date: Optional[date] = None,
-    end_date: Optional[date] = None,
-    store_name: Optional[str] = None,
-):
+def _filter_heatmap(query, start_date, end_date, store_name, scope=None):
     # FIX: Solo 'delivered' y coordenadas válidas
     query = (
-        db.query(Order.latitude, Order.longitude)
-        .filter(Order.current_status == "delivered")
+        query.filter(Order.current_status == "delivered")
         .filter(Order.latitude != None)
         .filter(Order.latitude != 0)
         .filter(Order.latitude != 0.0)
     )
 
-    local_created_at = func.timezone(
-        "America/Caracas", func.timezone("UTC", Order.created_at)
-    )
-    local_date = func.date(local_created_at)
-
+    if scope is not None:
+        return query.join(scope, scope.c.id == Order.id)
     if start_date:
-        query = query.filter(local_date >= start_date)
+        query = query.filter(Order.local_date >= start_date)
     if end_date:
-        query = query.filter(local_date <= end_date)
+        query = query.filter(Order.local_date <= end_date)
     if store_name:
         # USA EL NORMALIZADOR AQUÍ:
         real_name = _normalize_store_filter(store_name)
         query = query.join(Store, Order.store_id == Store.id).filter(
             Store.name == real_name
         )
+    return query
+
+
+def _heatmap_cell_degrees(zoom: int) -> float:
+    # Un tile de 256px cubre 360/2^z grados: celdas de ~8px en pantalla
+    zoom = max(HEATMAP_MIN_ZOOM, min(int(zoom), HEATMAP_MAX_ZOOM))
+    return 360.0 / (2**zoom) / 32
+
 
+@cached
+def get_heatmap_data(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    scope=None,
+    zoom: Optional[int] = None,
+):
+    """
+    Puntos [lat, lng, intensidad] para Leaflet.heat.
+    Sin zoom: un punto por pedido entregado (modo original).
+    Con zoom: celdas de una grilla agregadas en SQL, peso = pedidos por celda.
+    """
+    if zoom is not None:
+        return _get_heatmap_binned(db, start_date, end_date, store_name, zoom, scope)
+
+    query = _filter_heatmap(
+        db.query(Order.latitude, Order.longitude),
+        start_date,
+        end_date,
+        store_name,
+        scope,
+    )
     results = query.all()
     return [[float(r.latitude), float(r.longitude), 0.6] for r in results]
 
 
-def calculate_bottlenecks(
+@cached
+def get_heatmap_bins(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    zoom: int = HEATMAP_DEFAULT_ZOOM,
+    scope=None,
+) -> List[List[int]]:
+    """Celdas [fila, columna, pedidos] de la grilla para el zoom dado."""
+    cell = _heatmap_cell_degrees(zoom)
+    lat_idx = func.floor(Order.latitude / cell)
+    lng_idx = func.floor(Order.longitude / cell)
+
+    query = _filter_heatmap(
+        db.query(
+            lat_idx.label("row"),
+            lng_idx.label("col"),
+            func.count(Order.id).label("orders"),
+        ),
+        start_date,
+        end_date,
+        store_name,
+        scope,
+    )
+    return [
+        [int(r.row), int(r.col), int(r.orders)]
+        for r in query.group_by(lat_idx, lng_idx).all()
+    ]
+
+
+def _get_heatmap_binned(db, start_date, end_date, store_name, zoom, scope=None):
+    if scope is not None:
+        parts = [get_heatmap_bins(db, zoom=zoom, scope=scope)]
+    else:
+        # Días cerrados y hoy por separado: los cerrados quedan en caché
+        # (TTL largo) y refrescar o mover el mapa solo re-escanea el día de hoy
+        today = local_today()
+        yesterday = today - timedelta(days=1)
+        closed_end = min(end_date, yesterday) if end_date else yesterday
+        parts = []
+        if start_date is None or start_date <= closed_end:
+            parts.append(
+                get_heatmap_bins(db, start_date, closed_end, store_name, zoom)
+            )
+        if end_date is None or end_date >= today:
+            parts.append(
+                get_heatmap_bins(
+                    db, max(start_date or today, today), end_date, store_name, zoom
+                )
+            )
+
+    weights = Counter()
+    for part in parts:
+        for row, col, count in part:
+            weights[(row, col)] += count
+    if not weights:
+        return []
+
+    cell = _heatmap_cell_degrees(zoom)
+    heaviest = max(weights.values())
+    return [
+        [
+            round((row + 0.5) * cell, 6),
+            round((col + 0.5) * cell, 6),
+            round(max(count / heaviest, 0.2), 3),
+        ]
+        for (row, col), count in weights.items()
+    ]
+
+
+# Si el tipo no está definido, forzamos Delivery
+_order_kind = case((Order.order_type == "Pickup", "Pickup"), else_="Delivery")
+
+
+def _stage_durations_query(
     db: Session,
+    columns,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ):
-    # Limites Anti-Zombie
-    MAX_STEP_SEC = 21600
-
-    query = db.query(
-        OrderStatusLog.order_id,
-        OrderStatusLog.status,
-        OrderStatusLog.timestamp,
-        Order.created_at,
-        Order.order_type,
-        Order.current_status,
-    ).join(Order, OrderStatusLog.order_id == Order.id)
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
+    """Duraciones por etapa válidas (sin zombies) de los pedidos filtrados."""
+    query = (
+        db.query(*columns)
+        .join(Order, OrderStageDuration.order_id == Order.id)
+        .filter(
+            or_(
+                # Etapas operativas: solo pedidos NO cancelados
+                and_(
+                    Order.current_status.is_distinct_from("canceled"),
+                    OrderStageDuration.stage.in_(BOTTLENECK_STEPS),
+                    OrderStageDuration.seconds > 10,
+                    OrderStageDuration.seconds < stage_service.MAX_STEP_SEC,
+                ),
+                # Cancelados: vida total (ignoramos relojes negativos y zombies > 8h)
+                and_(
+                    Order.current_status == "canceled",
+                    OrderStageDuration.stage == stage_service.CANCELED_LIFE_STAGE,
+                    OrderStageDuration.seconds > 0,
+                    OrderStageDuration.seconds < stage_service.MAX_CANCEL_LIFE_SEC,
+                ),
+            )
+        )
     )
 
+    if scope is not None:
+        return query.join(scope, scope.c.id == Order.id)
     if start_date:
-        query = query.filter(local_date >= start_date)
+        query = query.filter(Order.local_date >= start_date)
     if end_date:
-        query = query.filter(local_date <= end_date)
+        query = query.filter(Order.local_date <= end_date)
     if store_name:
         # USA EL NORMALIZADOR AQUÍ:
         real_name = _normalize_store_filter(store_name)
         query = query.join(Store, Order.store_id == Store.id).filter(
             Store.name == real_name
         )
-    query = apply_search(query, search_query)
-
-    logs = query.order_by(OrderStatusLog.order_id, OrderStatusLog.timestamp).all()
-    if not logs:
-        return {"delivery": [], "pickup": []}
-
-    metrics = {
-        "Delivery": {
-            "pending": [],
-            "processing": [],
-            "confirmed": [],
-            "driver_assigned": [],
-            "on_the_way": [],
-            "delivered_life_time": [],
-            "canceled_life_time": [],
-        },
-        "Pickup": {"pending": [], "processing": [], "canceled_life_time": []},
-    }
+    return apply_search(query, search_query)
 
-    orders_data = {}
-    for log in logs:
-        if log.order_id not in orders_data:
-            orders_data[log.order_id] = {
-                "created_at": log.created_at,
-                "type": log.order_type,
-                "current_status": log.current_status,
-                "logs": [],
-            }
-        orders_data[log.order_id]["logs"].append(log)
-
-    for oid, data in orders_data.items():
-        o_created, o_type, o_status, o_logs = (
-            data["created_at"],
-            data["type"],
-            data["current_status"],
-            data["logs"],
-        )
 
-        # 1. Decidir tipo de pedido (Si no está definido, forzamos Delivery)
-        o_type = o_type or "Delivery"
-        if o_type not in metrics:
-            continue  # Evitar errores si el tipo no existe
-        target = metrics[o_type]  # AHORA USAMOS PICKUP/DELIVERY
+@cached
+def calculate_bottlenecks(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    search_query: Optional[str] = None,
+    scope=None,
+):
+    query = _stage_durations_query(
+        db,
+        [
+            _order_kind.label("kind"),
+            OrderStageDuration.stage,
+            func.avg(OrderStageDuration.seconds).label("avg_seconds"),
+        ],
+        start_date,
+        end_date,
+        store_name,
+        search_query,
+        scope,
+    )
 
-        # 2. Cancelados (Separados)
-        if o_status == "canceled":
-            cancel_log = next(
-                (l for l in reversed(o_logs) if l.status == "canceled"), None
-            )
-            if cancel_log:
-                # CORRECCIÓN DE ZONA HORARIA:
-                # o_created viene del Scraper (Hora VET, ej: 09:00).
-                # cancel_log viene del Servidor (Hora UTC, ej: 13:00).
-                # Para compararlos, debemos sumar 4 horas a la fecha de creación.
-
-                # Ajuste VET -> UTC (Sumar 4 horas)
-                created_at_utc = o_created + timedelta(hours=4)
-
-                life = (cancel_log.timestamp - created_at_utc).total_seconds()
-
-                # FILTRO DE OUTLIERS:
-                # 1. Ignoramos negativos (errores de reloj)
-                # 2. Ignoramos > 8 horas (zombies administrativos)
-                if 0 < life < 28800:
-                    target["canceled_life_time"].append(life)
-            continue
-
-        # 3. Calcular tiempos por estado
-        for i in range(len(o_logs) - 1):
-            curr, nxt = o_logs[i], o_logs[i + 1]
-            if curr.status in target:
-                delta = (nxt.timestamp - curr.timestamp).total_seconds()
-                if 10 < delta < MAX_STEP_SEC:
-                    target[curr.status].append(delta)
-
-    # 4. Construir las barras de tiempo
-    def build_flow(metric_dict):
+    averages = {"Delivery": {}, "Pickup": {}}
+    for row in query.group_by(_order_kind, OrderStageDuration.stage).all():
+        averages[row.kind][row.stage] = float(row.avg_seconds)
+
+    # Construir las barras de tiempo
+    def build_flow(kind):
         res = []
         total = 0.0
-
-        # Orden de estados (Importante)
-        steps = ["pending", "processing", "confirmed", "driver_assigned", "on_the_way"]
-
-        for step in steps:
-            if step in metric_dict and metric_dict[step]:
-                avg = sum(metric_dict[step]) / len(metric_dict[step])
+        for step in PICKUP_STEPS if kind == "Pickup" else BOTTLENECK_STEPS:
+            if step in averages[kind]:
+                avg = averages[kind][step]
                 res.append({"status": step, "avg_duration_seconds": avg})
                 total += avg
 
@@ -418,149 +772,127 @@ def calculate_bottlenecks(
             res.append({"status": "delivered", "avg_duration_seconds": total})
 
         # Barra Cancelado (Promedio, por separado)
-        if metric_dict.get("canceled_life_time"):
-            avg_can = sum(metric_dict["canceled_life_time"]) / len(
-                metric_dict["canceled_life_time"]
+        if stage_service.CANCELED_LIFE_STAGE in averages[kind]:
+            res.append(
+                {
+                    "status": "canceled",
+                    "avg_duration_seconds": averages[kind][
+                        stage_service.CANCELED_LIFE_STAGE
+                    ],
+                }
             )
-            res.append({"status": "canceled", "avg_duration_seconds": avg_can})
-
         return res
 
-    return {
-        "delivery": build_flow(metrics["Delivery"]),
-        "pickup": build_flow(metrics["Pickup"]),
-    }
+    return {"delivery": build_flow("Delivery"), "pickup": build_flow("Pickup")}
 
-    query = db.query(
-        OrderStatusLog.order_id,
-        OrderStatusLog.status,
-        OrderStatusLog.timestamp,
-        Order.created_at,
-        Order.order_type,
-        Order.current_status,
-    ).join(Order, OrderStatusLog.order_id == Order.id)
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
 
-    if start_date:
-        query = query.filter(local_date >= start_date)
-    if end_date:
-        query = query.filter(local_date <= end_date)
-    if store_name:
-        # USA EL NORMALIZADOR AQUÍ:
-        real_name = _normalize_store_filter(store_name)
-        query = query.join(Store, Order.store_id == Store.id).filter(
-            Store.name == real_name
+@cached
+def get_stage_distribution(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    search_query: Optional[str] = None,
+    scope=None,
+):
+    """
+    p50/p90/p99 e histograma de duración por etapa, calculados en PostgreSQL
+    (percentile_cont / width_bucket). Mismo filtro anti-zombie que calculate_bottlenecks.
+    """
+    seconds = OrderStageDuration.seconds
+    filters = (start_date, end_date, store_name, search_query, scope)
+
+    stats = (
+        _stage_durations_query(
+            db,
+            [
+                _order_kind.label("kind"),
+                OrderStageDuration.stage,
+                func.count(OrderStageDuration.id).label("samples"),
+                func.avg(seconds).label("avg"),
+                func.percentile_cont(0.5).within_group(seconds).label("p50"),
+                func.percentile_cont(0.9).within_group(seconds).label("p90"),
+                func.percentile_cont(0.99).within_group(seconds).label("p99"),
+            ],
+            *filters,
         )
-    query = apply_search(query, search_query)
-
-    logs = query.order_by(OrderStatusLog.order_id, OrderStatusLog.timestamp).all()
-    if not logs:
-        return {"delivery": [], "pickup": []}
-
-    metrics = {
-        "Delivery": {
-            "pending": [],
-            "processing": [],
-            "confirmed": [],
-            "driver_assigned": [],
-            "on_the_way": [],
-            "canceled_life_time": [],
-        },
-        "Pickup": {"pending": [], "processing": [], "canceled_life_time": []},
-    }
+        .group_by(_order_kind, OrderStageDuration.stage)
+        .all()
+    )
 
-    orders_data = {}
-    for log in logs:
-        if log.order_id not in orders_data:
-            orders_data[log.order_id] = {
-                "created_at": log.created_at,
-                "type": log.order_type,
-                "current_status": log.current_status,
-                "logs": [],
-            }
-        orders_data[log.order_id]["logs"].append(log)
-
-    for oid, data in orders_data.items():
-        o_created, o_type, o_status, o_logs = (
-            data["created_at"],
-            data["type"],
-            data["current_status"],
-            data["logs"],
+    # width_bucket(x, array) -> i tal que edges[i-1] <= x < edges[i]
+    bucket = func.width_bucket(
+        seconds,
+        cast(postgresql.array(DURATION_BUCKET_EDGES), postgresql.ARRAY(Float)),
+    )
+    histogram = {}
+    for row in (
+        _stage_durations_query(
+            db,
+            [
+                _order_kind.label("kind"),
+                OrderStageDuration.stage,
+                bucket.label("bucket"),
+                func.count(OrderStageDuration.id).label("orders"),
+            ],
+            *filters,
         )
-        if o_type not in metrics:
-            continue
-        target = metrics[o_type]
-
-        # FIX: Cancelados se acumulan aparte
-        if o_status == "canceled":
-            cancel_log = next(
-                (l for l in reversed(o_logs) if l.status == "canceled"), None
-            )
-            if cancel_log:
-                life = (cancel_log.timestamp - o_created).total_seconds()
-                if 0 < life < 172800:
-                    target["canceled_life_time"].append(life)
-            continue
-
-        clean_logs = []
-        for log in o_logs:
-            if not clean_logs or clean_logs[-1].status != log.status:
-                clean_logs.append(log)
-
-        for i in range(len(clean_logs) - 1):
-            curr, nxt = clean_logs[i], clean_logs[i + 1]
-
-            # Si el estado actual es 'delivered', ya no calculamos más tiempo
-            if curr.status == "delivered":
-                break
-
-            if curr.status in target:
-                delta = (nxt.timestamp - curr.timestamp).total_seconds()
-                # MAX_STEP_SEC (6 horas) evita errores de pedidos que se quedan abiertos
-                if 10 < delta < MAX_STEP_SEC:
-                    target[curr.status].append(delta)
-
-    # FIX: Sumar promedios para el Total Entregado
-    def build_flow(metric_dict):
-        res = []
-        total = 0.0
-        steps = ["pending", "processing", "confirmed", "driver_assigned", "on_the_way"]
-        for step in steps:
-            if step in metric_dict and metric_dict[step]:
-                avg = sum(metric_dict[step]) / len(metric_dict[step])
-                res.append({"status": step, "avg_duration_seconds": avg})
-                total += avg
+        .group_by(_order_kind, OrderStageDuration.stage, bucket)
+        .all()
+    ):
+        counts = histogram.setdefault(
+            (row.kind, row.stage), [0] * (len(DURATION_BUCKET_EDGES) - 1)
+        )
+        index = min(max(row.bucket, 1), len(counts)) - 1
+        counts[index] += row.orders
 
-        # Barra Total
-        if total > 0:
-            res.append({"status": "delivered", "avg_duration_seconds": total})
+    by_stage = {(r.kind, r.stage): r for r in stats}
 
-        # Barra Cancelado (Promedio)
-        if metric_dict.get("canceled_life_time"):
-            avg_can = sum(metric_dict["canceled_life_time"]) / len(
-                metric_dict["canceled_life_time"]
+    def build(kind):
+        steps = PICKUP_STEPS if kind == "Pickup" else BOTTLENECK_STEPS
+        res = []
+        for stage in steps + [stage_service.CANCELED_LIFE_STAGE]:
+            row = by_stage.get((kind, stage))
+            if not row:
+                continue
+            res.append(
+                {
+                    "status": (
+                        "canceled"
+                        if stage == stage_service.CANCELED_LIFE_STAGE
+                        else stage
+                    ),
+                    "samples": row.samples,
+                    "avg_seconds": round(float(row.avg), 1),
+                    "p50_seconds": round(float(row.p50), 1),
+                    "p90_seconds": round(float(row.p90), 1),
+                    "p99_seconds": round(float(row.p99), 1),
+                    "histogram": histogram.get((kind, stage), []),
+                }
             )
-            res.append({"status": "canceled", "avg_duration_seconds": avg_can})
         return res
 
     return {
-        "delivery": build_flow(metrics["Delivery"]),
-        "pickup": build_flow(metrics["Pickup"]),
+        "bucket_edges_seconds": DURATION_BUCKET_EDGES,
+        "delivery": build("Delivery"),
+        "pickup": build("Pickup"),
     }
 
 
+@cached
 def get_top_customers(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ):
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
+    # Ranking de toda la historia: lectura indexada de customer_stats
+    if not store_name and _covers_all_history(db, start_date, end_date):
+        query_planner.record_path("get_top_customers", query_planner.ROLLUP)
+        return _get_top_customers_lifetime(db, search_query)
+    query_planner.record_path("get_top_customers", query_planner.RAW)
 
     # FIX: Evitamos apply_search() para no duplicar el JOIN con Customer
     query = (
@@ -573,34 +905,156 @@ def get_top_customers(
         .filter(Order.current_status == "delivered")
     )
 
-    if start_date:
-        query = query.filter(local_date >= start_date)
-    if end_date:
-        query = query.filter(local_date <= end_date)
-    if store_name:
-        # USA EL NORMALIZADOR AQUÍ:
-        real_name = _normalize_store_filter(store_name)
-        query = query.join(Store, Order.store_id == Store.id).filter(
-            Store.name == real_name
-        )
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        if start_date:
+            query = query.filter(Order.local_date >= start_date)
+        if end_date:
+            query = query.filter(Order.local_date <= end_date)
+        if store_name:
+            # USA EL NORMALIZADOR AQUÍ:
+            real_name = _normalize_store_filter(store_name)
+            query = query.join(Store, Order.store_id == Store.id).filter(
+                Store.name == real_name
+            )
+
+        # Filtro manual (índice trigram de customers.name)
+        if search_query:
+            query = query.filter(
+                Customer.name.ilike(
+                    search_service.contains_pattern(search_query), escape="\\"
+                )
+            )
+
+    all_results = (
+        query.group_by(Customer.name).order_by(desc("total_spent")).limit(20).all()
+    )
+    return _rank_customers(all_results)
+
+
+def _rank_customers(rows):
+    return [
+        {
+            "rank": index + 1,
+            "name": row.name or "Cliente Desconocido",
+            "count": row.total_orders,
+            "total_amount": float(row.total_spent or 0),
+        }
+        for index, row in enumerate(rows)
+    ]
+
+
+def _covers_all_history(db: Session, start_date, end_date) -> bool:
+    """¿El rango incluye desde el primer pedido registrado hasta hoy?"""
+    if end_date and end_date < local_today():
+        return False
+    if not start_date:
+        return True
+    first_order_at = db.query(func.min(CustomerStat.first_order_at)).scalar()
+    return first_order_at is not None and start_date <= local_date_of(first_order_at)
+
+
+def _get_top_customers_lifetime(db: Session, search_query: Optional[str] = None):
+    query = db.query(
+        Customer.name,
+        CustomerStat.delivered_count.label("total_orders"),
+        CustomerStat.total_spent.label("total_spent"),
+    ).join(Customer, CustomerStat.customer_id == Customer.id)
 
-    # Filtro manual
     if search_query:
-        query = query.filter(Customer.name.ilike(f"%{search_query}%"))
+        query = query.filter(
+            Customer.name.ilike(
+                search_service.contains_pattern(search_query), escape="\\"
+            )
+        )
 
-    all_results = query.group_by(Customer.name).order_by(desc("total_spent")).all()
+    rows = (
+        query.filter(CustomerStat.delivered_count > 0)
+        .order_by(CustomerStat.total_spent.desc())
+        .limit(20)
+        .all()
+    )
+    return _rank_customers(rows)
+
+
+# Mapa de colores coherente con el Dashboard
+TIMELINE_COLORS = {
+    "created": "#343a40",  # Dark
+    "pending": "#6c757d",  # Grey
+    "processing": "#ffc107",  # Warning (Amarillo)
+    "confirmed": "#0d6efd",  # Primary (Azul)
+    "driver_assigned": "#212529",  # Dark (Negro)
+    "on_the_way": "#0dcaf0",  # Info (Celeste)
+    "delivered": "#198754",  # Success (Verde)
+    "canceled": "#dc3545",  # Danger (Rojo)
+}
+
+# Traductor
+TIMELINE_LABELS = {
+    "created": "Creado",
+    "pending": "Pendiente",
+    "processing": "Facturando",
+    "confirmed": "Solicitando",
+    "driver_assigned": "Asignado",
+    "on_the_way": "En Camino",
+    "delivered": "Entregado",
+    "canceled": "Cancelado",
+}
+
+# Tope de pedidos por llamada a /timelines (una página de la tabla en vivo)
+MAX_TIMELINE_ORDERS = 500
+
+
+def get_order_timelines(
+    db: Session, order_ids: List[int]
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Cronología por estado (minutos) de varios pedidos en una sola consulta:
+    LAG() empareja cada log con el anterior del mismo pedido.
+    """
+    timelines = {
+        order_id: {"labels": [], "data": [], "colors": [], "total_seconds": 0}
+        for order_id in order_ids
+    }
+    if not timelines:
+        return timelines
 
-    final_list = []
-    for index, row in enumerate(all_results):
-        final_list.append(
-            {
-                "rank": index + 1,
-                "name": row.name or "Cliente Desconocido",
-                "count": row.total_orders,
-                "total_amount": float(row.total_spent or 0),
-            }
+    window = {
+        "partition_by": OrderStatusLog.order_id,
+        "order_by": (OrderStatusLog.timestamp, OrderStatusLog.id),
+    }
+    pairs = (
+        select(
+            OrderStatusLog.order_id,
+            OrderStatusLog.timestamp,
+            func.lag(OrderStatusLog.status).over(**window).label("prev_status"),
+            func.lag(OrderStatusLog.timestamp).over(**window).label("prev_timestamp"),
         )
-    return final_list[:20]
+        .where(OrderStatusLog.order_id.in_(list(timelines)))
+        .subquery("pairs")
+    )
+    rows = db.execute(
+        select(pairs)
+        .where(pairs.c.prev_status != None)
+        .order_by(pairs.c.order_id, pairs.c.timestamp)
+    ).all()
+
+    first_seen = {}
+    for row in rows:
+        timeline = timelines[row.order_id]
+        started_at = first_seen.setdefault(row.order_id, row.prev_timestamp)
+        timeline["total_seconds"] = (row.timestamp - started_at).total_seconds()
+
+        # Solo guardamos si duró algo significativo (> 0.1 min)
+        delta = (row.timestamp - row.prev_timestamp).total_seconds() / 60
+        if delta > 0.1:
+            status_key = row.prev_status.lower()
+            timeline["labels"].append(TIMELINE_LABELS.get(status_key, status_key))
+            timeline["data"].append(round(delta, 1))
+            timeline["colors"].append(TIMELINE_COLORS.get(status_key, "#cccccc"))
+
+    return timelines
 
 
 def get_total_duration_for_order(db: Session, order_id: int):
@@ -623,80 +1077,95 @@ def get_total_duration_for_order(db: Session, order_id: int):
     return {"total_seconds": 0, "source": "unknown"}
 
 
+@cached
 def get_cancellation_reasons(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ):
-    local_date = func.date(
-        func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
-    )
 
+    # Agrupamos por el código entero del clasificador (indexado)
     query = db.query(
-        Order.cancellation_reason, func.count(Order.id).label("count")
-    ).filter(Order.current_status == "canceled", Order.cancellation_reason != None)
-
-    if start_date:
-        query = query.filter(local_date >= start_date)
-    if end_date:
-        query = query.filter(local_date <= end_date)
-    if store_name:
-        # USA EL NORMALIZADOR AQUÍ:
-        real_name = _normalize_store_filter(store_name)
-        query = query.join(Store, Order.store_id == Store.id).filter(
-            Store.name == real_name
-        )
+        Order.cancellation_code, func.count(Order.id).label("count")
+    ).filter(Order.current_status == "canceled", Order.cancellation_code != None)
+
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        if start_date:
+            query = query.filter(Order.local_date >= start_date)
+        if end_date:
+            query = query.filter(Order.local_date <= end_date)
+        if store_name:
+            # USA EL NORMALIZADOR AQUÍ:
+            real_name = _normalize_store_filter(store_name)
+            query = query.join(Store, Order.store_id == Store.id).filter(
+                Store.name == real_name
+            )
 
-    query = apply_search(query, search_query)
+        query = apply_search(query, search_query)
 
-    results = query.group_by(Order.cancellation_reason).order_by(desc("count")).all()
-    return [{"reason": row.cancellation_reason, "count": row.count} for row in results]
+    results = query.group_by(Order.cancellation_code).order_by(desc("count")).all()
+    return [
+        {
+            "reason": cancellation_service.label_for(row.cancellation_code),
+            "count": row.count,
+        }
+        for row in results
+    ]
 
 
+@cached
 def get_top_products(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    scope=None,
 ):
-    query = db.query(
-        OrderItem.name,
-        func.sum(OrderItem.quantity).label("total_qty"),
-        func.sum(OrderItem.total_price).label("total_revenue"),
-    ).join(Order, OrderItem.order_id == Order.id)
-
-    if start_date:
-        query = query.filter(cast(Order.created_at, Date) >= start_date)
-    if end_date:
-        query = query.filter(cast(Order.created_at, Date) <= end_date)
-    if store_name:
-        # USA EL NORMALIZADOR AQUÍ:
-        real_name = _normalize_store_filter(store_name)
-        query = query.join(Store, Order.store_id == Store.id).filter(
-            Store.name == real_name
+    # Agrupamos por la dimensión de productos (clave entera, promos ya marcadas)
+    query = (
+        db.query(
+            Product.name,
+            func.sum(OrderItem.quantity).label("total_qty"),
+            func.sum(OrderItem.total_price).label("total_revenue"),
         )
+        .join(Product, OrderItem.product_id == Product.id)
+        .join(Order, OrderItem.order_id == Order.id)
+    )
 
-    if search_query:
-        query = query.join(
-            Customer, Order.customer_id == Customer.id, isouter=True
-        ).filter(
-            or_(
-                OrderItem.name.ilike(f"%{search_query}%"),
-                Customer.name.ilike(f"%{search_query}%"),
-                Order.external_id.ilike(f"%{search_query}%"),
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        if start_date:
+            query = query.filter(Order.local_date >= start_date)
+        if end_date:
+            query = query.filter(Order.local_date <= end_date)
+        if store_name:
+            # USA EL NORMALIZADOR AQUÍ:
+            real_name = _normalize_store_filter(store_name)
+            query = query.join(Store, Order.store_id == Store.id).filter(
+                Store.name == real_name
+            )
+
+        ids = search_service.matching_order_ids(search_query)
+        if ids is not None:
+            query = query.filter(
+                or_(
+                    search_service.matching_item_names(search_query),
+                    Order.id.in_(ids),
+                )
             )
-        )
 
     query = query.filter(
-        OrderItem.unit_price > 0.01,
-        ~OrderItem.name.ilike("%obsequio%"),
-        ~OrderItem.name.ilike("%bolsa%gopharma%"),
+        OrderItem.unit_price > 0.01, Product.is_promotional.is_(False)
     )
 
-    results = query.group_by(OrderItem.name).order_by(desc("total_qty")).limit(10).all()
+    results = query.group_by(Product.id).order_by(desc("total_qty")).limit(10).all()
 
     return [
         {
@@ -706,3 +1175,103 @@ def get_top_products(
         }
         for row in results
     ]
+
+
+def get_recent_orders(db: Session, query, limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    Últimos pedidos (ya filtrados por quien llama) con items, driver y lealtad.
+    Número fijo de consultas sin importar 'limit' (nada de N+1):
+    pedidos + tienda/cliente/driver (JOIN), items y auditorías (selectin),
+    último log (ventana) y pedidos por cliente (customer_stats).
+    """
+    orders = (
+        query.options(
+            joinedload(Order.store),
+            joinedload(Order.customer),
+            joinedload(Order.driver),
+            selectinload(Order.items),
+            selectinload(Order.audits),
+        )
+        .order_by(Order.created_at.desc())
+        .limit(limit)
+        .all()
+    )
+    if not orders:
+        return []
+
+    order_ids = [o.id for o in orders]
+
+    # 1. Tiempos: último log de cada pedido
+    ranked_logs = (
+        db.query(
+            OrderStatusLog.order_id,
+            OrderStatusLog.timestamp,
+            func.row_number()
+            .over(
+                partition_by=OrderStatusLog.order_id,
+                order_by=OrderStatusLog.timestamp.desc(),
+            )
+            .label("rn"),
+        )
+        .filter(OrderStatusLog.order_id.in_(order_ids))
+        .subquery()
+    )
+    last_log_at = dict(
+        db.query(ranked_logs.c.order_id, ranked_logs.c.timestamp)
+        .filter(ranked_logs.c.rn == 1)
+        .all()
+    )
+
+    # 2. Lealtad: pedidos históricos por cliente (lookup en customer_stats)
+    customer_ids = {o.customer_id for o in orders if o.customer_id}
+    orders_per_customer = {}
+    if customer_ids:
+        orders_per_customer = dict(
+            db.query(CustomerStat.customer_id, CustomerStat.order_count)
+            .filter(CustomerStat.customer_id.in_(customer_ids))
+            .all()
+        )
+
+    data_response = []
+    for o in orders:
+        # 3. Driver
+        driver_info = {"name": "No Asignado", "phone": None}
+        if o.driver:
+            driver_info["name"] = o.driver.name
+            driver_info["phone"] = getattr(o.driver, "phone", None)
+
+        # 4. ITEMS (ESTO ES LO QUE FALTABA PARA VER LA LISTA)
+        items_list = [
+            {
+                "name": i.name,
+                "quantity": i.quantity,
+                "unit_price": i.unit_price,
+                "total_price": i.total_price,
+            }
+            for i in o.items
+        ]
+
+        data_response.append(
+            {
+                "id": o.id,
+                "external_id": o.external_id,
+                "current_status": o.current_status,
+                "order_type": o.order_type,
+                "total_amount": o.total_amount,
+                "store_name": (
+                    f"{o.store.company_name} - {o.store.name}"
+                    if o.store and o.store.company_name
+                    else (o.store.name if o.store else "Sin Tienda")
+                ),
+                "customer_name": o.customer.name if o.customer else "Anónimo",
+                "customer_phone": o.customer.phone if o.customer else None,
+                "customer_orders_count": orders_per_customer.get(o.customer_id, 0),
+                "driver": driver_info,
+                "created_at": o.created_at,
+                "state_start_at": last_log_at.get(o.id, o.created_at),
+                "duration_text": o.duration,
+                "items": items_list,  # <--- AQUÍ SE ENVÍA LA DATA AL FRONT
+                "has_audit": bool(o.audits),
+            }
+        )
+    return data_response
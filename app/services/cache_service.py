@@ -0,0 +1,117 @@
+"""
+Caché de respuestas analíticas en Redis (la misma instancia de Celery).
+
+La clave incluye la función, sus filtros y un contador de versión de datos.
+El ingestor incrementa el contador cada vez que cambia un pedido, así que las
+entradas viejas simplemente dejan de leerse y expiran solas por TTL.
+Si Redis no responde, se calcula directo contra la DB (fail-open).
+"""
+
+import enum
+import functools
+import hashlib
+import inspect
+import json
+import logging
+from datetime import date, datetime
+from typing import Optional
+
+import redis
+
+from app.core.config import settings
+from app.services import query_planner
+from app.services.order_metrics import local_today
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "analytics"
+# Cualquier pedido cambió (invalida rangos que incluyen hoy)
+DATA_VERSION_KEY = f"{KEY_PREFIX}:data_version"
+# Cambió un pedido de un día ya cerrado (invalida también rangos pasados)
+PAST_VERSION_KEY = f"{KEY_PREFIX}:data_version:past"
+
+LIVE_TTL = 120  # Rangos que incluyen hoy
+PAST_TTL = 86400  # Rangos íntegramente pasados
+
+_client: Optional[redis.Redis] = None
+
+
+def _get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        # Timeouts cortos: un Redis lento no debe frenar el dashboard
+        _client = redis.Redis.from_url(
+            settings.REDIS_URL, socket_timeout=0.25, socket_connect_timeout=0.25
+        )
+    return _client
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    raise TypeError(f"No serializable: {type(value)}")
+
+
+def _is_past_range(end_date: Optional[date]) -> bool:
+    return end_date is not None and end_date < local_today()
+
+
+def bump_data_version(changed_day: Optional[date] = None):
+    """Invalida la caché tras escribir un pedido. Nunca lanza excepción."""
+    try:
+        client = _get_client()
+        client.incr(DATA_VERSION_KEY)
+        if changed_day is None or changed_day < local_today():
+            client.incr(PAST_VERSION_KEY)
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ Caché: no se pudo invalidar la versión de datos: {e}")
+
+
+def cached(func):
+    """
+    Cachea funciones de servicio con firma (db, start_date, end_date, store_name, ...).
+    Las llamadas con 'scope' (CTE del snapshot) no se cachean.
+    """
+    signature = inspect.signature(func)
+    name = f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = {k: v for k, v in bound.arguments.items() if k != "db"}
+        if params.get("scope") is not None:
+            return func(*args, **kwargs)
+
+        past = _is_past_range(params.get("end_date"))
+        try:
+            client = _get_client()
+            version = client.get(PAST_VERSION_KEY if past else DATA_VERSION_KEY)
+            digest = hashlib.sha1(
+                json.dumps(params, sort_keys=True, default=_json_default).encode()
+            ).hexdigest()
+            # Cada contador con su espacio: la versión N de uno no es la del otro
+            scope_ns = "past" if past else "live"
+            key = f"{KEY_PREFIX}:{name}:{scope_ns}:{int(version or 0)}:{digest}"
+
+            hit = client.get(key)
+            if hit is not None:
+                query_planner.record_path(func.__name__, query_planner.CACHE)
+                return json.loads(hit)
+        except redis.RedisError as e:
+            logger.warning(f"⚠️ Caché no disponible ({name}): {e}")
+            return func(*args, **kwargs)
+
+        result = func(*args, **kwargs)
+        try:
+            # Ida y vuelta por JSON: el llamador recibe lo mismo en hit y en miss
+            payload = json.dumps(result, default=_json_default)
+            client.set(key, payload, ex=PAST_TTL if past else LIVE_TTL)
+            return json.loads(payload)
+        except redis.RedisError as e:
+            logger.warning(f"⚠️ Caché: no se pudo guardar {name}: {e}")
+        return result
+
+    return wrapper
@@ -0,0 +1,202 @@
+"""
+Clasificador de motivos de cancelación (Filtro Nivel 2).
+
+Las reglas viven en una tabla (CANCELLATION_RULES) y se compilan una sola vez
+en una regex: una rama con lookaheads por regla, probadas en orden de
+prioridad, así que un solo re.match resuelve lo que antes eran siete
+recorridos de listas. Cada motivo se guarda como un código entero
+(orders.cancellation_code, indexado) junto a su etiqueta y el texto original,
+para poder reclasificar todo el histórico cuando cambien las reglas.
+"""
+
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from sqlalchemy import func, update, values, column, String, Integer
+
+from app.db.base import Order
+
+logger = logging.getLogger(__name__)
+
+UNSPECIFIED_CODE = 0
+OTHER_CODE = 99
+
+# (código, etiqueta, grupos de palabras clave). Deben aparecer TODOS los grupos.
+# El orden es la prioridad: gana la primera regla que coincida.
+CANCELLATION_RULES: List[Tuple[int, str, List[List[str]]]] = [
+    # 1. Disponibilidad de Producto (incluye errores ortográficos y variantes)
+    (
+        1,
+        "Producto No Disponible / Dañado",
+        [
+            [
+                "disponib",
+                "dsiponible",
+                "existencia",
+                "vencido",
+                "dañado",
+                "no hay",
+                "no tenemos",
+                "blister",
+                "inventario",
+                "coca cola",
+                "falta",
+                "falto",
+                "agotado",
+                "stock",
+                "medicamento",
+                "existente",
+                "contamos",
+                "disponen",
+                "disponemos",
+            ]
+        ],
+    ),
+    # 2. Pagos (el tiempo agotado va antes que el genérico)
+    (
+        2,
+        "Tiempo de Pago Agotado",
+        [
+            ["payment", "pago", "transferencia", "zelle", "móvil", "movil"],
+            ["agotado", "tiempo"],
+        ],
+    ),
+    (
+        3,
+        "Problemas con el Pago",
+        [["payment", "pago", "transferencia", "zelle", "móvil", "movil"]],
+    ),
+    # 3. Récipe Médico
+    (
+        4,
+        "Requiere Récipe Médico",
+        [["recipe", "récipe", "receta", "indicacion", "indicación"]],
+    ),
+    # 4. Zona de Cobertura
+    (
+        5,
+        "Fuera de Zona de Cobertura",
+        [["cobertura", "cubre", "lejos", "valencia", "zona", "delery"]],
+    ),
+    # 5. Fuera de Horario
+    (
+        6,
+        "Fuera de Horario / Tienda Cerrada",
+        [["horario", "cierre", "cerrado", "tarde"]],
+    ),
+    # 6. Errores del Cliente
+    (
+        7,
+        "Error en Pedido / Descripción",
+        [
+            [
+                "equivocado",
+                "descripcion",
+                "descripción",
+                "precio",
+                "código",
+                "codigo",
+                "error",
+                "guante",
+                "par",
+            ]
+        ],
+    ),
+    # 7. Administrativo
+    (
+        8,
+        "Cancelación Administrativa",
+        [["nota", "prueba", "test", "orden de", "admin", "traspaso", "ajuste"]],
+    ),
+]
+
+CODE_LABELS: Dict[int, str] = {
+    UNSPECIFIED_CODE: "Sin especificar",
+    OTHER_CODE: "Otros motivos",
+    **{code: label for code, label, _ in CANCELLATION_RULES},
+}
+_LABEL_CODES = {label: code for code, label in CODE_LABELS.items()}
+
+
+def _compile_rules() -> re.Pattern:
+    branches = []
+    for code, _, groups in CANCELLATION_RULES:
+        lookaheads = "".join(
+            f"(?=.*?(?:{'|'.join(re.escape(k) for k in keywords)}))"
+            for keywords in groups
+        )
+        # Grupo vacío al final: match.lastgroup indica qué regla ganó
+        branches.append(f"{lookaheads}(?P<r{code}>)")
+    return re.compile("|".join(branches), re.DOTALL)
+
+
+_RULES_RE = _compile_rules()
+
+
+def classify_reason(text: Optional[str]) -> Tuple[int, str]:
+    """Texto libre del Legacy -> (código, etiqueta estandarizada)."""
+    if not text or text == "." or len(text) < 3:
+        return UNSPECIFIED_CODE, CODE_LABELS[UNSPECIFIED_CODE]
+
+    text = text.replace("del pedido :", "").replace("del pedido", "").strip()
+    match = _RULES_RE.match(text.lower())
+    if match:
+        code = int(match.lastgroup[1:])
+        return code, CODE_LABELS[code]
+
+    # Fallback: si alguien inventa algo MUY nuevo, se guarda en Capitalize
+    return OTHER_CODE, text.title()
+
+
+def label_for(code: int) -> str:
+    """Etiqueta del dashboard para un código (los textos libres van a 'Otros')."""
+    return CODE_LABELS.get(code, CODE_LABELS[OTHER_CODE])
+
+
+def _reclassify_source(text: Optional[str]) -> Tuple[int, str]:
+    # Pedidos anteriores al texto crudo: solo tienen la etiqueta ya normalizada
+    if text in _LABEL_CODES and text != CODE_LABELS[OTHER_CODE]:
+        return _LABEL_CODES[text], text
+    return classify_reason(text)
+
+
+def reclassify_all(db: Session, batch_size: int = 1000) -> int:
+    """
+    Re-etiqueta todos los pedidos cancelados con las reglas actuales.
+    Se clasifica cada texto distinto una sola vez y se actualiza en bloque
+    con UPDATE ... FROM (VALUES ...).
+    """
+    source = func.coalesce(Order.cancellation_reason_raw, Order.cancellation_reason)
+    texts = [
+        row[0]
+        for row in db.query(source)
+        .filter(Order.current_status == "canceled", source != None)
+        .distinct()
+        .all()
+    ]
+
+    updated = 0
+    for i in range(0, len(texts), batch_size):
+        rows = [(t, *_reclassify_source(t)) for t in texts[i : i + batch_size]]
+        mapping = values(
+            column("source", String),
+            column("code", Integer),
+            column("label", String),
+            name="mapping",
+        ).data(rows)
+        updated += db.execute(
+            update(Order)
+            .where(Order.current_status == "canceled", source == mapping.c.source)
+            .values(
+                cancellation_code=mapping.c.code, cancellation_reason=mapping.c.label
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+    db.commit()
+    logger.info(
+        f"🏷️ Motivos de cancelación reclasificados: {len(texts)} textos distintos, "
+        f"{updated} pedidos."
+    )
+    return updated
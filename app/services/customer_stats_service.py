@@ -0,0 +1,62 @@
+import logging
+from typing import Iterable, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, insert
+
+from app.db.base import Order, CustomerStat
+
+logger = logging.getLogger(__name__)
+
+# Columnas de customer_stats (mismo orden que _stats_select)
+STAT_COLUMNS = [
+    "customer_id",
+    "order_count",
+    "delivered_count",
+    "total_spent",
+    "first_order_at",
+    "last_order_at",
+]
+
+
+def _stats_select(customer_ids: Optional[set] = None):
+    """Agrega 'orders' por cliente con la forma de customer_stats."""
+    delivered = Order.current_status == "delivered"
+    stmt = select(
+        Order.customer_id,
+        func.count(Order.id),
+        func.count(Order.id).filter(delivered),
+        func.coalesce(func.sum(Order.total_amount).filter(delivered), 0.0),
+        func.min(Order.created_at),
+        func.max(Order.created_at),
+    ).where(Order.customer_id != None)
+    if customer_ids is not None:
+        stmt = stmt.where(Order.customer_id.in_(customer_ids))
+    return stmt.group_by(Order.customer_id)
+
+
+def refresh_customer_stats(db: Session, customer_ids: Iterable[Optional[int]]):
+    """
+    Recalcula las filas de los clientes indicados (índice orders.customer_id).
+    No hace commit: corre dentro de la transacción del ingestor.
+    """
+    ids = {c for c in customer_ids if c is not None}
+    if not ids:
+        return
+    db.query(CustomerStat).filter(CustomerStat.customer_id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    db.execute(insert(CustomerStat).from_select(STAT_COLUMNS, _stats_select(ids)))
+
+
+def rebuild_customer_stats(db: Session) -> int:
+    """Reconstruye customer_stats completo desde 'orders'."""
+    deleted = db.query(CustomerStat).delete(synchronize_session=False)
+    result = db.execute(
+        insert(CustomerStat).from_select(STAT_COLUMNS, _stats_select())
+    )
+    db.commit()
+    logger.info(
+        f"👥 Estadísticas de clientes reconstruidas: {deleted} borradas, "
+        f"{result.rowcount} insertadas."
+    )
+    return result.rowcount
@@ -0,0 +1,83 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+from typing import Dict, Any, Optional
+from datetime import date, datetime
+
+from app.db.base import Order
+from app.services import analysis_service, kpi_service
+from app.services.cache_service import cached
+
+
+@cached
+def get_dashboard_snapshot(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    search_query: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Todos los widgets del dashboard en una sola transacción.
+    Los widgets sobre 'orders' comparten el CTE 'filtered_orders' (filtro único);
+    los que tienen rollup (KPIs, tendencias, tiendas) lo usan si no hay búsqueda.
+    """
+    # Foto consistente: todas las consultas ven los mismos datos aunque el
+    # ingestor escriba en paralelo. SET TRANSACTION debe ser la primera sentencia.
+    db.rollback()
+    db.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"))
+
+    try:
+        scope = analysis_service.filtered_orders_cte(
+            start_date, end_date, store_name, search_query
+        )
+        filters = {
+            "start_date": start_date,
+            "end_date": end_date,
+            "store_name": store_name,
+            "search_query": search_query,
+        }
+
+        # Igual que /analysis/cancellations: sin ningún filtro, solo HOY
+        if not any(filters.values()):
+            cancellations = analysis_service.get_cancellation_reasons(
+                db, start_date=date.today(), end_date=date.today()
+            )
+        else:
+            cancellations = analysis_service.get_cancellation_reasons(
+                db, scope=scope, **filters
+            )
+
+        return {
+            "generated_at": datetime.utcnow(),
+            "kpis": kpi_service.get_main_kpis(db, scope=scope, **filters),
+            "orders": analysis_service.get_recent_orders(
+                db, db.query(Order).join(scope, scope.c.id == Order.id)
+            ),
+            "bottlenecks": analysis_service.calculate_bottlenecks(
+                db, scope=scope, **filters
+            ),
+            "cancellations": cancellations,
+            "trends": analysis_service.get_daily_trends(db, scope=scope, **filters),
+            "top_customers": analysis_service.get_top_customers(
+                db, scope=scope, **filters
+            ),
+            "top_products": analysis_service.get_top_products(
+                db, scope=scope, **filters
+            ),
+            "driver_leaderboard": analysis_service.get_driver_leaderboard(
+                db, scope=scope, **filters
+            ),
+            "top_stores": analysis_service.get_top_stores(db, scope=scope, **filters),
+            # Sin scope: el mapa nunca usó la búsqueda y así aprovecha la
+            # caché de celdas de días cerrados
+            "heatmap": analysis_service.get_heatmap_data(
+                db,
+                start_date,
+                end_date,
+                store_name,
+                zoom=analysis_service.HEATMAP_DEFAULT_ZOOM,
+            ),
+        }
+    finally:
+        # Transacción de solo lectura: la cerramos sin commit
+        db.rollback()
@@ -0,0 +1,121 @@
+import logging
+from datetime import date
+from typing import Iterable, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, insert, and_
+
+from app.db.base import Order, OrderStageDuration, DriverDailyStat
+from app.db.utils import advisory_xact_lock
+from app.services import stage_service
+
+logger = logging.getLogger(__name__)
+
+# Columnas del rollup (mismo orden en la tabla y en la agregación cruda)
+STAT_COLUMNS = [
+    "local_date",
+    "driver_id",
+    "store_id",
+    "orders_count",
+    "deliveries",
+    "canceled_count",
+    "on_the_way_seconds",
+    "on_the_way_count",
+    "first_order_at",
+    "last_order_at",
+]
+
+
+def _raw_stats_select(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    driver_ids: Optional[set] = None,
+):
+    """Agrega 'orders' por (día, driver, tienda) con la forma de driver_daily_stats."""
+    conditions = [Order.driver_id != None]
+    if start_date:
+        conditions.append(Order.local_date >= start_date)
+    if end_date:
+        conditions.append(Order.local_date <= end_date)
+    if driver_ids is not None:
+        conditions.append(Order.driver_id.in_(driver_ids))
+
+    # Tiempo en ruta por pedido; limitado a los pedidos de la porción a recalcular
+    on_the_way = (
+        select(
+            OrderStageDuration.order_id,
+            func.sum(OrderStageDuration.seconds).label("seconds"),
+        )
+        .where(
+            OrderStageDuration.stage == "on_the_way",
+            OrderStageDuration.seconds > 0,
+            OrderStageDuration.seconds < stage_service.MAX_STEP_SEC,
+            OrderStageDuration.order_id.in_(select(Order.id).where(*conditions)),
+        )
+        .group_by(OrderStageDuration.order_id)
+        .subquery("on_the_way")
+    )
+
+    return (
+        select(
+            Order.local_date,
+            Order.driver_id,
+            Order.store_id,
+            func.count(Order.id),
+            func.count(Order.id).filter(Order.current_status == "delivered"),
+            func.count(Order.id).filter(Order.current_status == "canceled"),
+            func.coalesce(func.sum(on_the_way.c.seconds), 0.0),
+            func.count(on_the_way.c.seconds),
+            func.min(Order.created_at),
+            func.max(Order.created_at),
+        )
+        .outerjoin(on_the_way, on_the_way.c.order_id == Order.id)
+        .where(*conditions)
+        .group_by(Order.local_date, Order.driver_id, Order.store_id)
+    )
+
+
+def refresh_driver_stats(
+    db: Session, day: Optional[date], driver_ids: Iterable[Optional[int]]
+):
+    """
+    Recalcula las porciones (día, driver) del rollup que toca un pedido.
+    No hace commit: se ejecuta dentro de la transacción del ingestor.
+    """
+    ids = {d for d in driver_ids if d is not None}
+    if not day or not ids:
+        return
+    # Un candado por (día, driver), en orden fijo para no bloquearse en cruz
+    for driver_id in sorted(ids):
+        advisory_xact_lock(db, f"driver_daily_stats:{day}:{driver_id}")
+    db.query(DriverDailyStat).filter(
+        and_(DriverDailyStat.local_date == day, DriverDailyStat.driver_id.in_(ids))
+    ).delete(synchronize_session=False)
+    db.execute(
+        insert(DriverDailyStat).from_select(
+            STAT_COLUMNS, _raw_stats_select(day, day, driver_ids=ids)
+        )
+    )
+
+
+def rebuild_driver_stats(
+    db: Session, start_date: Optional[date] = None, end_date: Optional[date] = None
+) -> int:
+    """Reconstruye driver_daily_stats completo (o un rango) desde 'orders'."""
+    delete_q = db.query(DriverDailyStat)
+    if start_date:
+        delete_q = delete_q.filter(DriverDailyStat.local_date >= start_date)
+    if end_date:
+        delete_q = delete_q.filter(DriverDailyStat.local_date <= end_date)
+    deleted = delete_q.delete(synchronize_session=False)
+
+    result = db.execute(
+        insert(DriverDailyStat).from_select(
+            STAT_COLUMNS, _raw_stats_select(start_date, end_date)
+        )
+    )
+    db.commit()
+    logger.info(
+        f"🛵 Estadísticas de repartidores reconstruidas: {deleted} borradas, "
+        f"{result.rowcount} insertadas."
+    )
+    return result.rowcount
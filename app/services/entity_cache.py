@@ -0,0 +1,133 @@
+"""
+Caché por proceso de nombre -> id para tiendas, clientes y drivers.
+
+El ingestor resuelve las mismas pocas centenas de tiendas y drivers todo el
+día; con esta caché LRU + TTL esos SELECT desaparecen del camino caliente.
+Coherencia entre procesos (API y workers): cada tipo tiene un contador de
+versión en Redis. Quien renombra o borra filas llama a invalidate(); los
+demás procesos ven la versión nueva en su próximo sync() y vacían su copia.
+Si Redis no responde, la caché local sigue sirviendo hasta su TTL.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+import redis
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("stores", "customers", "drivers")
+VERSION_KEY = "entities:version:{kind}"
+
+MAX_ENTRIES = 5000  # Por tipo
+TTL_SECONDS = 3600
+
+_client: Optional[redis.Redis] = None
+
+
+def _get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.REDIS_URL, socket_timeout=0.25, socket_connect_timeout=0.25
+        )
+    return _client
+
+
+class _EntityLRU:
+    def __init__(self):
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.version: Optional[int] = None
+
+    def get(self, name: str) -> Optional[int]:
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        entity_id, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[name]
+            return None
+        self.entries.move_to_end(name)
+        return entity_id
+
+    def put(self, name: str, entity_id: int):
+        self.entries[name] = (entity_id, time.monotonic() + TTL_SECONDS)
+        self.entries.move_to_end(name)
+        while len(self.entries) > MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+
+_caches: Dict[str, _EntityLRU] = {kind: _EntityLRU() for kind in KINDS}
+
+
+def get_many(kind: str, names: Iterable[str]) -> Dict[str, int]:
+    """{nombre: id} de los nombres que están en caché (los demás se omiten)."""
+    cache = _caches[kind]
+    found = {}
+    for name in names:
+        entity_id = cache.get(name)
+        if entity_id is not None:
+            found[name] = entity_id
+    return found
+
+
+def put_many(kind: str, ids: Dict[str, int]):
+    cache = _caches[kind]
+    for name, entity_id in ids.items():
+        cache.put(name, entity_id)
+
+
+def clear_local(kind: Optional[str] = None):
+    for k in [kind] if kind else KINDS:
+        _caches[k].entries.clear()
+
+
+def sync():
+    """Vacía los tipos cuya versión en Redis cambió (una lectura por lote)."""
+    try:
+        versions = _get_client().mget([VERSION_KEY.format(kind=k) for k in KINDS])
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ Caché de entidades: Redis no disponible: {e}")
+        return
+    for kind, raw in zip(KINDS, versions):
+        version = int(raw or 0)
+        cache = _caches[kind]
+        if cache.version is not None and cache.version != version:
+            cache.entries.clear()
+        cache.version = version
+
+
+def invalidate(kind: str):
+    """Tras renombrar o borrar filas: todos los procesos descartan su copia."""
+    clear_local(kind)
+    try:
+        _get_client().incr(VERSION_KEY.format(kind=kind))
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ Caché de entidades: no se pudo invalidar {kind}: {e}")
+
+
+def warm(db, customers_limit: int = 2000):
+    """Precarga tiendas y drivers completos y los clientes más recientes."""
+    from app.db.base import Store, Driver, Customer
+
+    sync()
+    for kind, model, limit in (
+        ("stores", Store, None),
+        ("drivers", Driver, None),
+        ("customers", Customer, customers_limit),
+    ):
+        # Orden descendente: si un nombre se repite, queda el id más bajo
+        # (el mismo que elige la búsqueda por nombre del ingestor)
+        query = db.query(model.name, model.id).filter(model.name != None)
+        if limit:
+            query = query.order_by(model.id.desc()).limit(limit)
+        rows = sorted(query.all(), key=lambda r: r.id, reverse=True)
+        put_many(kind, {name: entity_id for name, entity_id in rows})
+    logger.info(
+        "🔥 Caché de entidades precargada: "
+        + ", ".join(f"{k}={len(_caches[k].entries)}" for k in KINDS)
+    )
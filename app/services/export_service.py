@@ -0,0 +1,186 @@
+"""
+Exportación masiva de pedidos (CSV / NDJSON) en streaming.
+
+La consulta se lee con yield_per (cursor del lado del servidor en Postgres),
+así la memoria es constante sin importar cuántos pedidos salgan.
+Items y etapas se agregan como JSON por pedido dentro de la misma fila.
+"""
+
+import csv
+import enum
+import io
+import json
+from datetime import date, datetime
+from typing import Iterable, Iterator, List, Set
+
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, select
+
+from app.db.base import Order, Store, Customer, Driver, OrderItem
+from app.db.base import OrderStageDuration
+
+EXPORT_FORMATS = {"csv", "ndjson"}
+# Grupos de columnas opcionales (?include=store,driver,items,stages)
+EXPORT_GROUPS = {"store", "driver", "items", "stages"}
+
+# Filas por lote del cursor (y por chunk enviado al cliente)
+EXPORT_BATCH_SIZE = 1000
+
+
+def parse_groups(include: str) -> Set[str]:
+    """'items, driver' -> {'items', 'driver'}. Lanza ValueError si hay grupos desconocidos."""
+    groups = {g.strip().lower() for g in (include or "").split(",") if g.strip()}
+    unknown = groups - EXPORT_GROUPS
+    if unknown:
+        raise ValueError(f"Grupos desconocidos: {', '.join(sorted(unknown))}")
+    return groups
+
+
+def _items_json():
+    return (
+        select(
+            func.json_agg(
+                func.json_build_object(
+                    "name",
+                    OrderItem.name,
+                    "quantity",
+                    OrderItem.quantity,
+                    "unit_price",
+                    OrderItem.unit_price,
+                    "total_price",
+                    OrderItem.total_price,
+                )
+            )
+        )
+        .where(OrderItem.order_id == Order.id)
+        .correlate(Order)
+        .scalar_subquery()
+    )
+
+
+def _stages_json():
+    return (
+        select(
+            func.json_agg(
+                func.json_build_object(
+                    "stage",
+                    OrderStageDuration.stage,
+                    "seconds",
+                    OrderStageDuration.seconds,
+                )
+            )
+        )
+        .where(OrderStageDuration.order_id == Order.id)
+        .correlate(Order)
+        .scalar_subquery()
+    )
+
+
+def export_query(db: Session, groups: Set[str]):
+    """Consulta por columnas (no entidades ORM) lista para aplicar filtros."""
+    # Alias: los filtros del dashboard pueden hacer su propio JOIN con stores
+    store = aliased(Store)
+
+    columns = [
+        Order.id.label("id"),
+        Order.external_id.label("external_id"),
+        Order.created_at.label("created_at"),
+        Order.local_date.label("local_date"),
+        Order.current_status.label("status"),
+        Order.order_type.label("order_type"),
+        Order.total_amount.label("total_amount"),
+        Order.product_price.label("product_price"),
+        Order.delivery_fee.label("delivery_fee"),
+        Order.gross_delivery_fee.label("gross_delivery_fee"),
+        Order.service_fee.label("service_fee"),
+        Order.coupon_discount.label("coupon_discount"),
+        Order.payment_method.label("payment_method"),
+        Order.cancellation_reason.label("cancellation_reason"),
+        Order.duration.label("duration_text"),
+        Order.delivery_time_minutes.label("delivery_time_minutes"),
+        Order.distance_km.label("distance_km"),
+        Order.latitude.label("latitude"),
+        Order.longitude.label("longitude"),
+        Customer.name.label("customer_name"),
+    ]
+    if "store" in groups:
+        columns += [
+            store.company_name.label("store_company"),
+            store.name.label("store_name"),
+        ]
+    if "driver" in groups:
+        columns += [Driver.name.label("driver_name")]
+    if "items" in groups:
+        columns += [_items_json().label("items")]
+    if "stages" in groups:
+        columns += [_stages_json().label("stages")]
+
+    query = db.query(*columns).outerjoin(Customer, Order.customer_id == Customer.id)
+    if "store" in groups:
+        query = query.outerjoin(store, Order.store_id == store.id)
+    if "driver" in groups:
+        query = query.outerjoin(Driver, Order.driver_id == Driver.id)
+    return query
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+def _rows(query) -> Iterator[dict]:
+    # yield_per => stream_results: Postgres entrega los pedidos por lotes
+    for row in query.order_by(Order.id).execution_options(
+        yield_per=EXPORT_BATCH_SIZE
+    ):
+        yield {key: _plain(value) for key, value in row._mapping.items()}
+
+
+def _batched(lines: Iterable[str]) -> Iterator[str]:
+    chunk: List[str] = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def stream_ndjson(query) -> Iterator[str]:
+    return _batched(
+        json.dumps(row, ensure_ascii=False) + "\n" for row in _rows(query)
+    )
+
+
+def stream_csv(query) -> Iterator[str]:
+    header = [c["name"] for c in query.column_descriptions]
+
+    def lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def flush():
+            line = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            return line
+
+        writer.writerow(header)
+        yield flush()
+        for row in _rows(query):
+            writer.writerow(
+                [
+                    # Items / etapas van como JSON dentro de la celda
+                    json.dumps(row[k], ensure_ascii=False)
+                    if isinstance(row[k], (list, dict))
+                    else row[k]
+                    for k in header
+                ]
+            )
+            yield flush()
+
+    return _batched(lines())
@@ -0,0 +1,186 @@
+"""
+Cola write-behind entre los scrapers y la base de datos (Redis Streams).
+
+Los scrapers publican los payloads del dron en STREAM_KEY y siguen navegando;
+un consumidor dedicado (tasks.celery_tasks.consume_ingest_stream) los lee con
+un consumer group, los guarda por lotes con process_drone_batch y confirma
+(XACK) solo los que se escribieron. Lo no confirmado se reclama pasado
+CLAIM_IDLE_MS (XAUTOCLAIM) y, tras MAX_DELIVERIES intentos, se mueve al
+stream de descarte (DEAD_LETTER_KEY) para revisarlo o reencolarlo a mano.
+"""
+
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = "ingest:orders"
+DEAD_LETTER_KEY = "ingest:orders:dead"
+GROUP = "ingest-writers"
+
+STREAM_MAXLEN = 100000  # Recorte aproximado (MAXLEN ~) de mensajes ya leídos
+MAX_DELIVERIES = 5
+CLAIM_IDLE_MS = 60000  # Un mensaje sin ACK tras 1 min se reintenta
+
+Message = Tuple[str, dict]  # (id del stream, payload)
+
+_client: Optional[redis.Redis] = None
+
+
+def _get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _client
+
+
+def publish(payloads: List[dict]) -> bool:
+    """
+    Encola los payloads (un mensaje por pedido). False si Redis no responde:
+    el llamador debe escribirlos directo para no perderlos.
+    """
+    if not payloads:
+        return True
+    try:
+        pipe = _get_client().pipeline(transaction=False)
+        for data in payloads:
+            pipe.xadd(
+                STREAM_KEY,
+                {"payload": json.dumps(data, default=str, ensure_ascii=False)},
+                maxlen=STREAM_MAXLEN,
+                approximate=True,
+            )
+        pipe.execute()
+        return True
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ Stream de ingesta caído, escritura directa: {e}")
+        return False
+
+
+def ensure_group():
+    try:
+        _get_client().xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _decode(entries) -> List[Message]:
+    return [
+        (msg_id, json.loads(fields["payload"]))
+        for msg_id, fields in entries
+        if fields  # XAUTOCLAIM devuelve None si el mensaje ya se recortó
+    ]
+
+
+def read_batch(consumer: str, count: int, block_ms: int = 2000) -> List[Message]:
+    """
+    Primero reclama lo que otro consumidor dejó sin confirmar (y manda al
+    descarte lo que ya agotó sus intentos); luego lee mensajes nuevos.
+    """
+    client = _get_client()
+    _, claimed, *_ = client.xautoclaim(
+        STREAM_KEY, GROUP, consumer, CLAIM_IDLE_MS, start_id="0-0", count=count
+    )
+    messages = _decode(claimed)
+    if messages:
+        deliveries = {
+            p["message_id"]: p["times_delivered"]
+            for p in client.xpending_range(
+                STREAM_KEY,
+                GROUP,
+                min=messages[0][0],
+                max=messages[-1][0],
+                count=len(messages),
+                consumername=consumer,
+            )
+        }
+        exhausted = [
+            m for m in messages if deliveries.get(m[0], 0) > MAX_DELIVERIES
+        ]
+        for msg_id, data in exhausted:
+            dead_letter(msg_id, data, "Reintentos agotados")
+        messages = [m for m in messages if m not in exhausted]
+    if len(messages) >= count:
+        return messages
+
+    fresh = client.xreadgroup(
+        GROUP,
+        consumer,
+        {STREAM_KEY: ">"},
+        count=count - len(messages),
+        block=block_ms,
+    )
+    for _, entries in fresh or []:
+        messages += _decode(entries)
+    return messages
+
+
+def ack(msg_ids: List[str]):
+    if msg_ids:
+        _get_client().xack(STREAM_KEY, GROUP, *msg_ids)
+
+
+def dead_letter(msg_id: str, data: dict, error: str):
+    """Mueve el mensaje al stream de descarte y lo confirma en el principal."""
+    client = _get_client()
+    client.xadd(
+        DEAD_LETTER_KEY,
+        {
+            "payload": json.dumps(data, default=str, ensure_ascii=False),
+            "source_id": msg_id,
+            "error": error[:500],
+        },
+    )
+    client.xack(STREAM_KEY, GROUP, msg_id)
+    logger.error(f"☠️ Pedido #{data.get('external_id')} enviado a descarte: {error}")
+
+
+def replay_dead_letters(limit: Optional[int] = None) -> int:
+    """Reencola los mensajes del descarte (tras corregir la causa)."""
+    client = _get_client()
+    entries = client.xrange(DEAD_LETTER_KEY, count=limit)
+    if not entries:
+        return 0
+    pipe = client.pipeline()
+    for msg_id, fields in entries:
+        pipe.xadd(STREAM_KEY, {"payload": fields["payload"]})
+        pipe.xdel(DEAD_LETTER_KEY, msg_id)
+    pipe.execute()
+    return len(entries)
+
+
+def _id_age_seconds(msg_id: Optional[str]) -> Optional[float]:
+    # Los ids del stream empiezan con el timestamp en ms
+    if not msg_id:
+        return None
+    return round(time.time() - int(msg_id.split("-")[0]) / 1000, 1)
+
+
+def stream_stats() -> Dict[str, Any]:
+    """
+    Métricas de rezago: mensajes sin leer (lag), leídos sin confirmar
+    (pending), antigüedad del pendiente más viejo y tamaño del descarte.
+    Solo lee: si el consumidor aún no creó el grupo, lo informa (group=False).
+    """
+    client = _get_client()
+    group = None
+    if client.exists(STREAM_KEY):
+        group = next(
+            (g for g in client.xinfo_groups(STREAM_KEY) if g["name"] == GROUP), None
+        )
+    pending = client.xpending(STREAM_KEY, GROUP) if group else None
+    return {
+        "group": group is not None,
+        "stream_length": client.xlen(STREAM_KEY),
+        "lag": group.get("lag") if group else None,
+        "pending": pending["pending"] if pending else 0,
+        "oldest_pending_age_s": _id_age_seconds(pending["min"]) if pending else None,
+        "dead_letters": client.xlen(DEAD_LETTER_KEY),
+    }
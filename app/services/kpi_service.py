@@ -1,9 +1,12 @@
 import re
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func, cast, Date, or_
+from sqlalchemy import func, cast, Date, and_, select, true
 from typing import Dict, Any, Optional
 from datetime import date, datetime, timedelta
 from app.db.base import Order, Store, Customer
+from app.services import order_metrics as m
+from app.services import rollup_service, search_service, query_planner
+from app.services.cache_service import cached
 
 
 def _parse_duration_to_minutes(s: str) -> float:
@@ -27,12 +30,251 @@ def _parse_duration_to_minutes(s: str) -> float:
         return 0.0
 
 
+@cached
 def get_main_kpis(
     db: Session,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     store_name: Optional[str] = None,
     search_query: Optional[str] = None,
+    mode: str = "sql",
+    scope=None,
+) -> Dict[str, Any]:
+    """
+    KPIs principales del dashboard.
+    mode="sql" agrega todo dentro de PostgreSQL (un solo viaje).
+    mode="python" conserva el bucle original (referencia para benchmark).
+    scope: CTE de pedidos ya filtrados (snapshot del dashboard), reemplaza los filtros.
+    """
+    if mode == "python":
+        return _get_main_kpis_python(
+            db, start_date, end_date, store_name, search_query
+        )
+    return _get_main_kpis_sql(
+        db, start_date, end_date, store_name, search_query, scope
+    )
+
+
+def _apply_kpi_filters(query, start_date, end_date, store_name, search_query):
+    # local_date: día VET precalculado al ingerir (columna indexada)
+    if start_date:
+        query = query.filter(Order.local_date >= start_date)
+    if end_date:
+        query = query.filter(Order.local_date <= end_date)
+
+    if store_name:
+        query = query.filter(Store.name == store_name)
+
+    ids = search_service.matching_order_ids(search_query)
+    if ids is not None:
+        query = query.filter(Order.id.in_(ids))
+    return query
+
+
+def _new_users_filter(start_date, end_date):
+    # El Scraper guarda 'joined_at' como fecha sin hora (00:00:00).
+    # Si aplicamos timezone("America/Caracas"), restamos 4h y retrocedemos al día anterior.
+    # SOLUCIÓN: Usamos cast directo a Date.
+    local_joined_at = cast(Customer.joined_at, Date)
+    conditions = []
+    if start_date:
+        conditions.append(local_joined_at >= start_date)
+    if end_date:
+        conditions.append(local_joined_at <= end_date)
+    return conditions
+
+
+def _kpi_payload(row) -> Dict[str, Any]:
+    """Convierte la fila agregada (cruda o rollup) al diccionario de KPIs."""
+    valid_orders_count = row.deliveries + row.pickups
+    total_revenue = float(row.total_revenue)
+    real_net_profit = (
+        row.profit_delivery + row.profit_service + row.profit_commission
+    ) - row.total_coupons
+
+    return {
+        "total_orders": row.total_orders,
+        "total_revenue": round(total_revenue, 2),
+        "total_fees": round(float(row.total_fees_gross), 2),
+        "total_coupons": round(float(row.total_coupons), 2),
+        "driver_payout": round(float(row.driver_payout), 2),
+        "company_profit": round(float(real_net_profit), 2),
+        "total_deliveries": row.deliveries,
+        "total_pickups": row.pickups,
+        "total_canceled": row.total_canceled,
+        "lost_revenue": round(float(row.lost_revenue), 2),
+        "avg_delivery_minutes": round(float(row.avg_time or 0.0), 1),
+        "avg_ticket": round(
+            total_revenue / valid_orders_count if valid_orders_count > 0 else 0.0, 2
+        ),
+        "avg_delivery_ticket": round(
+            float(row.delivery_fees_only) / row.deliveries
+            if row.deliveries > 0
+            else 0.0,
+            2,
+        ),
+        "avg_service_fee": round(
+            float(row.total_service_fee) / valid_orders_count
+            if valid_orders_count > 0
+            else 0.0,
+            2,
+        ),
+        "total_users_historic": row.total_users_historic,
+        "active_users_period": row.active_users,
+        "new_users_registered": row.new_users,
+    }
+
+
+def _customer_subqueries(start_date, end_date):
+    # correlate(None): la consulta externa también hace JOIN con customers/stores
+    total_users_historic = (
+        select(func.count(Customer.id)).correlate(None).scalar_subquery()
+    )
+    new_users = (
+        select(func.count(Customer.id))
+        .where(*_new_users_filter(start_date, end_date))
+        .correlate(None)
+        .scalar_subquery()
+    )
+    return total_users_historic, new_users
+
+
+def _get_main_kpis_sql(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    search_query: Optional[str] = None,
+    scope=None,
+) -> Dict[str, Any]:
+    # El rollup no conoce clientes ni IDs: la búsqueda va contra 'orders'
+    plan = query_planner.plan_query("get_main_kpis", search_query)
+    if plan.uses_rollup:
+        return _get_main_kpis_rollup(db, start_date, end_date, store_name)
+
+    valid_delivery = and_(m.is_valid, ~m.is_pickup)
+    valid_duration = and_(
+        valid_delivery,
+        Order.current_status == "delivered",
+        m.kpi_duration_minutes > 0,
+        m.kpi_duration_minutes < 600,
+    )
+
+    def _sum(expr, condition=m.is_valid):
+        return func.coalesce(func.sum(expr).filter(condition), 0.0)
+
+    total_users_historic, new_users = _customer_subqueries(start_date, end_date)
+
+    query = db.query(
+        func.count(Order.id).label("total_orders"),
+        func.count(Order.id).filter(m.is_canceled).label("total_canceled"),
+        _sum(Order.total_amount, m.is_canceled).label("lost_revenue"),
+        func.count(Order.id).filter(and_(m.is_valid, m.is_pickup)).label("pickups"),
+        func.count(Order.id).filter(valid_delivery).label("deliveries"),
+        _sum(Order.total_amount).label("total_revenue"),
+        _sum(m.delivery_real).label("total_fees_gross"),
+        _sum(m.delivery_real, valid_delivery).label("delivery_fees_only"),
+        _sum(Order.coupon_discount).label("total_coupons"),
+        _sum(m.service_fee).label("total_service_fee"),
+        _sum(m.delivery_real * 0.80).label("driver_payout"),
+        _sum((m.delivery_real * 0.20) / 1.16).label("profit_delivery"),
+        _sum(
+            (m.product_price + m.product_price * 0.16 + m.delivery_real + m.service_fee)
+            * 0.05
+            / 1.16
+        ).label("profit_service"),
+        _sum(
+            m.product_price * (func.coalesce(Store.commission_rate, 0.0) / 100.0)
+        ).label("profit_commission"),
+        func.avg(m.kpi_duration_minutes).filter(valid_duration).label("avg_time"),
+        func.count(func.distinct(Order.customer_id)).label("active_users"),
+        total_users_historic.label("total_users_historic"),
+        new_users.label("new_users"),
+    ).outerjoin(Store, Order.store_id == Store.id)
+
+    if scope is not None:
+        query = query.join(scope, scope.c.id == Order.id)
+    else:
+        query = _apply_kpi_filters(
+            query, start_date, end_date, store_name, search_query
+        )
+    return _kpi_payload(query.one())
+
+
+def _get_main_kpis_rollup(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Mismo resultado que la versión cruda, leyendo order_daily_facts."""
+    f = rollup_service.daily_facts_source(start_date, end_date)
+
+    canceled = f.c.status == "canceled"
+    valid = f.c.status.is_distinct_from("canceled")
+    pickup = f.c.order_type.is_not_distinct_from("Pickup")
+    valid_delivery = and_(valid, ~pickup)
+    valid_duration = and_(valid_delivery, f.c.status == "delivered")
+
+    def _sum(expr, condition=valid):
+        return func.coalesce(func.sum(expr).filter(condition), 0)
+
+    # Clientes distintos no es aditivo entre días: se cuenta sobre 'orders'
+    active_users = select(func.count(func.distinct(Order.customer_id)))
+    if start_date:
+        active_users = active_users.where(Order.local_date >= start_date)
+    if end_date:
+        active_users = active_users.where(Order.local_date <= end_date)
+    if store_name:
+        active_users = active_users.join(Store, Order.store_id == Store.id).where(
+            Store.name == store_name
+        )
+    active_users = active_users.correlate(None).scalar_subquery()
+
+    total_users_historic, new_users = _customer_subqueries(start_date, end_date)
+
+    query = db.query(
+        _sum(f.c.orders_count, true()).label("total_orders"),
+        _sum(f.c.orders_count, canceled).label("total_canceled"),
+        _sum(f.c.total_revenue, canceled).label("lost_revenue"),
+        _sum(f.c.orders_count, and_(valid, pickup)).label("pickups"),
+        _sum(f.c.orders_count, valid_delivery).label("deliveries"),
+        _sum(f.c.total_revenue).label("total_revenue"),
+        _sum(f.c.delivery_fees).label("total_fees_gross"),
+        _sum(f.c.delivery_fees, valid_delivery).label("delivery_fees_only"),
+        _sum(f.c.coupons).label("total_coupons"),
+        _sum(f.c.service_fees).label("total_service_fee"),
+        _sum(f.c.delivery_fees * 0.80).label("driver_payout"),
+        _sum((f.c.delivery_fees * 0.20) / 1.16).label("profit_delivery"),
+        _sum(
+            (f.c.product_sales * 1.16 + f.c.delivery_fees + f.c.service_fees)
+            * 0.05
+            / 1.16
+        ).label("profit_service"),
+        _sum(
+            f.c.product_sales * (func.coalesce(Store.commission_rate, 0.0) / 100.0)
+        ).label("profit_commission"),
+        (
+            func.sum(f.c.kpi_duration_sum).filter(valid_duration)
+            / func.nullif(func.sum(f.c.kpi_duration_count).filter(valid_duration), 0)
+        ).label("avg_time"),
+        active_users.label("active_users"),
+        total_users_historic.label("total_users_historic"),
+        new_users.label("new_users"),
+    ).select_from(f).outerjoin(Store, f.c.store_id == Store.id)
+
+    if store_name:
+        query = query.filter(Store.name == store_name)
+
+    return _kpi_payload(query.one())
+
+
+def _get_main_kpis_python(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_name: Optional[str] = None,
+    search_query: Optional[str] = None,
 ) -> Dict[str, Any]:
 
     # OPTIMIZACIÓN: Eager Loading
@@ -40,33 +282,20 @@ def get_main_kpis(
         joinedload(Order.status_logs), joinedload(Order.store)
     )
 
-    # --- CORRECCIÓN DE ZONA HORARIA (PEDIDOS) ---
-    # Los pedidos SÍ tienen hora exacta, así que mantenemos la lógica VET
-    local_created_at = func.timezone(
-        "America/Caracas", func.timezone("UTC", Order.created_at)
-    )
-    local_date = func.date(local_created_at)
-
-    # --- FILTROS ---
+    # --- FILTROS (local_date = día VET precalculado) ---
     if start_date:
-        base_query = base_query.filter(local_date >= start_date)
+        base_query = base_query.filter(Order.local_date >= start_date)
     if end_date:
-        base_query = base_query.filter(local_date <= end_date)
+        base_query = base_query.filter(Order.local_date <= end_date)
 
     if store_name:
         base_query = base_query.join(Store, Order.store_id == Store.id).filter(
             Store.name == store_name
         )
 
-    if search_query:
-        base_query = base_query.join(
-            Customer, Order.customer_id == Customer.id, isouter=True
-        ).filter(
-            or_(
-                Order.external_id.ilike(f"%{search_query}%"),
-                Customer.name.ilike(f"%{search_query}%"),
-            )
-        )
+    ids = search_service.matching_order_ids(search_query)
+    if ids is not None:
+        base_query = base_query.filter(Order.id.in_(ids))
 
     orders = base_query.all()
 
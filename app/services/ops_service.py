@@ -0,0 +1,109 @@
+"""
+Resumen ejecutivo de Operaciones (página /ops).
+
+Una sola pasada sobre 'orders': la CTE agrupa por farmacia con
+COUNT(*) FILTER (...) y los totales globales salen de sumar esas filas.
+El método de pago se compara por código (Order.payment_code), sin LIKE.
+"""
+
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict
+
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, extract, and_, or_, desc
+
+from app.db.base import Order, Store, OrderAudit
+from app.services.cache_service import cached
+from app.services.order_metrics import is_canceled, is_refundable, PAYMENT_POS
+
+TOP_LIMIT = 5
+
+
+@cached
+def get_ops_executive_summary(
+    db: Session, start_date: date, end_date: date
+) -> Dict[str, Any]:
+    # Mismo rango de siempre (created_at de 00:00 a 23:59:59); local_date solo
+    # acota por índice: va hasta un día detrás del día de created_at
+    in_range = and_(
+        Order.local_date.between(start_date - timedelta(days=1), end_date),
+        Order.created_at.between(
+            datetime.combine(start_date, time.min),
+            datetime.combine(end_date, time(23, 59, 59)),
+        ),
+    )
+    # Turno nocturno (22:00 a 08:00)
+    is_night = or_(
+        extract("hour", Order.created_at) >= 22,
+        extract("hour", Order.created_at) < 8,
+    )
+
+    by_store = (
+        select(
+            Store.name.label("store"),
+            func.count(Order.id).label("total"),
+            func.count(Order.id).filter(Order.current_status == "delivered").label(
+                "delivered"
+            ),
+            # Solo reembolsos: cancelados con método de pago no efectivo
+            func.count(Order.id)
+            .filter(is_canceled, is_refundable)
+            .label("canceled"),
+            func.count(Order.id).filter(Order.payment_code == PAYMENT_POS).label("pos"),
+            func.count(Order.id).filter(is_night).label("night"),
+        )
+        .select_from(Order)
+        .outerjoin(Store, Order.store_id == Store.id)
+        .where(in_range)
+        .group_by(Store.name)
+        .cte("ops_by_store")
+    )
+    stores = db.execute(select(by_store)).all()
+
+    totals = {
+        key: sum(getattr(row, key) for row in stores)
+        for key in ("total", "delivered", "canceled", "pos", "night")
+    }
+    named = [row for row in stores if row.store is not None]
+    top_stores = sorted(named, key=lambda r: r.total, reverse=True)[:TOP_LIMIT]
+    canceled_stores = sorted(
+        (row for row in named if row.canceled > 0),
+        key=lambda r: r.canceled,
+        reverse=True,
+    )[:TOP_LIMIT]
+
+    # Fricción: incidencias gestionadas (tabla aparte, consulta propia)
+    top_incidences = (
+        db.query(OrderAudit.root_cause, func.count(OrderAudit.id).label("count"))
+        .join(Order, Order.id == OrderAudit.order_id)
+        .filter(in_range, OrderAudit.root_cause != None)
+        .group_by(OrderAudit.root_cause)
+        .order_by(desc("count"))
+        .limit(TOP_LIMIT)
+        .all()
+    )
+
+    total_orders = totals["total"]
+    fulfillment_rate = (
+        round((totals["delivered"] / total_orders * 100), 2) if total_orders > 0 else 0
+    )
+
+    return {
+        "global_health": {
+            "total_orders": total_orders,
+            "delivered": totals["delivered"],
+            "canceled": totals["canceled"],
+            "fulfillment_rate": fulfillment_rate,
+            "pos_orders": totals["pos"],  # Punto de venta
+            "night_orders": totals["night"],
+        },
+        "charts": {
+            "top_stores": [{"store": s.store, "orders": s.total} for s in top_stores],
+            "top_incidences": [
+                {"cause": i.root_cause, "count": i.count} for i in top_incidences
+            ],
+            "canceled_stores": [
+                {"store": s.store, "canceled": s.canceled} for s in canceled_stores
+            ],
+        },
+    }
@@ -0,0 +1,105 @@
+"""
+Expresiones SQL compartidas sobre la tabla 'orders'.
+Las usan los KPIs, los rollups y los reportes para que todos calculen
+exactamente lo mismo.
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Optional
+from sqlalchemy import func, cast, Float, case, select, extract
+
+from app.db.base import Order, OrderStatusLog
+
+# Venezuela no tiene horario de verano: UTC-4 fijo
+VET_OFFSET = timedelta(hours=4)
+
+# --- FECHA LOCAL (VET) ---
+# Las consultas usan la columna indexada Order.local_date; esta expresión solo
+# sirve para rellenarla (backfill) y debe coincidir con local_date_of().
+local_date_expr = func.date(
+    func.timezone("America/Caracas", func.timezone("UTC", Order.created_at))
+)
+
+
+def local_today() -> date:
+    return (datetime.utcnow() - VET_OFFSET).date()
+
+
+def local_date_of(created_at: datetime) -> date:
+    """Valor de Order.local_date para un created_at concreto."""
+    return (created_at - VET_OFFSET).date()
+
+
+# --- ESTATUS Y TIPO ---
+is_canceled = Order.current_status == "canceled"
+is_valid = Order.current_status.is_distinct_from("canceled")
+is_pickup = Order.order_type.is_not_distinct_from("Pickup")
+
+# --- MÉTODO DE PAGO ---
+# Código precalculado al ingerir (Order.payment_code) para no evaluar
+# LOWER(payment_method) LIKE fila por fila. La migración de create_tables.py
+# usa las mismas reglas en SQL.
+PAYMENT_CASH = 1
+PAYMENT_POS = 2  # Punto de venta
+PAYMENT_DIGITAL = 3  # Pago Móvil, Zelle, transferencias...
+
+
+def payment_code_of(payment_method: Optional[str]) -> Optional[int]:
+    """Valor de Order.payment_code para un método de pago del Legacy."""
+    if not payment_method:
+        return None
+    method = payment_method.lower()
+    if "efectivo" in method or "cash" in method:
+        return PAYMENT_CASH
+    if "punto" in method:
+        return PAYMENT_POS
+    return PAYMENT_DIGITAL
+
+
+# Cancelados que requieren reembolso (cualquier método conocido que no sea efectivo)
+is_refundable = Order.payment_code.in_([PAYMENT_POS, PAYMENT_DIGITAL])
+
+# --- FINANZAS ---
+delivery_real = case(
+    (Order.gross_delivery_fee > 0, Order.gross_delivery_fee),
+    else_=func.coalesce(Order.delivery_fee, 0.0),
+)
+product_price = func.coalesce(Order.product_price, 0.0)
+service_fee = func.coalesce(Order.service_fee, 0.0)
+coupon_discount = func.coalesce(Order.coupon_discount, 0.0)
+
+# --- DURACIÓN DE ENTREGA (Misma cadena de respaldo que el KPI en Python) ---
+# Mismas regex que kpi_service._parse_duration_to_minutes (Postgres acepta (?:...))
+_duration_text = func.replace(func.lower(Order.duration), "á", "a")
+_duration_hours = cast(
+    func.substring(_duration_text, r"(\d+)\s*(?:horas?|hours?|hrs?|h)"), Float
+)
+_duration_mins = cast(
+    func.substring(_duration_text, r"(\d+)\s*(?:minutos?|minutes?|mins?|min|m)"),
+    Float,
+)
+_parsed_minutes = (
+    func.coalesce(_duration_hours, 0.0) * 60 + func.coalesce(_duration_mins, 0.0)
+)
+
+# Primer log 'delivered' del pedido (created_at viene en VET, el log en UTC)
+_delivered_log_seconds = extract(
+    "epoch",
+    select(OrderStatusLog.timestamp)
+    .where(
+        OrderStatusLog.order_id == Order.id,
+        OrderStatusLog.status == "delivered",
+    )
+    .order_by(OrderStatusLog.id)
+    .limit(1)
+    .correlate(Order)
+    .scalar_subquery()
+    - (Order.created_at + VET_OFFSET),
+)
+
+kpi_duration_minutes = case(
+    (_parsed_minutes > 0, _parsed_minutes),
+    (Order.delivery_time_minutes > 0, Order.delivery_time_minutes),
+    (_delivered_log_seconds > 0, func.trunc(_delivered_log_seconds / 60)),
+    else_=0.0,
+)
@@ -0,0 +1,129 @@
+"""
+Dimensión de productos (tabla 'products').
+
+Clave: código de barras si existe, si no el nombre normalizado.
+La marca de promocional (obsequios, bolsas) se calcula una sola vez al crear
+el producto, en Python al ingerir y en SQL en el backfill, con las mismas reglas.
+"""
+
+import logging
+import re
+from typing import Dict, Iterable, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, literal, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.db.base import OrderItem, Product
+
+logger = logging.getLogger(__name__)
+
+# Items que no son venta real (mismas reglas que el viejo filtro ILIKE del top)
+PROMOTIONAL_PATTERNS = [r"obsequio", r"bolsa.*gopharma"]
+_PROMOTIONAL_RE = re.compile("|".join(PROMOTIONAL_PATTERNS), re.IGNORECASE)
+
+
+def normalize_name(name: Optional[str]) -> str:
+    return " ".join((name or "").lower().split())
+
+
+def product_key(barcode: Optional[str], name: Optional[str]) -> str:
+    barcode = (barcode or "").strip()
+    return f"bc:{barcode}" if barcode else f"nm:{normalize_name(name)}"
+
+
+def is_promotional(name: Optional[str]) -> bool:
+    return bool(_PROMOTIONAL_RE.search(name or ""))
+
+
+def resolve_products(db: Session, items: Iterable[dict]) -> Dict[str, int]:
+    """
+    Devuelve {product_key: product_id} para los items de un pedido, creando
+    los productos nuevos. Dos consultas por pedido, no una por item.
+    No hace commit: corre dentro de la transacción del ingestor.
+    """
+    wanted = {}
+    for item in items:
+        key = product_key(item.get("barcode"), item.get("name"))
+        wanted.setdefault(key, item)
+    if not wanted:
+        return {}
+
+    # ON CONFLICT: otro worker puede estar creando el mismo producto
+    db.execute(
+        pg_insert(Product)
+        .values(
+            [
+                {
+                    "product_key": key,
+                    "barcode": (item.get("barcode") or "").strip() or None,
+                    "name": item.get("name"),
+                    "is_promotional": is_promotional(item.get("name")),
+                }
+                for key, item in wanted.items()
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=["product_key"])
+    )
+    return dict(
+        db.query(Product.product_key, Product.id)
+        .filter(Product.product_key.in_(list(wanted)))
+        .all()
+    )
+
+
+# --- Mismas reglas en SQL (backfill) ---
+_sql_normalized_name = func.lower(
+    func.trim(func.regexp_replace(OrderItem.name, r"\s+", " ", "g"))
+)
+_sql_barcode = func.nullif(func.trim(OrderItem.barcode), "")
+_sql_product_key = func.coalesce(
+    literal("bc:") + _sql_barcode,
+    literal("nm:") + func.coalesce(_sql_normalized_name, ""),
+)
+_sql_is_promotional = or_(
+    *[OrderItem.name.op("~*")(pattern) for pattern in PROMOTIONAL_PATTERNS]
+)
+
+
+def backfill_products(db: Session) -> int:
+    """Crea los productos faltantes y enlaza order_items.product_id en SQL puro."""
+    # Un representante por clave (el item más antiguo)
+    first_items = (
+        select(
+            _sql_product_key.label("product_key"),
+            _sql_barcode.label("barcode"),
+            OrderItem.name.label("name"),
+            func.coalesce(_sql_is_promotional, False).label("is_promotional"),
+        )
+        .distinct(_sql_product_key)
+        .order_by(_sql_product_key, OrderItem.id)
+    ).subquery()
+
+    created = db.execute(
+        pg_insert(Product)
+        .from_select(
+            ["product_key", "barcode", "name", "is_promotional"],
+            select(
+                first_items.c.product_key,
+                first_items.c.barcode,
+                first_items.c.name,
+                first_items.c.is_promotional,
+            ),
+        )
+        .on_conflict_do_nothing(index_elements=["product_key"])
+    ).rowcount
+
+    linked = db.execute(
+        OrderItem.__table__.update()
+        .where(
+            OrderItem.product_id == None,
+            Product.product_key == _sql_product_key,
+        )
+        .values(product_id=Product.id)
+    ).rowcount
+
+    db.commit()
+    logger.info(
+        f"📦 Productos: {created} creados, {linked} items enlazados a la dimensión."
+    )
+    return linked
@@ -0,0 +1,76 @@
+"""
+Planificador de rangos para los widgets del dashboard.
+
+Mira los filtros pedidos y decide de dónde sale cada consulta:
+  - "rollup":       rollups diarios (se mantienen al ingerir, hoy incluido)
+  - "rollup+live":  buckets cerrados del rollup + el tramo sin cubrir desde 'orders'
+                    (tendencia intradía, ver trend_service)
+  - "live":         agregación directa de 'orders' del tramo aún sin rollup
+  - "raw":          filtros que el rollup no conoce (búsqueda libre): tabla 'orders'
+  - "cache":        respuesta servida desde Redis (ver cache_service)
+
+Cada decisión queda registrada en el contexto del request; el middleware de
+main.py la publica en la cabecera X-Query-Path junto con X-Query-Latency.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+ROLLUP = "rollup"
+ROLLUP_LIVE = "rollup+live"
+LIVE = "live"
+RAW = "raw"
+CACHE = "cache"
+
+
+@dataclass(frozen=True)
+class RangePlan:
+    path: str
+
+    @property
+    def uses_rollup(self) -> bool:
+        return self.path != RAW
+
+
+def plan_query(name: str, search_query: Optional[str] = None) -> RangePlan:
+    """Elige el camino de un widget y lo registra."""
+    if search_query and search_query.strip():
+        plan = RangePlan(RAW)
+    else:
+        plan = RangePlan(ROLLUP)
+    record_path(name, plan.path)
+    return plan
+
+
+# --- OBSERVABILIDAD: camino elegido por cada consulta del request ---
+_query_paths: ContextVar[Optional[Dict[str, str]]] = ContextVar(
+    "query_paths", default=None
+)
+
+
+def record_path(name: str, path: str):
+    paths = _query_paths.get()
+    if paths is not None:
+        paths[name] = path
+
+
+@contextmanager
+def track_paths():
+    """
+    Registra los caminos elegidos dentro del bloque.
+    Es un dict mutable para que los hilos del threadpool (que copian el
+    contexto) escriban sobre el mismo registro.
+    """
+    paths: Dict[str, str] = {}
+    token = _query_paths.set(paths)
+    try:
+        yield paths
+    finally:
+        _query_paths.reset(token)
+
+
+def format_paths(paths: Dict[str, str]) -> str:
+    """{'get_main_kpis': 'rollup'} -> 'get_main_kpis=rollup'"""
+    return ",".join(f"{name}={path}" for name, path in sorted(paths.items()))
@@ -0,0 +1,156 @@
+import logging
+from datetime import date
+from typing import Iterable, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, insert, and_
+
+from app.db.base import Order, OrderDailyFact
+from app.db.utils import advisory_xact_lock
+from app.services import order_metrics as m
+
+logger = logging.getLogger(__name__)
+
+# Columnas del rollup (mismo orden en la tabla y en la agregación cruda)
+FACT_COLUMNS = [
+    "local_date",
+    "store_id",
+    "order_type",
+    "status",
+    "orders_count",
+    "total_revenue",
+    "delivery_fees",
+    "coupons",
+    "service_fees",
+    "product_sales",
+    "delivery_time_sum",
+    "delivery_time_count",
+    "kpi_duration_sum",
+    "kpi_duration_count",
+    "first_order_at",
+]
+
+
+def _raw_facts_select(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    store_id: Optional[int] = None,
+    filter_store: bool = False,
+):
+    """Agrega 'orders' crudo con la misma forma que la tabla order_daily_facts."""
+    valid_duration = and_(
+        Order.current_status == "delivered",
+        ~m.is_pickup,
+        m.kpi_duration_minutes > 0,
+        m.kpi_duration_minutes < 600,
+    )
+
+    stmt = select(
+        Order.local_date.label("local_date"),
+        Order.store_id.label("store_id"),
+        Order.order_type.label("order_type"),
+        Order.current_status.label("status"),
+        func.count(Order.id).label("orders_count"),
+        func.coalesce(func.sum(Order.total_amount), 0.0).label("total_revenue"),
+        func.coalesce(func.sum(m.delivery_real), 0.0).label("delivery_fees"),
+        func.coalesce(func.sum(m.coupon_discount), 0.0).label("coupons"),
+        func.coalesce(func.sum(m.service_fee), 0.0).label("service_fees"),
+        func.coalesce(func.sum(m.product_price), 0.0).label("product_sales"),
+        func.coalesce(func.sum(Order.delivery_time_minutes), 0.0).label(
+            "delivery_time_sum"
+        ),
+        func.count(Order.delivery_time_minutes).label("delivery_time_count"),
+        func.coalesce(
+            func.sum(m.kpi_duration_minutes).filter(valid_duration), 0.0
+        ).label("kpi_duration_sum"),
+        func.count(Order.id).filter(valid_duration).label("kpi_duration_count"),
+        func.min(Order.created_at).label("first_order_at"),
+    )
+
+    if start_date:
+        stmt = stmt.where(Order.local_date >= start_date)
+    if end_date:
+        stmt = stmt.where(Order.local_date <= end_date)
+    if filter_store:
+        stmt = stmt.where(
+            Order.store_id == store_id
+            if store_id is not None
+            else Order.store_id.is_(None)
+        )
+
+    return stmt.group_by(
+        Order.local_date, Order.store_id, Order.order_type, Order.current_status
+    )
+
+
+def daily_facts_source(
+    start_date: Optional[date] = None, end_date: Optional[date] = None
+):
+    """
+    Subquery de order_daily_facts para el rango pedido, hoy incluido: el
+    ingestor refresca la porción del día en la misma transacción del pedido
+    (refresh_order_facts), así que el rollup nunca va detrás de 'orders'.
+    """
+    stmt = select(*[getattr(OrderDailyFact, c) for c in FACT_COLUMNS])
+    if start_date:
+        stmt = stmt.where(OrderDailyFact.local_date >= start_date)
+    if end_date:
+        stmt = stmt.where(OrderDailyFact.local_date <= end_date)
+    return stmt.subquery("facts")
+
+
+def refresh_daily_facts(db: Session, day: date, store_id: Optional[int]):
+    """
+    Recalcula la porción (día, tienda) del rollup. No hace commit:
+    se ejecuta dentro de la transacción de quien lo llame.
+    """
+    advisory_xact_lock(db, f"order_daily_facts:{day}:{store_id}")
+    slice_filter = [
+        OrderDailyFact.local_date == day,
+        (
+            OrderDailyFact.store_id == store_id
+            if store_id is not None
+            else OrderDailyFact.store_id.is_(None)
+        ),
+    ]
+    db.query(OrderDailyFact).filter(*slice_filter).delete(synchronize_session=False)
+    db.execute(
+        insert(OrderDailyFact).from_select(
+            FACT_COLUMNS,
+            _raw_facts_select(day, day, store_id=store_id, filter_store=True),
+        )
+    )
+
+
+def refresh_order_facts(
+    db: Session, day: Optional[date], store_ids: Iterable[Optional[int]]
+):
+    """Refresca las porciones del rollup que toca un pedido (tienda vieja y nueva)."""
+    if not day:
+        return
+    # Orden fijo de candados: dos ingestas que tocan las mismas tiendas no se
+    # bloquean en cruz
+    for store_id in sorted(set(store_ids), key=lambda s: (s is not None, s or 0)):
+        refresh_daily_facts(db, day, store_id)
+
+
+def rebuild_daily_facts(
+    db: Session, start_date: Optional[date] = None, end_date: Optional[date] = None
+) -> int:
+    """Reconstruye el rollup completo (o un rango) desde 'orders'."""
+    delete_q = db.query(OrderDailyFact)
+    if start_date:
+        delete_q = delete_q.filter(OrderDailyFact.local_date >= start_date)
+    if end_date:
+        delete_q = delete_q.filter(OrderDailyFact.local_date <= end_date)
+    deleted = delete_q.delete(synchronize_session=False)
+
+    result = db.execute(
+        insert(OrderDailyFact).from_select(
+            FACT_COLUMNS, _raw_facts_select(start_date, end_date)
+        )
+    )
+    db.commit()
+    logger.info(
+        f"📊 Rollup diario reconstruido: {deleted} filas borradas, {result.rowcount} insertadas."
+    )
+    return result.rowcount
@@ -0,0 +1,79 @@
+"""
+Búsqueda libre del dashboard (ID de pedido o nombre de cliente).
+
+Devuelve subconsultas de IDs de pedido para que los análisis hagan
+semi-join contra ellas. Cada rama usa su propio índice:
+  - ID numérico: prefijo sobre ix_orders_external_id_prefix (varchar_pattern_ops)
+  - Texto: ILIKE '%term%' sobre los índices GIN pg_trgm (ver create_tables.py)
+"""
+
+from typing import Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import select, union
+
+from app.db.base import Order, Customer, OrderItem
+
+
+def _like_escape(term: str) -> str:
+    # '%' y '_' escritos por el usuario se buscan literalmente
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def contains_pattern(term: str) -> str:
+    return f"%{_like_escape(term.strip())}%"
+
+
+def matching_order_ids(search_query: Optional[str]):
+    """
+    SELECT de los IDs de pedido que coinciden con la búsqueda (None si no hay).
+    Uso: query.filter(Order.id.in_(matching_order_ids(term)))
+    """
+    if not search_query or not search_query.strip():
+        return None
+    term = search_query.strip()
+
+    # Fast-path: los IDs son numéricos y el operador teclea el inicio
+    if term.isdigit():
+        return select(Order.id).where(
+            Order.external_id.like(f"{term}%", escape="\\")
+        )
+
+    pattern = contains_pattern(term)
+    # UNION (no OR): cada rama puede usar su índice trigram
+    by_id = select(Order.id).where(Order.external_id.ilike(pattern, escape="\\"))
+    by_customer = (
+        select(Order.id)
+        .join(Customer, Order.customer_id == Customer.id)
+        .where(Customer.name.ilike(pattern, escape="\\"))
+    )
+    return union(by_id, by_customer)
+
+
+def matching_item_names(search_query: str):
+    """Condición sobre OrderItem.name (top de productos busca también por producto)."""
+    return OrderItem.name.ilike(contains_pattern(search_query), escape="\\")
+
+
+def search_orders(db: Session, search_query: str, limit: int = 50):
+    """Pedidos más recientes que coinciden con la búsqueda."""
+    ids = matching_order_ids(search_query)
+    if ids is None:
+        return []
+
+    rows = (
+        db.query(Order.id, Order.external_id, Order.created_at, Customer.name)
+        .outerjoin(Customer, Order.customer_id == Customer.id)
+        .filter(Order.id.in_(ids))
+        .order_by(Order.created_at.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {
+            "id": r.id,
+            "external_id": r.external_id,
+            "customer_name": r.name or "Anónimo",
+            "created_at": r.created_at,
+        }
+        for r in rows
+    ]
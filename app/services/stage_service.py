@@ -0,0 +1,114 @@
+import logging
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, insert, extract, literal
+
+from app.db.base import Order, OrderStatusLog, OrderStageDuration
+from app.services.order_metrics import VET_OFFSET
+
+logger = logging.getLogger(__name__)
+
+# Etapa sintética: vida total de un pedido cancelado (creación -> cancelación)
+CANCELED_LIFE_STAGE = "canceled_life_time"
+
+# Limites Anti-Zombie (duraciones fuera de rango no entran a los promedios)
+MAX_STEP_SEC = 21600
+MAX_CANCEL_LIFE_SEC = 28800
+
+
+def transition_rows(
+    order_id: int,
+    created_at: Optional[datetime],
+    prev_status: Optional[str],
+    prev_timestamp: Optional[datetime],
+    new_status: str,
+    timestamp: datetime,
+) -> List[dict]:
+    """Filas de order_stage_durations que genera una transición de estatus."""
+    rows = []
+    if prev_status is not None:
+        rows.append(
+            {
+                "order_id": order_id,
+                "stage": prev_status,
+                "seconds": (timestamp - prev_timestamp).total_seconds(),
+                "started_at": prev_timestamp,
+            }
+        )
+
+    if new_status == "canceled" and created_at:
+        # created_at viene del Scraper (VET); el log es UTC
+        rows.append(
+            {
+                "order_id": order_id,
+                "stage": CANCELED_LIFE_STAGE,
+                "seconds": (timestamp - (created_at + VET_OFFSET)).total_seconds(),
+                "started_at": created_at,
+            }
+        )
+    return rows
+
+
+def backfill_stage_durations(db: Session) -> int:
+    """
+    Reconstruye order_stage_durations desde order_status_logs en SQL puro:
+    LAG() para cada par de logs consecutivos + la vida de los cancelados.
+    """
+    deleted = db.query(OrderStageDuration).delete(synchronize_session=False)
+
+    window = {
+        "partition_by": OrderStatusLog.order_id,
+        "order_by": (OrderStatusLog.timestamp, OrderStatusLog.id),
+    }
+    pairs = select(
+        OrderStatusLog.order_id,
+        OrderStatusLog.timestamp,
+        func.lag(OrderStatusLog.status).over(**window).label("prev_status"),
+        func.lag(OrderStatusLog.timestamp).over(**window).label("prev_timestamp"),
+    ).subquery("pairs")
+
+    stages = db.execute(
+        insert(OrderStageDuration).from_select(
+            ["order_id", "stage", "seconds", "started_at"],
+            select(
+                pairs.c.order_id,
+                pairs.c.prev_status,
+                extract("epoch", pairs.c.timestamp - pairs.c.prev_timestamp),
+                pairs.c.prev_timestamp,
+            ).where(pairs.c.prev_status != None),
+        )
+    ).rowcount
+
+    # Último log 'canceled' de cada pedido cancelado
+    last_cancel = (
+        select(
+            OrderStatusLog.order_id,
+            func.max(OrderStatusLog.timestamp).label("canceled_at"),
+        )
+        .where(OrderStatusLog.status == "canceled")
+        .group_by(OrderStatusLog.order_id)
+        .subquery("last_cancel")
+    )
+    lifetimes = db.execute(
+        insert(OrderStageDuration).from_select(
+            ["order_id", "stage", "seconds", "started_at"],
+            select(
+                Order.id,
+                literal(CANCELED_LIFE_STAGE),
+                extract(
+                    "epoch", last_cancel.c.canceled_at - (Order.created_at + VET_OFFSET)
+                ),
+                Order.created_at,
+            )
+            .join(last_cancel, last_cancel.c.order_id == Order.id)
+            .where(Order.current_status == "canceled", Order.created_at != None),
+        )
+    ).rowcount
+
+    db.commit()
+    logger.info(
+        f"⏱️ Duraciones por etapa reconstruidas: {deleted} borradas, "
+        f"{stages} etapas + {lifetimes} cancelados insertados."
+    )
+    return stages + lifetimes
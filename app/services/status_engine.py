@@ -0,0 +1,45 @@
+"""
+Motor de transiciones de estatus de un pedido.
+
+El radar vuelve a leer los pedidos cada pocos segundos y el Legacy a veces
+"rebota" (processing -> pending -> processing) o muestra estatus viejos de un
+pedido ya cerrado. Aquí vive el orden canónico: solo se aceptan saltos hacia
+adelante (se pueden saltar etapas) y la cancelación desde cualquier estatus no
+final. Así order_status_logs queda limpio al escribir, con un índice único
+(order_id, status) como última barrera contra duplicados.
+"""
+
+from typing import Optional
+
+# Orden canónico del flujo feliz (mismo que analysis_service.BOTTLENECK_STEPS)
+STATUS_ORDER = (
+    "created",
+    "pending",
+    "processing",  # Facturación
+    "confirmed",  # Búsqueda de motorizado
+    "driver_assigned",
+    "on_the_way",
+    "delivered",
+)
+CANCELED = "canceled"
+FINAL_STATUSES = ("delivered", CANCELED)
+
+_RANK = {status: i for i, status in enumerate(STATUS_ORDER)}
+
+
+def is_final(status: Optional[str]) -> bool:
+    return status in FINAL_STATUSES
+
+
+def can_transition(previous: Optional[str], new: str) -> bool:
+    """True si pasar de 'previous' a 'new' es un avance legal."""
+    if previous is None:
+        return True
+    if previous == new or is_final(previous):
+        return False
+    if new == CANCELED:
+        return True
+    if previous not in _RANK or new not in _RANK:
+        # Estatus desconocido (datos viejos): no hay orden con qué comparar
+        return True
+    return _RANK[new] > _RANK[previous]
@@ -0,0 +1,149 @@
+"""
+Tendencias intradía (buckets de 15 y 60 minutos, hora VET).
+
+Los buckets cerrados se persisten una sola vez en order_trend_buckets y no se
+recalculan; trend_watermarks marca hasta dónde llegan. Lo posterior a la marca
+(el bucket abierto y los que aún se están asentando) se agrega en vivo, así que
+el costo de cada refresco no depende del largo del rango.
+"""
+
+import logging
+from datetime import date, datetime, timedelta
+from typing import Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, insert, and_, cast, extract, literal, Integer
+
+from app.db.base import Order, OrderTrendBucket, TrendWatermark
+from app.services import order_metrics as m
+from app.services.order_metrics import VET_OFFSET
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = (15, 60)
+
+# Un bucket recién terminado todavía recibe pedidos (el dron ingiere con
+# retraso) y cambios de estatus; solo se congela pasado este margen.
+SETTLE_DELAY = timedelta(hours=2)
+
+BUCKET_COLUMNS = [
+    "granularity",
+    "bucket_start",
+    "store_id",
+    "orders_count",
+    "total_revenue",
+    "delivery_time_sum",
+    "delivery_time_count",
+]
+
+# created_at viene en VET: es la hora que muestra el Legacy (ver order_metrics)
+_local_ts = Order.created_at
+
+
+def _bucket_expr(granularity: int):
+    # Entero // entero: división entera en Postgres (el bucket queda alineado)
+    minute = cast(extract("minute", _local_ts), Integer)
+    return func.date_trunc("hour", _local_ts) + func.make_interval(
+        0, 0, 0, 0, 0, minute // granularity * granularity
+    )
+
+
+def floor_bucket(moment: datetime, granularity: int) -> datetime:
+    """Inicio del bucket que contiene 'moment' (hora VET)."""
+    return moment.replace(
+        minute=moment.minute // granularity * granularity, second=0, microsecond=0
+    )
+
+
+def local_now() -> datetime:
+    """Hora VET actual (misma base que created_at)."""
+    return datetime.utcnow() - VET_OFFSET
+
+
+def raw_buckets_select(granularity: int, since: datetime, until: datetime):
+    """Agrega 'orders' en [since, until) con la forma de order_trend_buckets."""
+    bucket = _bucket_expr(granularity)
+    # Mismo criterio que los KPIs: un order_type NULL cuenta como delivery
+    timed = and_(
+        Order.current_status == "delivered",
+        ~m.is_pickup,
+        Order.delivery_time_minutes != None,
+    )
+    return (
+        select(
+            literal(granularity, Integer).label("granularity"),
+            bucket.label("bucket_start"),
+            Order.store_id.label("store_id"),
+            func.count(Order.id).label("orders_count"),
+            func.coalesce(func.sum(Order.total_amount), 0.0).label("total_revenue"),
+            func.coalesce(
+                func.sum(Order.delivery_time_minutes).filter(timed), 0.0
+            ).label("delivery_time_sum"),
+            func.count(Order.id).filter(timed).label("delivery_time_count"),
+        )
+        .where(
+            # local_date acota por índice (puede ir hasta un día detrás del día
+            # de created_at, ver order_metrics.local_date_of); created_at
+            # recorta las horas exactas
+            Order.local_date >= since.date() - timedelta(days=1),
+            Order.local_date <= until.date(),
+            _local_ts >= since,
+            _local_ts < until,
+        )
+        .group_by(bucket, Order.store_id)
+    )
+
+
+def stored_buckets_select(granularity: int, since: datetime, until: datetime):
+    return select(*[getattr(OrderTrendBucket, c) for c in BUCKET_COLUMNS]).where(
+        OrderTrendBucket.granularity == granularity,
+        OrderTrendBucket.bucket_start >= since,
+        OrderTrendBucket.bucket_start < until,
+    )
+
+
+def get_watermark(db: Session, granularity: int) -> Optional[datetime]:
+    return (
+        db.query(TrendWatermark.closed_until)
+        .filter(TrendWatermark.granularity == granularity)
+        .scalar()
+    )
+
+
+def close_buckets(db: Session, granularity: int) -> int:
+    """
+    Persiste los buckets ya asentados que aún no estén en la tabla y avanza
+    la marca. Cada bucket se escribe una sola vez.
+    """
+    cutoff = floor_bucket(local_now() - SETTLE_DELAY, granularity)
+
+    mark = (
+        db.query(TrendWatermark)
+        .filter(TrendWatermark.granularity == granularity)
+        .with_for_update()
+        .first()
+    )
+    if mark is None:
+        first_day: Optional[date] = db.query(func.min(Order.local_date)).scalar()
+        since = datetime.combine(first_day or cutoff.date(), datetime.min.time())
+        mark = TrendWatermark(granularity=granularity, closed_until=since)
+        db.add(mark)
+    if mark.closed_until >= cutoff:
+        db.commit()
+        return 0
+
+    result = db.execute(
+        insert(OrderTrendBucket).from_select(
+            BUCKET_COLUMNS, raw_buckets_select(granularity, mark.closed_until, cutoff)
+        )
+    )
+    mark.closed_until = cutoff
+    db.commit()
+    return result.rowcount
+
+
+def close_all_buckets(db: Session) -> int:
+    inserted = 0
+    for granularity in GRANULARITIES:
+        inserted += close_buckets(db, granularity)
+    logger.info(f"🕒 Buckets de tendencia cerrados: {inserted} filas nuevas.")
+    return inserted
@@ -41,6 +41,10 @@ document.addEventListener('DOMContentLoaded', function () {
 
     let datePicker, driverLeaderboardChart, bottleneckChart, orderTypeChart, trendsChart, cancellationChartInstance;
     let mapInstance, heatLayer, ordersInterval;
+    // Mismo valor que analysis_service.HEATMAP_DEFAULT_ZOOM (el snapshot ya viene agregado así)
+    const HEATMAP_DEFAULT_ZOOM = 12;
+    const HEATMAP_ZOOM_DEBOUNCE_MS = 300; // Un solo fetch por gesto de zoom
+    let heatmapZoomTimer = null, heatmapRequestSeq = 0;
     let bottleneckPickupChart = null;
 
     const statusTranslations = {
@@ -90,6 +94,19 @@ document.addEventListener('DOMContentLoaded', function () {
 
     // Variable para guardar instancias de gráficas y no duplicarlas
     let timelineCharts = {};
+    // Cronologías de la página actual (una sola llamada a /timelines)
+    let timelineCache = {};
+
+    async function prefetchTimelines(orderIds) {
+        timelineCache = {};
+        if (!orderIds.length) return;
+        try {
+            const res = await authFetch(`/api/analysis/timelines?ids=${orderIds.join(',')}`);
+            if (res && res.ok) timelineCache = await res.json();
+        } catch (e) {
+            console.error("Error timelines:", e);
+        }
+    }
 
     window.toggleOrderDetails = async function (rowId) {
         const detailRow = document.getElementById(`detail-${rowId}`);
@@ -117,9 +134,12 @@ document.addEventListener('DOMContentLoaded', function () {
                     if (loader) loader.classList.remove('d-none');
 
                     try {
-                        const res = await authFetch(`/api/analysis/order/${rowId}/timeline`);
-                        if (!res) return; // Validación extra
-                        const data = await res.json();
+                        let data = timelineCache[rowId];
+                        if (!data) {
+                            const res = await authFetch(`/api/analysis/order/${rowId}/timeline`);
+                            if (!res) return; // Validación extra
+                            data = await res.json();
+                        }
 
                         if (loader) loader.classList.add('d-none');
 
@@ -266,10 +286,17 @@ document.addEventListener('DOMContentLoaded', function () {
         return url;
     }
 
-    async function updateKpis() {
-        const res = await authFetch(buildUrl('/api/kpi/main'));
-        if (!res) return;
-        const data = await res.json();
+    // Si el snapshot ya trajo el widget lo usamos; si no (ej: abrir el mapa), lo pedimos suelto
+    async function widgetData(endpoint, preloaded) {
+        if (preloaded !== undefined) return preloaded;
+        const res = await authFetch(buildUrl(endpoint));
+        if (!res) return null;
+        return res.json();
+    }
+
+    async function updateKpis(preloaded) {
+        const data = await widgetData('/api/kpi/main', preloaded);
+        if (!data) return;
         const setVal = (id, val) => { const el = document.getElementById(id); if (el) el.textContent = val; };
 
         setVal('kpi-total-revenue', `$${(data.total_revenue || 0).toFixed(2)}`);
@@ -288,10 +315,9 @@ document.addEventListener('DOMContentLoaded', function () {
         updateOrderTypeChart(data.total_deliveries, data.total_pickups);
     }
 
-    async function updateRecentOrdersTable() {
-        const res = await authFetch(buildUrl('/api/data/orders'));
-        if (!res) return;
-        const data = await res.json();
+    async function updateRecentOrdersTable(preloaded) {
+        const data = await widgetData('/api/data/orders', preloaded);
+        if (!data) return;
 
         // --- CONEXIÓN VIGILANTE ---
         checkOperationalAnomalies(data);
@@ -674,6 +700,7 @@ document.addEventListener('DOMContentLoaded', function () {
         timelineCharts = {};
 
         tableBody.innerHTML = html;
+        prefetchTimelines(data.map(o => o.id));
         // Sobrescribimos el KPI falso del backend con nuestro cálculo real
         //if (calcTotalCount > 0) {
         //    const realAvg = (calcTotalMins / calcTotalCount).toFixed(1);
@@ -771,16 +798,15 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     }
 
-    async function updateBottleneckChart() {
+    async function updateBottleneckChart(preloaded) {
         try {
             const ctxDelivery = document.getElementById('bottleneckChart')?.getContext('2d');
             const ctxPickup = document.getElementById('bottleneckPickupChart')?.getContext('2d');
 
             if (!ctxDelivery && !ctxPickup) return;
 
-            const res = await authFetch(buildUrl('/api/analysis/bottlenecks'));
-            if (!res) return;
-            const data = await res.json();
+            const data = await widgetData('/api/analysis/bottlenecks', preloaded);
+            if (!data) return;
 
             // 1. CONFIGURACIÓN VISUAL
             const localStatusOrder = [
@@ -899,13 +925,12 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     }
 
-    async function updateCancellationChart() {
+    async function updateCancellationChart(preloaded) {
         const ctx = document.getElementById('cancellationChart')?.getContext('2d');
         if (!ctx) return;
 
-        const res = await authFetch(buildUrl('/api/analysis/cancellations'));
-        if (!res) return;
-        const data = await res.json();
+        const data = await widgetData('/api/analysis/cancellations', preloaded);
+        if (!data) return;
 
         let labels = data.length ? data.map(d => d.reason || 'Sin motivo') : ['Sin datos'];
         let values = data.length ? data.map(d => d.count) : [0];
@@ -934,13 +959,12 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     }
 
-    async function loadTopCustomers() {
+    async function loadTopCustomers(preloaded) {
         const tbody = document.querySelector('#topCustomersTable tbody');
         if (!tbody) return; // Si no hay tabla, salimos
 
-        const res = await authFetch(buildUrl('/api/data/top-customers'));
-        if (!res) return;
-        const data = await res.json();
+        const data = await widgetData('/api/data/top-customers', preloaded);
+        if (!data) return;
 
         tbody.innerHTML = '';
         data.forEach(c => {
@@ -949,12 +973,11 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     }
 
-    async function updateTopProducts() {
+    async function updateTopProducts(preloaded) {
         const tbody = document.getElementById('top-products-body');
         if (!tbody) return;
-        const res = await authFetch(buildUrl('/api/data/top-products'));
-        if (!res) return;
-        const data = await res.json();
+        const data = await widgetData('/api/data/top-products', preloaded);
+        if (!data) return;
         tbody.innerHTML = '';
         data.forEach((p, i) => {
             let icon = i === 0 ? '🥇' : (i === 1 ? '🥈' : (i === 2 ? '🥉' : '📦'));
@@ -963,13 +986,12 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
     // --- 4. TENDENCIAS (Gráfico Mixto: $ + Pedidos + Tiempo) ---
-    async function updateTrendsChart() {
+    async function updateTrendsChart(preloaded) {
         const ctx = document.getElementById('trendsChart')?.getContext('2d');
         if (!ctx) return;
 
-        const res = await authFetch(buildUrl('/api/data/trends'));
-        if (!res) return;
-        const data = await res.json();
+        const data = await widgetData('/api/data/trends', preloaded);
+        if (!data) return;
 
         if (trendsChart) trendsChart.destroy();
 
@@ -1032,13 +1054,12 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
     // --- 5. TOP REPARTIDORES (Leaderboard) ---
-    async function updateDriverLeaderboard() {
+    async function updateDriverLeaderboard(preloaded) {
         const ctx = document.getElementById('driverLeaderboardChart')?.getContext('2d');
         if (!ctx) return;
 
-        const res = await authFetch(buildUrl('/api/data/driver-leaderboard'));
-        if (!res) return;
-        const data = await res.json();
+        const data = await widgetData('/api/data/driver-leaderboard', preloaded);
+        if (!data) return;
 
         if (driverLeaderboardChart) driverLeaderboardChart.destroy();
 
@@ -1077,13 +1098,12 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
     // --- 6. TOP TIENDAS (Lista HTML) ---
-    async function updateTopStoresList() {
+    async function updateTopStoresList(preloaded) {
         const list = document.getElementById('top-stores-list');
         if (!list) return;
 
-        const res = await authFetch(buildUrl('/api/data/top-stores'));
-        if (!res) return;
-        const data = await res.json();
+        const data = await widgetData('/api/data/top-stores', preloaded);
+        if (!data) return;
 
         list.innerHTML = '';
         data.slice(0, 10).forEach(s => {
@@ -1105,14 +1125,15 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
     // --- 7. MAPA DE CALOR (Leaflet - BLINDADO) ---
-    async function updateHeatmap() {
+    async function updateHeatmap(preloaded) {
         const mapDiv = document.getElementById('heatmapContainer');
         if (!mapDiv) return;
 
-        // 1. Obtener Datos (Siempre, para tenerlos listos)
-        const res = await authFetch(buildUrl('/api/data/heatmap'));
-        if (!res) return;
-        const data = await res.json();
+        // 1. Obtener Datos (Siempre, para tenerlos listos). El servidor agrega por celdas según el zoom
+        const zoom = mapInstance ? mapInstance.getZoom() : HEATMAP_DEFAULT_ZOOM;
+        const seq = ++heatmapRequestSeq;
+        const data = await widgetData(`/api/data/heatmap?zoom=${zoom}`, preloaded);
+        if (!data || seq !== heatmapRequestSeq) return;
 
         // 2. CHECK DE SEGURIDAD (Si está oculto/colapsado)
         if (mapDiv.clientHeight === 0 || mapDiv.clientWidth === 0) {
@@ -1134,39 +1155,20 @@ document.addEventListener('DOMContentLoaded', function () {
                 maxZoom: 19,
                 attribution: '&copy; OpenStreetMap'
             }).addTo(mapInstance);
+            mapInstance.on('zoomend', onHeatmapZoom);
         }
 
         // 4. Forzar ajuste de tamaño (Vital cuando se abre el acordeón)
         mapInstance.invalidateSize();
 
-        // 5. Limpieza de capa anterior (Si existía)
-        if (heatLayer) {
-            mapInstance.removeLayer(heatLayer);
-            heatLayer = null;
+        // 5. Pintar Nueva Capa (reemplaza la anterior)
+        if (drawHeatLayer(data) && data.length > 1) {
+            // Auto-ajustar zoom para ver los puntos (el zoomend vuelve a pedir las celdas)
+            const bounds = data.map(p => [p[0], p[1]]);
+            mapInstance.fitBounds(bounds, { padding: [20, 20] });
         }
 
-        // 6. Pintar Nueva Capa
-        if (data && data.length > 0) {
-            try {
-                heatLayer = L.heatLayer(data, {
-                    radius: 20,
-                    blur: 15,
-                    maxZoom: 14,
-                    minOpacity: 0.4,
-                    gradient: { 0.4: 'cyan', 0.65: 'lime', 1: 'red' }
-                }).addTo(mapInstance);
-
-                // Auto-ajustar zoom para ver los puntos
-                if (data.length > 1) {
-                    const bounds = data.map(p => [p[0], p[1]]);
-                    mapInstance.fitBounds(bounds, { padding: [20, 20] });
-                }
-            } catch (e) {
-                console.error("Error pintando heatmap:", e);
-            }
-        }
-
-        // 7. Cargar Tiendas (Puntos Azules)
+        // 6. Cargar Tiendas (Puntos Azules)
         try {
             const resStores = await authFetch('/api/data/stores-locations');
             if (resStores) {
@@ -1181,6 +1183,40 @@ document.addEventListener('DOMContentLoaded', function () {
         } catch (e) { }
     }
 
+    function drawHeatLayer(data) {
+        if (heatLayer) {
+            mapInstance.removeLayer(heatLayer);
+            heatLayer = null;
+        }
+        if (!data || data.length === 0) return false;
+        try {
+            heatLayer = L.heatLayer(data, {
+                radius: 20,
+                blur: 15,
+                maxZoom: 14,
+                minOpacity: 0.4,
+                gradient: { 0.4: 'cyan', 0.65: 'lime', 1: 'red' }
+            }).addTo(mapInstance);
+            return true;
+        } catch (e) {
+            console.error("Error pintando heatmap:", e);
+            return false;
+        }
+    }
+
+    // Al cambiar el zoom se piden las celdas del nuevo nivel (solo la capa de calor)
+    function onHeatmapZoom() {
+        clearTimeout(heatmapZoomTimer);
+        heatmapZoomTimer = setTimeout(async () => {
+            const mapDiv = document.getElementById('heatmapContainer');
+            if (!mapInstance || !mapDiv || mapDiv.clientHeight === 0) return;
+            const seq = ++heatmapRequestSeq;
+            const data = await widgetData(`/api/data/heatmap?zoom=${mapInstance.getZoom()}`);
+            if (!data || seq !== heatmapRequestSeq) return;
+            drawHeatLayer(data);
+        }, HEATMAP_ZOOM_DEBOUNCE_MS);
+    }
+
     // --- 8. FILTRO DE TIENDAS (Dropdown) ---
     async function loadStoreFilterOptions() {
         const sel = document.getElementById('store-filter');
@@ -1232,22 +1268,23 @@ document.addEventListener('DOMContentLoaded', function () {
         const timeString = now.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
         document.getElementById('last-updated').textContent = timeString;
 
-        // Usamos await para garantizar que los datos críticos carguen primero
-        await updateKpis();
-        await updateRecentOrdersTable();
-
-        // Ejecutamos en paralelo los secundarios para velocidad
-        updateBottleneckChart();
-        updateCancellationChart();
-
-        // Llamada a las funciones restantes (asegúrate de que estas existan en tu archivo real)
-        // Como pusiste "dummy code" en el prompt, asumo que las tienes definidas abajo.
-        if (typeof loadTopCustomers === 'function') loadTopCustomers();
-        if (typeof updateTopProducts === 'function') updateTopProducts();
-        if (typeof updateDriverLeaderboard === 'function') updateDriverLeaderboard();
-        if (typeof updateTopStoresList === 'function') updateTopStoresList();
-        if (typeof updateHeatmap === 'function') updateHeatmap();
-        if (typeof updateTrendsChart === 'function') updateTrendsChart();
+        // Una sola llamada: todos los widgets salen del mismo snapshot (misma foto de datos)
+        const res = await authFetch(buildUrl('/api/dashboard/snapshot'));
+        if (!res || !res.ok) return;
+        const snap = await res.json();
+
+        // Los datos críticos primero
+        await updateKpis(snap.kpis);
+        await updateRecentOrdersTable(snap.orders);
+
+        updateBottleneckChart(snap.bottlenecks);
+        updateCancellationChart(snap.cancellations);
+        loadTopCustomers(snap.top_customers);
+        updateTopProducts(snap.top_products);
+        updateDriverLeaderboard(snap.driver_leaderboard);
+        updateTopStoresList(snap.top_stores);
+        updateHeatmap(snap.heatmap);
+        updateTrendsChart(snap.trends);
     }
 
     datePicker = flatpickr("#date-range-picker", { mode: "range", dateFormat: "Y-m-d", defaultDate: [new Date(), new Date()], onClose: fetchAllData });
@@ -0,0 +1,24 @@
+import logging
+from app.db.session import SessionLocal
+from app.services import product_service
+
+# Configuración
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def run_backfill():
+    db = SessionLocal()
+    logger.info("🚀 POBLANDO DIMENSIÓN DE PRODUCTOS (products)")
+    try:
+        linked = product_service.backfill_products(db)
+        logger.info(f"✅ Backfill completado: {linked} items enlazados.")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error en el backfill de productos: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_backfill()
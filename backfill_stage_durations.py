@@ -0,0 +1,24 @@
+import logging
+from app.db.session import SessionLocal
+from app.services import stage_service
+
+# Configuración
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def run_backfill():
+    db = SessionLocal()
+    logger.info("🚀 RECONSTRUYENDO DURACIONES POR ETAPA (order_stage_durations)")
+    try:
+        rows = stage_service.backfill_stage_durations(db)
+        logger.info(f"✅ Backfill completado: {rows} filas.")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error en el backfill de etapas: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_backfill()
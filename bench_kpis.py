@@ -0,0 +1,65 @@
+import logging
+import time
+from datetime import date, timedelta
+from app.db.session import SessionLocal
+from app.services import kpi_service
+
+# Configuración básica
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RANGES_DAYS = [1, 7, 30, 90]
+REPEATS = 3
+
+
+def _timed(fn):
+    best = None
+    result = None
+    for _ in range(REPEATS):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def benchmark_kpis():
+    db = SessionLocal()
+    print("\n⏱️ BENCHMARK KPIs: Python vs SQL")
+    print("================================")
+    print(f"{'RANGO':<10} | {'PYTHON (s)':<12} | {'SQL (s)':<10} | {'SPEEDUP':<8} | DIFERENCIAS")
+    print("-" * 80)
+
+    today = date.today()
+    try:
+        for days in RANGES_DAYS:
+            start = today - timedelta(days=days - 1)
+
+            py_data, py_time = _timed(
+                lambda: kpi_service.get_main_kpis(
+                    db, start_date=start, end_date=today, mode="python"
+                )
+            )
+            sql_data, sql_time = _timed(
+                lambda: kpi_service.get_main_kpis(
+                    db, start_date=start, end_date=today, mode="sql"
+                )
+            )
+
+            # Tolerancia: los floats se suman en distinto orden
+            diffs = [
+                f"{k}: {py_data[k]} != {sql_data.get(k)}"
+                for k in py_data
+                if abs(float(py_data[k] or 0) - float(sql_data.get(k) or 0)) > 0.05
+            ]
+            speedup = py_time / sql_time if sql_time > 0 else 0
+            print(
+                f"{days:>3} días   | {py_time:<12.3f} | {sql_time:<10.3f} | x{speedup:<7.1f} | "
+                f"{'OK' if not diffs else '; '.join(diffs)}"
+            )
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    benchmark_kpis()
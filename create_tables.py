@@ -19,6 +19,181 @@ def create_database_tables():
                     "ALTER TABLE stores ADD COLUMN IF NOT EXISTS company_name VARCHAR;"
                 )
             )
+            # Día VET precalculado (filtros de fecha con índice)
+            conn.execute(
+                text("ALTER TABLE orders ADD COLUMN IF NOT EXISTS local_date DATE;")
+            )
+            conn.execute(
+                text(
+                    "UPDATE orders SET local_date = "
+                    "date(timezone('America/Caracas', timezone('UTC', created_at))) "
+                    "WHERE local_date IS NULL AND created_at IS NOT NULL;"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_local_date "
+                    "ON orders (local_date);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_store_local_date "
+                    "ON orders (store_id, local_date);"
+                )
+            )
+            conn.execute(text("DROP INDEX IF EXISTS ix_orders_store_created;"))
+
+            # Buscador (pg_trgm): ILIKE '%texto%' por índice en lugar de escaneo
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm;"))
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_external_id_trgm "
+                    "ON orders USING gin (external_id gin_trgm_ops);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_external_id_prefix "
+                    "ON orders (external_id varchar_pattern_ops);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_customers_name_trgm "
+                    "ON customers USING gin (name gin_trgm_ops);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_order_items_name_trgm "
+                    "ON order_items USING gin (name gin_trgm_ops);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_customer_id "
+                    "ON orders (customer_id);"
+                )
+            )
+            # Dimensión de productos (la tabla 'products' la crea create_all)
+            conn.execute(
+                text(
+                    "ALTER TABLE order_items ADD COLUMN IF NOT EXISTS product_id "
+                    "INTEGER REFERENCES products(id);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_order_items_product_id "
+                    "ON order_items (product_id);"
+                )
+            )
+            # Clasificador de cancelaciones: código entero + texto original
+            conn.execute(
+                text(
+                    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS cancellation_code "
+                    "SMALLINT;"
+                )
+            )
+            conn.execute(
+                text(
+                    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS "
+                    "cancellation_reason_raw VARCHAR;"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_cancellation_code "
+                    "ON orders (cancellation_code);"
+                )
+            )
+            # Código de método de pago (mismas reglas que order_metrics.payment_code_of)
+            conn.execute(
+                text("ALTER TABLE orders ADD COLUMN IF NOT EXISTS payment_code SMALLINT;")
+            )
+            conn.execute(
+                text(
+                    "UPDATE orders SET payment_code = CASE "
+                    "WHEN lower(payment_method) LIKE '%efectivo%' "
+                    "OR lower(payment_method) LIKE '%cash%' THEN 1 "
+                    "WHEN lower(payment_method) LIKE '%punto%' THEN 2 "
+                    "ELSE 3 END "
+                    "WHERE payment_code IS NULL AND payment_method <> '';"
+                )
+            )
+            # Primer pedido por cliente: MIN() indexado para el top histórico
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_customer_stats_first_order_at "
+                    "ON customer_stats (first_order_at);"
+                )
+            )
+            # Logs de estatus: se purgan los rebotes históricos (estatus repetidos
+            # y todo lo posterior al primer estatus final) antes del índice único
+            conn.execute(
+                text(
+                    "DELETE FROM order_status_logs l USING ("
+                    "SELECT id, "
+                    "ROW_NUMBER() OVER (PARTITION BY order_id, status "
+                    "ORDER BY timestamp, id) AS n, "
+                    "MIN(timestamp) FILTER (WHERE status IN ('delivered', 'canceled')) "
+                    "OVER (PARTITION BY order_id) AS final_at "
+                    "FROM order_status_logs) r "
+                    "WHERE l.id = r.id AND (r.n > 1 OR l.timestamp > r.final_at);"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS "
+                    "uq_order_status_logs_order_status "
+                    "ON order_status_logs (order_id, status);"
+                )
+            )
+            # Huella del último payload ingerido (ingesta sin escrituras repetidas)
+            conn.execute(
+                text(
+                    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS payload_hash "
+                    "VARCHAR(40);"
+                )
+            )
+            # Rollup diario: se quitan las filas duplicadas por refrescos
+            # concurrentes (copias completas de la misma porción) antes del
+            # índice único
+            conn.execute(
+                text(
+                    "DELETE FROM order_daily_facts f USING order_daily_facts d "
+                    "WHERE f.local_date = d.local_date "
+                    "AND f.store_id IS NOT DISTINCT FROM d.store_id "
+                    "AND f.order_type IS NOT DISTINCT FROM d.order_type "
+                    "AND f.status IS NOT DISTINCT FROM d.status "
+                    "AND f.id > d.id;"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS uq_order_daily_facts_slice "
+                    "ON order_daily_facts (local_date, store_id, order_type, status) "
+                    "NULLS NOT DISTINCT;"
+                )
+            )
+            # Actividad diaria por driver: misma limpieza y mismo índice único
+            conn.execute(
+                text(
+                    "DELETE FROM driver_daily_stats s USING driver_daily_stats d "
+                    "WHERE s.local_date = d.local_date "
+                    "AND s.driver_id = d.driver_id "
+                    "AND s.store_id IS NOT DISTINCT FROM d.store_id "
+                    "AND s.id > d.id;"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS uq_driver_daily_stats_slice "
+                    "ON driver_daily_stats (local_date, driver_id, store_id) "
+                    "NULLS NOT DISTINCT;"
+                )
+            )
 
         print("✅ ¡Estructura de Base de Datos actualizada y lista!")
 
@@ -1,6 +1,7 @@
 import logging
 from app.db.session import SessionLocal
 from app.db.base import Store
+from app.services import entity_cache
 from tasks.scraper.store_scraper import StoreScraper
 
 logging.basicConfig(level=logging.INFO)
@@ -38,6 +39,8 @@ def force_sync():
 
     db.commit()
     db.close()
+    # Los workers tienen cacheado nombre -> id de las tiendas renombradas
+    entity_cache.invalidate("stores")
     print(
         f"\n🎯 Proceso finalizado. Tiendas actualizadas: {matched}/{len(stores_info)}"
     )
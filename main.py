@@ -2,9 +2,12 @@ from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from app.api.endpoints import analysis, kpis, data, auth, audit, schedules, holidays
+from app.api.endpoints import analysis, kpis, data, auth, audit, schedules, holidays, dashboard, search
+from app.db.utils import count_queries
+from app.services.query_planner import track_paths, format_paths
 from pathlib import Path
 import os
+import time
 
 app = FastAPI(title="GoAnalisis Dashboard", version="2.0.2")
 
@@ -33,10 +36,28 @@ app.mount(
 )
 templates = Jinja2Templates(directory=str(templates_path))
 
+# --- OBSERVABILIDAD: Consultas SQL, camino y latencia por request ---
+@app.middleware("http")
+async def query_count_header(request: Request, call_next):
+    started = time.perf_counter()
+    with count_queries() as counter, track_paths() as paths:
+        response = await call_next(request)
+    response.headers["X-Query-Count"] = str(counter[0])
+    # Camino de cada widget (rollup / rollup+live / raw / cache) y latencia total
+    response.headers["X-Query-Path"] = format_paths(paths) or (
+        "raw" if counter[0] else "none"
+    )
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    response.headers["X-Query-Latency"] = f"{elapsed_ms:.1f}ms"
+    return response
+
+
 # --- RUTAS DE LA API ---
 app.include_router(analysis.router, prefix="/api/analysis", tags=["Analysis"])
 app.include_router(kpis.router, prefix="/api/kpi", tags=["KPIs"])
 app.include_router(data.router, prefix="/api/data", tags=["Data"])
+app.include_router(dashboard.router, prefix="/api/dashboard", tags=["Dashboard"])
+app.include_router(search.router, prefix="/api/search", tags=["Search"])
 app.include_router(auth.router, prefix="/api/auth", tags=["Auth"])
 app.include_router(audit.router, prefix="/api/audit", tags=["audit"])
 app.include_router(schedules.router, prefix="/api/schedules", tags=["schedules"])
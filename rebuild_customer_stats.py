@@ -0,0 +1,24 @@
+import logging
+from app.db.session import SessionLocal
+from app.services import customer_stats_service
+
+# Configuración
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def run_rebuild():
+    db = SessionLocal()
+    logger.info("🚀 RECONSTRUYENDO ESTADÍSTICAS DE CLIENTES (customer_stats)")
+    try:
+        rows = customer_stats_service.rebuild_customer_stats(db)
+        logger.info(f"✅ Estadísticas listas: {rows} clientes.")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error reconstruyendo customer_stats: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_rebuild()
@@ -0,0 +1,35 @@
+import argparse
+import logging
+from datetime import datetime
+from app.db.session import SessionLocal
+from app.services import driver_stats_service
+
+# Configuración
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+
+def run_rebuild(start_date=None, end_date=None):
+    db = SessionLocal()
+    logger.info("🚀 RECONSTRUYENDO ESTADÍSTICAS DE REPARTIDORES (driver_daily_stats)")
+    logger.info(f"   Rango: {start_date or 'inicio'} -> {end_date or 'hoy'}")
+    try:
+        rows = driver_stats_service.rebuild_driver_stats(db, start_date, end_date)
+        logger.info(f"✅ Estadísticas listas: {rows} filas.")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error reconstruyendo driver_daily_stats: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruye driver_daily_stats")
+    parser.add_argument("--start", help="YYYY-MM-DD (opcional)")
+    parser.add_argument("--end", help="YYYY-MM-DD (opcional)")
+    args = parser.parse_args()
+    run_rebuild(_parse_date(args.start), _parse_date(args.end))
@@ -0,0 +1,27 @@
+import logging
+from app.db.session import SessionLocal
+from app.services import cache_service, cancellation_service
+
+# Configuración
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def run_reclassify():
+    """Correr de nuevo cada vez que cambien las reglas (CANCELLATION_RULES)."""
+    db = SessionLocal()
+    logger.info("🚀 RECLASIFICANDO MOTIVOS DE CANCELACIÓN")
+    try:
+        rows = cancellation_service.reclassify_all(db)
+        # Cambian pedidos de días cerrados: invalida también la caché histórica
+        cache_service.bump_data_version()
+        logger.info(f"✅ Reclasificación completada: {rows} pedidos.")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error reclasificando cancelaciones: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_reclassify()
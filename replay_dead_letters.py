@@ -0,0 +1,23 @@
+import logging
+import sys
+from app.services import ingest_stream
+
+# Configuración
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def run_replay(limit=None):
+    """Reencola el stream de descarte una vez corregida la causa del fallo."""
+    logger.info("🚀 REENCOLANDO PEDIDOS DEL STREAM DE DESCARTE")
+    try:
+        before = ingest_stream.stream_stats()
+        logger.info(f"☠️ En descarte: {before['dead_letters']} mensajes.")
+        moved = ingest_stream.replay_dead_letters(limit)
+        logger.info(f"✅ Reencolados: {moved} mensajes.")
+    except Exception as e:
+        logger.error(f"❌ Error reencolando el descarte: {e}")
+
+
+if __name__ == "__main__":
+    run_replay(int(sys.argv[1]) if len(sys.argv) > 1 else None)
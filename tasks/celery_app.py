@@ -34,9 +34,12 @@ celery_app.conf.update(
         # 🏎️ CARRIL RÁPIDO (Prioridad Máxima - Segundos)
         "tasks.celery_tasks.monitor_active_orders": {"queue": "default"},
         "tasks.ops_tasks.enforce_schedules": {"queue": "default"},
+        # 📥 CARRIL DE ESCRITURA (Consumidor del stream de ingesta)
+        "tasks.celery_tasks.consume_ingest_stream": {"queue": "ingest"},
         # 🚛 CARRIL LENTO (Fuerza Bruta - Minutos/Horas)
         "tasks.celery_tasks.enrich_missing_data": {"queue": "heavy"},
         "tasks.celery_tasks.sync_customer_database": {"queue": "heavy"},
+        "tasks.celery_tasks.close_trend_buckets": {"queue": "heavy"},
         "tasks.maintenance.nightly_deep_clean": {"queue": "heavy"},
     },
 )
@@ -49,6 +52,12 @@ celery_app.conf.beat_schedule = {
         "task": "tasks.celery_tasks.monitor_active_orders",
         "schedule": crontab(minute="*"),
     },
+    # 1.1 Escritor del stream de ingesta (Cada minuto, en su propio worker)
+    # Persiste lo que el radar publica sin frenar el scraping
+    "ingest-stream-every-minute": {
+        "task": "tasks.celery_tasks.consume_ingest_stream",
+        "schedule": crontab(minute="*"),
+    },
     # VIGILANTE DE HORARIOS (CADA 5 MINUTOS)
     "store-schedule-enforcer": {
         "task": "tasks.ops_tasks.enforce_schedules",
@@ -60,6 +69,11 @@ celery_app.conf.beat_schedule = {
         "task": "tasks.celery_tasks.enrich_missing_data",
         "schedule": crontab(minute="*/30"),
     },
+    # Tendencias intradía: congela los buckets de 15 / 60 min ya asentados
+    "trend-buckets-every-15-mins": {
+        "task": "tasks.celery_tasks.close_trend_buckets",
+        "schedule": crontab(minute="*/15"),
+    },
     # 3. VIGILANCIA DE CLIENTES (BARRIDO PROFUNDO)
     # Ejecuta a las 3:00 AM todos los días.
     "customer-surveillance-daily": {
@@ -1,15 +1,31 @@
+import hashlib
+import json
 import logging
 import re
 import time
 import math
+import os
+import socket
 from datetime import datetime, timedelta
+from typing import Optional
 from contextlib import contextmanager
 from celery import shared_task
+from celery.signals import worker_process_init
 import redis
 
 from app.core.config import settings
 from app.db.session import SessionLocal
+from sqlalchemy import select, insert, update, delete, values, column
+from sqlalchemy import Integer, Float, String
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
 from app.db.base import Order, Store, Customer, Driver, OrderStatusLog, OrderItem
+from app.db.base import OrderStageDuration
+from app.services import rollup_service, stage_service, cache_service
+from app.services import customer_stats_service, driver_stats_service, product_service
+from app.services import cancellation_service, trend_service, entity_cache
+from app.services import ingest_stream, status_engine
+from app.services.order_metrics import local_date_of, payment_code_of
 from tasks.scraper.order_scraper import OrderScraper
 from tasks.scraper.drone_scraper import DroneScraper
 from tasks.scraper.customer_scraper import CustomerScraper
@@ -31,6 +47,18 @@ def redis_lock(lock_key: str, expire: int):
             redis_client.delete(lock_key)
 
 
+@worker_process_init.connect
+def warm_entity_cache(**kwargs):
+    """Cada proceso hijo arranca con tiendas, drivers y clientes recientes."""
+    db = SessionLocal()
+    try:
+        entity_cache.warm(db)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo precargar la caché de entidades: {e}")
+    finally:
+        db.close()
+
+
 # --- HELPERS ---
 def parse_spanish_date(date_str: str):
     """
@@ -160,363 +188,664 @@ def calculate_distance_km(lat1, lon1, lat2, lon2):
         return 0.0
 
 
-def normalize_cancellation_reason(text: str) -> str:
-    """Estandariza los motivos de cancelación (Filtro Nivel 2)."""
-    if not text or text == "." or len(text) < 3:
-        return "Sin especificar"
-
-    text = text.replace("del pedido :", "").replace("del pedido", "").strip()
-    text_lower = text.lower()
-
-    # 1. Disponibilidad de Producto (Agregados errores ortográficos y variantes)
-    if any(
-        x in text_lower
-        for x in [
-            "disponib",
-            "dsiponible",
-            "existencia",
-            "vencido",
-            "dañado",
-            "no hay",
-            "no tenemos",
-            "blister",
-            "inventario",
-            "coca cola",
-            "falta",
-            "falto",
-            "agotado",
-            "stock",
-            "medicamento",
-            "existente",
-            "contamos",
-            "disponen",
-            "disponemos",
-        ]
-    ):
-        return "Producto No Disponible / Dañado"
-
-    # 2. Pagos
-    if any(
-        x in text_lower
-        for x in ["payment", "pago", "transferencia", "zelle", "móvil", "movil"]
-    ):
-        if "agotado" in text_lower or "tiempo" in text_lower:
-            return "Tiempo de Pago Agotado"
-        return "Problemas con el Pago"
-
-    # 3. Récipe Médico (¡NUEVA!)
-    if any(
-        x in text_lower
-        for x in ["recipe", "récipe", "receta", "indicacion", "indicación"]
-    ):
-        return "Requiere Récipe Médico"
-
-    # 4. Zona de Cobertura (¡NUEVA!)
-    if any(
-        x in text_lower
-        for x in ["cobertura", "cubre", "lejos", "valencia", "zona", "delery"]
-    ):
-        return "Fuera de Zona de Cobertura"
-
-    # 5. Fuera de Horario (¡NUEVA!)
-    if any(x in text_lower for x in ["horario", "cierre", "cerrado", "tarde"]):
-        return "Fuera de Horario / Tienda Cerrada"
-
-    # 6. Errores del Cliente
-    if any(
-        x in text_lower
-        for x in [
-            "equivocado",
-            "descripcion",
-            "descripción",
-            "precio",
-            "código",
-            "codigo",
-            "error",
-            "guante",
-            "par",
-        ]
-    ):
-        return "Error en Pedido / Descripción"
+# --- INGESTA ---
+# Pedidos por transacción en process_drone_batch
+INGEST_BATCH_SIZE = 50
 
-    # 7. Administrativo
-    if any(
-        x in text_lower
-        for x in ["nota", "prueba", "test", "orden de", "admin", "traspaso", "ajuste"]
-    ):
-        return "Cancelación Administrativa"
+# Contadores (HINCRBY): payloads saltados por huella y filas de items tocadas
+FINGERPRINT_STATS_KEY = "ingest:fingerprint"
+ITEM_STATS_KEY = "ingest:items"
 
-    # Fallback: Si alguien inventa algo MUY nuevo, lo guarda en Capitalize
-    return text.title()
 
+def payload_fingerprint(data: dict) -> str:
+    """SHA-1 del payload tal como lo entrega el dron (claves ordenadas)."""
+    raw = json.dumps(data, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
-def process_drone_data(db, data: dict):
-    try:
-        external_id = data.get("external_id")
-        if not external_id:
-            return
 
-        # --- DIAGNÓSTICO DE ESTATUS (Doble Escudo SRE) ---
-        list_status = data.get("list_status", "").lower()
-        raw_status = data.get("status_text", "").strip()
-        status_text = raw_status.lower()
-
-        db_status = "pending"  # Default
-
-        # ESCUDO 1: Prioridad Absoluta (El estatus extraído de la tabla principal)
-        if list_status:
-            if list_status == "delivered":
-                db_status = "delivered"
-            elif list_status == "canceled" or list_status == "failed":
-                db_status = "canceled"
-            elif list_status == "confirmed":
-                db_status = "confirmed"
-            elif list_status == "processing":
-                db_status = "processing"
-            elif list_status == "handover":
-                db_status = "driver_assigned"
-            elif list_status in ["item_on_the_way", "picked_up"]:
-                db_status = "on_the_way"
-                # --- NUEVO: Atrapar estado Creado y Pendiente ---
-            elif list_status == "created":
-                db_status = "created"
-            elif list_status == "pending":
-                db_status = "pending"
-            # -------------------------------------------------
-
-        # ESCUDO 2: Fallback (Para escaneos viejos o reparaciones profundas)
-        else:
-            if "entregado" in status_text:
-                db_status = "delivered"
-            elif "cancelado" in status_text:
-                db_status = "canceled"
-            elif "creado" in status_text:
-                db_status = "created"
-            elif "camino" in status_text or "ruta" in status_text:
-                db_status = "on_the_way"
-            elif (
-                "asignado" in status_text or "repartidor" in status_text
-            ):  # <--- CRÍTICO: La palabra que faltaba
-                db_status = "driver_assigned"
-            elif "proceso" in status_text:
-                db_status = "processing"
-            elif "confirmado" in status_text:
-                db_status = "confirmed"
-
-        # CASO ESPECIAL DEL CHÓFER: Si el HTML dice 'confirmed' pero ya hay chofer
-        has_driver_name = data.get("driver_name") and "N/A" not in data.get(
-            "driver_name"
-        )
-        if db_status == "confirmed" and has_driver_name:
+def _count_stats(key: str, counts: dict):
+    try:
+        pipe = redis_client.pipeline()
+        for field, amount in counts.items():
+            pipe.hincrby(key, field, amount)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ No se pudieron registrar los contadores {key}: {e}")
+
+
+def resolve_status(data: dict) -> str:
+    """Traduce el estatus del Legacy (lista principal o detalle) al de la DB."""
+    external_id = data.get("external_id")
+    # --- DIAGNÓSTICO DE ESTATUS (Doble Escudo SRE) ---
+    list_status = data.get("list_status", "").lower()
+    raw_status = data.get("status_text", "").strip()
+    status_text = raw_status.lower()
+
+    db_status = "pending"  # Default
+
+    # ESCUDO 1: Prioridad Absoluta (El estatus extraído de la tabla principal)
+    if list_status:
+        if list_status == "delivered":
+            db_status = "delivered"
+        elif list_status == "canceled" or list_status == "failed":
+            db_status = "canceled"
+        elif list_status == "confirmed":
+            db_status = "confirmed"
+        elif list_status == "processing":
+            db_status = "processing"
+        elif list_status == "handover":
             db_status = "driver_assigned"
-        # -------------------------------------------------------------
-
-        elif "asignado" in status_text:
+        elif list_status in ["item_on_the_way", "picked_up"]:
+            db_status = "on_the_way"
+            # --- NUEVO: Atrapar estado Creado y Pendiente ---
+        elif list_status == "created":
+            db_status = "created"
+        elif list_status == "pending":
+            db_status = "pending"
+        # -------------------------------------------------
+
+    # ESCUDO 2: Fallback (Para escaneos viejos o reparaciones profundas)
+    else:
+        if "entregado" in status_text:
+            db_status = "delivered"
+        elif "cancelado" in status_text:
+            db_status = "canceled"
+        elif "creado" in status_text:
+            db_status = "created"
+        elif "camino" in status_text or "ruta" in status_text:
+            db_status = "on_the_way"
+        elif (
+            "asignado" in status_text or "repartidor" in status_text
+        ):  # <--- CRÍTICO: La palabra que faltaba
             db_status = "driver_assigned"
-
-        elif "proceso" in status_text:  # El HTML Legacy usa "Procesos"
+        elif "proceso" in status_text:
             db_status = "processing"
-
         elif "confirmado" in status_text:
             db_status = "confirmed"
 
-        # Log para ver qué decidió el sistema
-        if db_status == "pending" and "pendiente" not in status_text:
-            logger.warning(
-                f"⚠️ Estatus Raro en #{external_id}: '{raw_status}' -> Se quedó como Pending"
-            )
+    # CASO ESPECIAL DEL CHÓFER: Si el HTML dice 'confirmed' pero ya hay chofer
+    has_driver_name = data.get("driver_name") and "N/A" not in data.get(
+        "driver_name"
+    )
+    if db_status == "confirmed" and has_driver_name:
+        db_status = "driver_assigned"
+    # -------------------------------------------------------------
 
-        # --- BUSCAR O CREAR RELACIONES ---
-        # (Tiendas, Clientes, Drivers)
+    elif "asignado" in status_text:
+        db_status = "driver_assigned"
 
-        store = None
-        if data.get("store_name"):
-            store = db.query(Store).filter(Store.name == data["store_name"]).first()
-            if not store:
-                store = Store(
-                    name=data["store_name"], external_id=f"store_{data['store_name']}"
-                )
-                db.add(store)
-                db.commit()
-                db.refresh(store)
-            # Actualizar coords tienda si faltan
-            if "store_lat" in data and store.latitude is None:
-                store.latitude = data["store_lat"]
-                store.longitude = data["store_lng"]
-
-        customer = None
-        if data.get("customer_name"):
-            customer = (
-                db.query(Customer)
-                .filter(Customer.name == data["customer_name"])
-                .first()
-            )
-            if not customer:
-                # AQUÍ ESTÁ EL CAMBIO: Asignamos fecha de hoy para que cuente en el KPI
-                customer = Customer(
-                    name=data["customer_name"],
-                    external_id=f"cust_{data['customer_name']}",
-                    joined_at=datetime.utcnow(),
-                )
-                db.add(customer)
-                db.commit()
-                db.refresh(customer)
-
-            # Actualizar teléfono si viene nuevo
-            if data.get("customer_phone"):
-                customer.phone = data["customer_phone"]
-
-        driver = None
-        d_name = data.get("driver_name", "N/A")
-        if d_name and "N/A" not in d_name:
-            driver = db.query(Driver).filter(Driver.name == d_name).first()
-            if not driver:
-                driver = Driver(name=d_name, external_id=f"driver_{d_name}")
-                db.add(driver)
-                db.commit()
-                db.refresh(driver)
+    elif "proceso" in status_text:  # El HTML Legacy usa "Procesos"
+        db_status = "processing"
 
-        # --- BUSCAR PEDIDO ---
-        order = db.query(Order).filter(Order.external_id == external_id).first()
+    elif "confirmado" in status_text:
+        db_status = "confirmed"
 
-        # Fechas y Cálculos
-        created_at_dt = parse_spanish_date(data.get("created_at_text", ""))
-        minutes_calc = parse_duration_to_minutes(data.get("duration_text", ""))
+    # Log para ver qué decidió el sistema
+    if db_status == "pending" and "pendiente" not in status_text:
+        logger.warning(
+            f"⚠️ Estatus Raro en #{external_id}: '{raw_status}' -> Se quedó como Pending"
+        )
+    return db_status
+
+
+def _has_driver(name) -> bool:
+    return bool(name) and "N/A" not in name
 
-        dist_km = 0.0
-        cust_lat, cust_lng = data.get("customer_lat"), data.get("customer_lng")
-        if cust_lat and store and store.latitude:
-            dist_km = calculate_distance_km(
-                store.latitude, store.longitude, cust_lat, cust_lng
-            )
 
-        # --- LÓGICA DE CLASIFICACIÓN LOGÍSTICA V2 (La que arreglamos antes) ---
+def _upsert_dimension(db, model, kind: str, names, prefix: str, **extra) -> dict:
+    """
+    {nombre: id} de tiendas, clientes o drivers del lote: primero la caché del
+    proceso (entity_cache), luego un SELECT por nombre para los que no estén y
+    un INSERT ... ON CONFLICT DO UPDATE ... RETURNING para los que faltan.
+    """
+    names = {n for n in names if n}
+    if not names:
+        return {}
+    ids = entity_cache.get_many(kind, names)
+    unknown = names - set(ids)
+    if unknown:
+        found = {}
+        for row_id, name in (
+            db.query(model.id, model.name)
+            .filter(model.name.in_(unknown))
+            .order_by(model.id)
+        ):
+            found.setdefault(name, row_id)
+        entity_cache.put_many(kind, found)
+        ids.update(found)
+
+    missing = sorted(names - set(ids))
+    if missing:
+        stmt = pg_insert(model).values(
+            [{"name": n, "external_id": f"{prefix}_{n}", **extra} for n in missing]
+        )
+        # DO UPDATE (no DO NOTHING) para que RETURNING incluya los que ya existían
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["external_id"], set_={"name": stmt.excluded.name}
+        ).returning(model.id, model.name)
+        created = {name: row_id for row_id, name in db.execute(stmt)}
+        entity_cache.put_many(kind, created)
+        ids.update(created)
+    return ids
+
+
+def _resolve_dimensions(db, payloads: list):
+    """Tiendas (con coordenadas), clientes y drivers de todo el lote en bloque."""
+    store_ids = _upsert_dimension(
+        db, Store, "stores", (d.get("store_name") for d in payloads), "store"
+    )
+    customer_ids = _upsert_dimension(
+        db,
+        Customer,
+        "customers",
+        (d.get("customer_name") for d in payloads),
+        "cust",
+        # Fecha de hoy para que cuente en el KPI de clientes nuevos
+        joined_at=datetime.utcnow(),
+    )
+    driver_ids = _upsert_dimension(
+        db,
+        Driver,
+        "drivers",
+        (d.get("driver_name") for d in payloads if _has_driver(d.get("driver_name"))),
+        "driver",
+    )
+
+    # Coordenadas de tienda (solo si faltan) y teléfonos nuevos de clientes
+    coords = {
+        store_ids[d["store_name"]]: (d["store_lat"], d["store_lng"])
+        for d in payloads
+        if d.get("store_name") and "store_lat" in d
+    }
+    if coords:
+        v = values(
+            column("id", Integer),
+            column("lat", Float),
+            column("lng", Float),
+            name="coords",
+        ).data([(sid, lat, lng) for sid, (lat, lng) in coords.items()])
+        db.execute(
+            update(Store)
+            .where(Store.id == v.c.id, Store.latitude == None)
+            .values(latitude=v.c.lat, longitude=v.c.lng)
+            .execution_options(synchronize_session=False)
+        )
+    phones = {
+        customer_ids[d["customer_name"]]: d["customer_phone"]
+        for d in payloads
+        if d.get("customer_name") and d.get("customer_phone")
+    }
+    if phones:
+        v = values(
+            column("id", Integer), column("phone", String), name="phones"
+        ).data(list(phones.items()))
+        db.execute(
+            update(Customer)
+            .where(Customer.id == v.c.id)
+            .values(phone=v.c.phone)
+            .execution_options(synchronize_session=False)
+        )
+
+    store_coords = {}
+    if store_ids:
+        store_coords = {
+            sid: (lat, lng)
+            for sid, lat, lng in db.query(
+                Store.id, Store.latitude, Store.longitude
+            ).filter(Store.id.in_(store_ids.values()))
+        }
+    return store_ids, store_coords, customer_ids, driver_ids
+
+
+# Columnas de 'orders' que escribe el upsert (todas menos la PK)
+_ORDER_COLUMNS = [c for c in Order.__table__.columns if c.name != "id"]
+
+
+def _new_order_row() -> dict:
+    return {
+        c.name: c.default.arg if c.default is not None and c.default.is_scalar else None
+        for c in _ORDER_COLUMNS
+    }
+
+
+def _order_row(
+    data, current, db_status, store_id, store_coords, customer_id, driver_id
+):
+    """
+    Fila completa del pedido tras aplicar el payload (mismas reglas de siempre:
+    un pedido finalizado no retrocede y los campos vacíos no pisan los guardados).
+    Devuelve (fila, hubo_cambio_de_estatus).
+    """
+    external_id = data["external_id"]
+    minutes_calc = parse_duration_to_minutes(data.get("duration_text", ""))
+
+    dist_km = 0.0
+    cust_lat, cust_lng = data.get("customer_lat"), data.get("customer_lng")
+    store_lat, store_lng = store_coords.get(store_id, (None, None))
+    if cust_lat and store_lat:
+        dist_km = calculate_distance_km(store_lat, store_lng, cust_lat, cust_lng)
+
+    # --- LÓGICA DE CLASIFICACIÓN LOGÍSTICA V2 ---
+    order_type = "Delivery"
+    # 1. Si hay driver, es Delivery seguro
+    if driver_id:
         order_type = "Delivery"
+    # 2. Cancelado no tiene tipo
+    elif db_status == "canceled":
+        order_type = None
+    # 3. Distancia cero = Pickup
+    elif dist_km is not None and dist_km < 0.2 and dist_km >= 0:
+        order_type = "Pickup"
+
+    c_reason_raw = data.get("cancellation_reason")
+    c_code, c_reason = cancellation_service.classify_reason(c_reason_raw)
+
+    if current is None:
+        # CREAR NUEVO
+        created_at_dt = parse_spanish_date(data.get("created_at_text", ""))
+        row = _new_order_row()
+        row.update(
+            external_id=external_id,
+            created_at=created_at_dt,
+            local_date=local_date_of(created_at_dt),
+            total_amount=data.get("total_amount", 0),
+            delivery_fee=data.get("delivery_fee", 0),
+            gross_delivery_fee=data.get("real_delivery_fee", 0),
+            service_fee=data.get("service_fee", 0),
+            coupon_discount=data.get("coupon_discount", 0),
+            tips=data.get("tips", 0),
+            product_price=data.get("product_price", 0),
+            current_status=db_status,
+            order_type=order_type,
+            distance_km=dist_km,
+            latitude=cust_lat,
+            longitude=cust_lng,
+            cancellation_reason=c_reason,
+            cancellation_code=c_code,
+            cancellation_reason_raw=c_reason_raw,
+            delivery_time_minutes=minutes_calc,
+            duration=data.get("duration_text"),
+            store_id=store_id,
+            customer_id=customer_id,
+            driver_id=driver_id,
+            payment_method=data.get("payment_method"),
+            payment_code=payment_code_of(data.get("payment_method")),
+        )
+        return row, True
+
+    # ACTUALIZAR EXISTENTE
+    row = {k: v for k, v in current.items() if k != "id"}
+    status_changed = False
+
+    # 1. Cambio de Estatus (solo avances legales, ver status_engine)
+    previous = row["current_status"]
+    if status_engine.can_transition(previous, db_status):
+        logger.info(f"🔄 Cambio #{external_id}: {previous} -> {db_status}")
+        row["current_status"] = db_status
+        status_changed = True
+    elif previous != db_status:
+        # Retrocesos o rebotes del robot (o cambios sobre un pedido finalizado)
+        logger.warning(
+            f"🚫 Intento de cambio de estado inválido en #{external_id}: {previous} -> {db_status} (Ignorado)"
+        )
 
-        # 1. Si hay driver, es Delivery seguro
-        if driver and driver.name and "N/A" not in driver.name:
-            order_type = "Delivery"
-        # 2. Cancelado no tiene tipo
-        elif db_status == "canceled":
-            order_type = None
-        # 3. Distancia cero = Pickup
-        elif dist_km is not None and dist_km < 0.2 and dist_km >= 0:
-            order_type = "Pickup"
-
-        c_reason = normalize_cancellation_reason(data.get("cancellation_reason"))
-
-        # --- GUARDADO ---
-        if not order:
-            # CREAR NUEVO
-            order = Order(
-                external_id=external_id,
-                created_at=created_at_dt,
-                total_amount=data.get("total_amount", 0),
-                delivery_fee=data.get("delivery_fee", 0),
-                gross_delivery_fee=data.get("real_delivery_fee", 0),
-                service_fee=data.get("service_fee", 0),
-                coupon_discount=data.get("coupon_discount", 0),
-                tips=data.get("tips", 0),
-                product_price=data.get("product_price", 0),
-                current_status=db_status,
-                order_type=order_type,
-                distance_km=dist_km,
-                latitude=cust_lat,
-                longitude=cust_lng,
-                cancellation_reason=c_reason,
-                delivery_time_minutes=minutes_calc,
-                duration=data.get("duration_text"),
-                store_id=store.id if store else None,
-                customer_id=customer.id if customer else None,
-                driver_id=driver.id if driver else None,
-                payment_method=data.get("payment_method"),
-            )
-            db.add(order)
-            db.commit()
-            db.refresh(order)
-            # Log inicial
-            db.add(
-                OrderStatusLog(
-                    order_id=order.id, status=db_status, timestamp=datetime.utcnow()
-                )
-            )
+    # Pedidos previos a la columna local_date
+    if row["local_date"] is None and row["created_at"]:
+        row["local_date"] = local_date_of(row["created_at"])
+
+    # 2. Updates Financieros
+    row["total_amount"] = data.get("total_amount", row["total_amount"])
+    # 🎯 INYECCIÓN SRE: Guardar método de pago extraído
+    if data.get("payment_method") and data.get("payment_method") != "Desconocido":
+        row["payment_method"] = data["payment_method"]
+        row["payment_code"] = payment_code_of(row["payment_method"])
+
+    if data.get("real_delivery_fee"):
+        row["gross_delivery_fee"] = data["real_delivery_fee"]
+    if data.get("service_fee"):
+        row["service_fee"] = data["service_fee"]
+    if data.get("product_price"):
+        row["product_price"] = data["product_price"]
+    if c_reason:
+        row["cancellation_reason"] = c_reason
+        row["cancellation_code"] = c_code
+        row["cancellation_reason_raw"] = c_reason_raw
+
+    # 3. Logística
+    if minutes_calc:
+        row["delivery_time_minutes"] = minutes_calc
+    if cust_lat:
+        row["latitude"] = cust_lat
+        row["longitude"] = cust_lng
+        row["distance_km"] = dist_km
+
+    if order_type:
+        row["order_type"] = order_type
+    if driver_id:
+        row["driver_id"] = driver_id
+    if customer_id:
+        row["customer_id"] = customer_id
+    return row, status_changed
+
+
+_ITEM_FIELDS = (
+    "name",
+    "quantity",
+    "unit_price",
+    "total_price",
+    "barcode",
+    "product_id",
+)
+
+
+def _item_key(order_id: int, item) -> tuple:
+    return (
+        order_id,
+        product_service.product_key(item["barcode"], item["name"]),
+        round(item["unit_price"] or 0, 2),
+    )
+
+
+def _sync_items(db, with_items: list, order_ids: dict) -> dict:
+    """
+    Diff de las líneas de cada pedido contra las guardadas, por
+    (producto, precio unitario): solo se insertan, actualizan o borran las que
+    cambiaron, cada grupo con una sola sentencia. Devuelve las filas tocadas.
+    """
+    all_items = [item for d in with_items for item in d["items"]]
+    product_ids = product_service.resolve_products(db, all_items)
+
+    # Líneas guardadas por clave (una lista: el mismo producto puede repetirse)
+    item_order_ids = [order_ids[d["external_id"]] for d in with_items]
+    columns = [getattr(OrderItem, f) for f in _ITEM_FIELDS]
+    stored = {}
+    for r in db.execute(
+        select(OrderItem.id, OrderItem.order_id, *columns).where(
+            OrderItem.order_id.in_(item_order_ids)
+        )
+    ).mappings():
+        stored.setdefault(_item_key(r["order_id"], r), []).append(r)
+
+    inserts, updates = [], []
+    for d in with_items:
+        order_id = order_ids[d["external_id"]]
+        for item in d["items"]:
+            line = {
+                "name": item["name"],
+                "quantity": item["quantity"],
+                "unit_price": item["unit_price"],
+                "total_price": item["total_price"],
+                "barcode": item.get("barcode"),
+                "product_id": product_ids.get(
+                    product_service.product_key(item.get("barcode"), item.get("name"))
+                ),
+            }
+            matches = stored.get(_item_key(order_id, line))
+            if not matches:
+                inserts.append({"order_id": order_id, **line})
+                continue
+            current = matches.pop(0)
+            if any(current[f] != line[f] for f in _ITEM_FIELDS):
+                updates.append({"id": current["id"], **line})
+    deletes = [r["id"] for rows in stored.values() for r in rows]
+
+    if deletes:
+        db.execute(
+            delete(OrderItem)
+            .where(OrderItem.id.in_(deletes))
+            .execution_options(synchronize_session=False)
+        )
+    if updates:
+        # UPDATE por clave primaria en bloque (executemany)
+        db.execute(update(OrderItem), updates)
+    if inserts:
+        db.execute(insert(OrderItem), inserts)
+    return {
+        "inserted": len(inserts),
+        "updated": len(updates),
+        "deleted": len(deletes),
+        "unchanged": len(all_items) - len(inserts) - len(updates),
+    }
+
+
+def _locked_orders(db, external_ids) -> dict:
+    """Filas actuales de los pedidos, bloqueadas (FOR UPDATE) hasta el commit."""
+    return {
+        row["external_id"]: dict(row)
+        for row in db.execute(
+            select(Order.__table__)
+            .where(Order.external_id.in_(external_ids))
+            .order_by(Order.external_id)  # Mismo orden en todos: sin deadlocks
+            .with_for_update()
+        ).mappings()
+    }
+
+
+def _ingest_chunk(db, payloads: list, force: bool = False) -> int:
+    """
+    Un lote = una transacción. No atrapa errores (ver process_drone_batch).
+    Los payloads idénticos al último ingerido (misma huella) se descartan
+    antes de tocar la base; force=True los reescribe igual.
+    """
+    existing = _locked_orders(db, [d["external_id"] for d in payloads])
+
+    hashes = {d["external_id"]: payload_fingerprint(d) for d in payloads}
+    total = len(payloads)
+    if not force:
+        payloads = [
+            d
+            for d in payloads
+            if (existing.get(d["external_id"]) or {}).get("payload_hash")
+            != hashes[d["external_id"]]
+        ]
+    fingerprint_stats = {"hits": total - len(payloads), "misses": len(payloads)}
+    if len(payloads) < total:
+        logger.info(
+            f"🧬 Huella: {total - len(payloads)}/{total} pedidos sin cambios (omitidos)"
+        )
+    if not payloads:
+        db.rollback()  # Nada que escribir: libera los bloqueos
+        _count_stats(FINGERPRINT_STATS_KEY, fingerprint_stats)
+        return 0
+
+    store_ids, store_coords, customer_ids, driver_ids = _resolve_dimensions(
+        db, payloads
+    )
+
+    by_eid, changed = {}, set()
+
+    def build(data):
+        eid = data["external_id"]
+        driver_name = data.get("driver_name")
+        row, status_changed = _order_row(
+            data,
+            existing.get(eid),
+            resolve_status(data),
+            store_ids.get(data.get("store_name")),
+            store_coords,
+            customer_ids.get(data.get("customer_name")),
+            driver_ids.get(driver_name) if _has_driver(driver_name) else None,
+        )
+        row["payload_hash"] = hashes[eid]
+        by_eid[eid] = row
+        if status_changed:
+            changed.add(eid)
         else:
-            # ACTUALIZAR EXISTENTE
-
-            # 1. Cambio de Estatus
-            if order.current_status != db_status and order.current_status not in [
-                "delivered",
-                "canceled",
-            ]:
-                logger.info(
-                    f"🔄 Cambio #{external_id}: {order.current_status} -> {db_status}"
-                )
-                db.add(
-                    OrderStatusLog(
-                        order_id=order.id, status=db_status, timestamp=datetime.utcnow()
-                    )
-                )
-                order.current_status = db_status
-            elif (
-                order.current_status in ["delivered", "canceled"]
-                and db_status != order.current_status
-            ):
-                # Si ya estaba finalizado, ignoramos cualquier "retroceso" a pendiente que intente el robot
-                logger.warning(
-                    f"🚫 Intento de cambio de estado inválido en #{external_id}: {order.current_status} -> {db_status} (Ignorado)"
+            changed.discard(eid)
+
+    for data in payloads:
+        build(data)
+
+    # --- GUARDADO ---
+    # 1. Pedidos nuevos: INSERT sin pisar nada si otro worker se adelantó
+    order_ids = {}
+    new_rows = [row for eid, row in by_eid.items() if eid not in existing]
+    if new_rows:
+        inserted = pg_insert(Order).values(new_rows)
+        inserted = inserted.on_conflict_do_nothing(
+            index_elements=["external_id"]
+        ).returning(Order.id, Order.external_id)
+        order_ids.update({eid: oid for oid, eid in db.execute(inserted)})
+        raced = {row["external_id"] for row in new_rows} - set(order_ids)
+        if raced:
+            # Se insertaron entre la lectura y el INSERT: se releen bloqueados y
+            # el payload se aplica encima de lo guardado (no de los defaults)
+            existing.update(_locked_orders(db, raced))
+            for data in payloads:
+                if data["external_id"] in raced:
+                    build(data)
+
+    # 2. Pedidos existentes (bloqueados): un solo upsert con la fila completa
+    updated_rows = [row for eid, row in by_eid.items() if eid not in order_ids]
+    if updated_rows:
+        stmt = pg_insert(Order).values(updated_rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["external_id"],
+            set_={
+                c.name: stmt.excluded[c.name]
+                for c in _ORDER_COLUMNS
+                if c.name != "external_id"
+            },
+        ).returning(Order.id, Order.external_id)
+        order_ids.update({eid: oid for oid, eid in db.execute(stmt)})
+    rows = list(by_eid.values())
+    rows_by_id = {order_ids[row["external_id"]]: row for row in rows}
+
+    # --- LOGS DE ESTATUS Y DURACIÓN DE LA ETAPA QUE TERMINA ---
+    changed_ids = [order_ids[eid] for eid in changed]
+    if changed_ids:
+        # Último log de cada pedido que cambió (DISTINCT ON, una consulta)
+        last_logs = {
+            r.order_id: r
+            for r in db.execute(
+                select(
+                    OrderStatusLog.order_id,
+                    OrderStatusLog.status,
+                    OrderStatusLog.timestamp,
                 )
+                .where(OrderStatusLog.order_id.in_(changed_ids))
+                .distinct(OrderStatusLog.order_id)
+                .order_by(OrderStatusLog.order_id, OrderStatusLog.timestamp.desc())
+            )
+        }
+        now = datetime.utcnow()
+        log_rows, duration_rows = [], []
+        for order_id in changed_ids:
+            row = rows_by_id[order_id]
+            prev = last_logs.get(order_id)
+            log_rows.append(
+                {
+                    "order_id": order_id,
+                    "status": row["current_status"],
+                    "timestamp": now,
+                }
+            )
+            duration_rows += stage_service.transition_rows(
+                order_id,
+                row["created_at"],
+                prev.status if prev else None,
+                prev.timestamp if prev else None,
+                row["current_status"],
+                now,
+            )
+        # El índice único (order_id, status) descarta un estatus ya registrado;
+        # la duración solo se guarda si el log realmente entró
+        logged = set(
+            db.execute(
+                pg_insert(OrderStatusLog)
+                .values(log_rows)
+                .on_conflict_do_nothing(index_elements=["order_id", "status"])
+                .returning(OrderStatusLog.order_id)
+            ).scalars()
+        )
+        duration_rows = [r for r in duration_rows if r["order_id"] in logged]
+        if duration_rows:
+            db.execute(insert(OrderStageDuration), duration_rows)
+
+    # --- PRODUCTOS (solo las líneas que cambiaron) ---
+    with_items = [d for d in payloads if d.get("items")]
+    item_stats = _sync_items(db, with_items, order_ids) if with_items else None
+
+    # --- ROLLUPS: DIARIO, CLIENTE Y DRIVER (Misma transacción que los pedidos) ---
+    # Tienda, cliente y driver previos: si cambian, se refresca también su porción
+    fact_slices, driver_slices, customers = {}, {}, set()
+    for eid, row in ((r["external_id"], r) for r in rows):
+        current = existing.get(eid) or {}
+        day = row["local_date"]
+        fact_slices.setdefault(day, set()).update(
+            {current.get("store_id"), row["store_id"]}
+        )
+        driver_slices.setdefault(day, set()).update(
+            {current.get("driver_id"), row["driver_id"]}
+        )
+        customers.update({current.get("customer_id"), row["customer_id"]})
+    for day, store_set in fact_slices.items():
+        rollup_service.refresh_order_facts(db, day, store_set)
+    for day, driver_set in driver_slices.items():
+        driver_stats_service.refresh_driver_stats(db, day, driver_set)
+    customer_stats_service.refresh_customer_stats(db, customers)
+
+    db.commit()
+    # Contadores solo tras el commit: un lote reintentado no cuenta doble
+    _count_stats(FINGERPRINT_STATS_KEY, fingerprint_stats)
+    if item_stats:
+        _count_stats(ITEM_STATS_KEY, item_stats)
+        summary = ", ".join(f"{k}={v}" for k, v in item_stats.items())
+        logger.info(f"🧾 Items del lote: {summary}")
+    # CACHÉ ANALÍTICA: nueva versión de datos (solo tras commit)
+    cache_service.bump_data_version(min((d for d in fact_slices if d), default=None))
+    for row in rows:
+        logger.info(
+            f"✅ Procesado #{row['external_id']}: {row['current_status']} | {row['order_type']}"
+        )
+    return len(rows)
 
-            # 2. Updates Financieros
-            order.total_amount = data.get("total_amount", order.total_amount)
-            # 🎯 INYECCIÓN SRE AQUÍ: Guardar método de pago extraído
-            if data.get("payment_method") and data.get("payment_method") != "Desconocido":
-                order.payment_method = data.get("payment_method")
-
-            if data.get("real_delivery_fee"):
-                order.gross_delivery_fee = data["real_delivery_fee"]
-            if data.get("service_fee"):
-                order.service_fee = data["service_fee"]
-            if data.get("product_price"):
-                order.product_price = data["product_price"]
-            if c_reason:
-                order.cancellation_reason = c_reason
-
-            # 3. Logística
-            if minutes_calc:
-                order.delivery_time_minutes = minutes_calc
-            if cust_lat:
-                order.latitude = cust_lat
-                order.longitude = cust_lng
-                order.distance_km = dist_km
-
-            if order_type:
-                order.order_type = order_type
-            if driver:
-                order.driver_id = driver.id
-            if customer:
-                order.customer_id = customer.id
-
-        # 4. PRODUCTOS (Siempre actualizar detalle)
-        if "items" in data and data["items"]:
-            db.query(OrderItem).filter(OrderItem.order_id == order.id).delete()
-            for item in data["items"]:
-                db.add(
-                    OrderItem(
-                        order_id=order.id,
-                        name=item["name"],
-                        quantity=item["quantity"],
-                        unit_price=item["unit_price"],
-                        total_price=item["total_price"],
-                        barcode=item.get("barcode"),
-                    )
-                )
 
-        db.commit()
-        logger.info(f"✅ Procesado #{external_id}: {db_status} | {order_type}")
+def process_drone_batch(
+    db, payloads: list, force: bool = False, failed: Optional[set] = None
+) -> int:
+    """
+    Ingesta por lotes de los payloads del dron: dimensiones, pedidos, items y
+    logs con operaciones en bloque y un solo commit por lote.
+    Si un lote falla se reintenta pedido por pedido, para que un payload roto
+    no tumbe a los demás. Devuelve cuántos pedidos se guardaron (los que no
+    cambiaron desde la última ingesta no cuentan); si se pasa 'failed', se
+    agregan ahí los external_id que no se pudieron guardar.
+    """
+    # Un pedido repetido en el lote: gana el último payload
+    batch = {}
+    for data in payloads:
+        if data and data.get("external_id"):
+            batch[data["external_id"]] = data
+    payloads = list(batch.values())
+
+    # Si otro proceso renombró tiendas/clientes/drivers, se descarta la caché
+    entity_cache.sync()
+    saved = 0
+    for i in range(0, len(payloads), INGEST_BATCH_SIZE):
+        chunk = payloads[i : i + INGEST_BATCH_SIZE]
+        try:
+            saved += _ingest_chunk(db, chunk, force=force)
+        except Exception as e:
+            db.rollback()
+            # Los ids insertados en el lote fallido ya no existen
+            entity_cache.clear_local()
+            if len(chunk) == 1:
+                logger.error(f"Error save {chunk[0].get('external_id')}: {e}")
+                if failed is not None:
+                    failed.add(chunk[0]["external_id"])
+                continue
+            logger.warning(
+                f"⚠️ Lote de {len(chunk)} falló ({e}). Reintentando uno a uno..."
+            )
+            for data in chunk:
+                saved += process_drone_batch(db, [data], force=force, failed=failed)
+    return saved
 
-    except Exception as e:
-        logger.error(f"Error save {data.get('external_id')}: {e}")
-        db.rollback()
+
+def process_drone_data(db, data: dict, force: bool = False):
+    """Ingesta de un solo payload (resync manual, scripts de recuperación)."""
+    process_drone_batch(db, [data], force=force)
 
 
 def save_orders_batch(orders_data: list):
@@ -596,22 +925,31 @@ def monitor_active_orders(self):
                 recent_items = ls.get_recent_order_ids(limit=15)
 
                 if recent_items:
+                    # Estatus actual de todo el barrido en una sola consulta
+                    known = dict(
+                        db.query(Order.external_id, Order.current_status)
+                        .filter(
+                            Order.external_id.in_([item["id"] for item in recent_items])
+                        )
+                        .all()
+                    )
+                    payloads = []
                     for item in recent_items:
                         eid = item["id"]
-                        order = db.query(Order).filter(Order.external_id == eid).first()
+                        current_status = known.get(eid)
 
                         needs_extraction = False
 
                         # A. ES NUEVO: Extracción inmediata
-                        if not order:
+                        if eid not in known:
                             needs_extraction = True
 
                         # B. ESTÁ PENDIENTE: Extracción agresiva (cada 8 seg) para no perder el salto
-                        elif order.current_status in ["created", "pending"]:
+                        elif current_status in ["created", "pending"]:
                             needs_extraction = True
 
                         # C. ESTÁ EN PROCESO/CAMINO: Extracción pasiva (1 vez por minuto es suficiente)
-                        elif order.current_status not in ["delivered", "canceled"]:
+                        elif current_status not in ["delivered", "canceled"]:
                             if eid not in processed_low_priority:
                                 needs_extraction = True
                                 processed_low_priority.add(
@@ -624,7 +962,12 @@ def monitor_active_orders(self):
                             data["duration_text"] = item.get("duration", "")
                             # --- NUEVO: Pasamos el estado de la lista principal ---
                             data["list_status"] = item.get("list_status", "")
-                            process_drone_data(db, data)
+                            payloads.append(data)
+
+                    # Al stream: el consumidor escribe mientras el radar sigue.
+                    # Sin Redis, un solo lote (una transacción) por barrido.
+                    if not ingest_stream.publish(payloads):
+                        process_drone_batch(db, payloads)
 
                 # 3. Descanso táctico antes de volver a refrescar la tabla
                 elapsed = time.time() - loop_start
@@ -645,6 +988,61 @@ def monitor_active_orders(self):
             logger.info("🛑 Radar apagado limpiamente. Esperando siguiente ciclo.")
 
 
+# Pedidos por lectura del stream (varios lotes de INGEST_BATCH_SIZE)
+STREAM_READ_COUNT = 200
+
+
+@celery_app.task(bind=True, soft_time_limit=120, time_limit=135)
+def consume_ingest_stream(self):
+    """
+    Consumidor del stream de ingesta (ver ingest_stream): guarda por lotes lo
+    que publican los scrapers y confirma solo lo escrito. Lo fallido queda
+    pendiente y se reintenta; tras MAX_DELIVERIES va al stream de descarte.
+    """
+    with redis_lock("celery_lock_consume_ingest_stream", 58) as acquired:
+        if not acquired:
+            return
+
+        consumer = f"{socket.gethostname()}-{os.getpid()}"
+        db = SessionLocal()
+        written = 0
+        try:
+            ingest_stream.ensure_group()
+            end_time = time.time() + 50
+            while time.time() < end_time:
+                messages = ingest_stream.read_batch(consumer, STREAM_READ_COUNT)
+                if not messages:
+                    continue
+                failed = set()
+                written += process_drone_batch(
+                    db, [data for _, data in messages], failed=failed
+                )
+                ingest_stream.ack(
+                    [
+                        msg_id
+                        for msg_id, data in messages
+                        if data.get("external_id") not in failed
+                    ]
+                )
+                if failed:
+                    logger.warning(
+                        f"⚠️ Stream: {len(failed)} pedidos sin guardar, quedan "
+                        "pendientes para reintento."
+                    )
+
+            stats = ingest_stream.stream_stats()
+            logger.info(
+                f"📥 Stream de ingesta: {written} escritos | lag={stats['lag']} "
+                f"pending={stats['pending']} "
+                f"más_viejo={stats['oldest_pending_age_s']}s "
+                f"descarte={stats['dead_letters']}"
+            )
+        except Exception as e:
+            logger.error(f"❌ Consumidor del stream: {e}")
+        finally:
+            db.close()
+
+
 @shared_task(bind=True, soft_time_limit=600, time_limit=660)
 def enrich_missing_data(self):
     """
@@ -674,15 +1072,25 @@ def enrich_missing_data(self):
             if missing_reasons:
                 if not drone.login():
                     return
+                slices = {}
                 for order in missing_reasons:
+                    slices.setdefault(order.local_date, set()).add(order.store_id)
                     data = drone.scrape_detail(order.external_id, mode="reason")
-                    order.cancellation_reason = normalize_cancellation_reason(
-                        data.get("cancellation_reason")
-                    )
+                    raw_reason = data.get("cancellation_reason")
+                    code, reason = cancellation_service.classify_reason(raw_reason)
+                    order.cancellation_reason = reason
+                    order.cancellation_code = code
+                    order.cancellation_reason_raw = raw_reason
                     if "service_fee" in data:
                         order.service_fee = data["service_fee"]
                     processed += 1
+                # service_fee alimenta el rollup diario (misma transacción)
+                for day, store_set in slices.items():
+                    rollup_service.refresh_order_facts(db, day, store_set)
                 db.commit()
+                cache_service.bump_data_version(
+                    min((d for d in slices if d), default=None)
+                )
 
             # 2. Entregados incompletos (Mapa, Fee, Productos)
             if processed < BATCH_SIZE:
@@ -707,11 +1115,13 @@ def enrich_missing_data(self):
                 if targets:
                     if not drone.driver:
                         drone.login()
+                    payloads = []
                     for order in targets:
-                        data = drone.scrape_detail(order.external_id, mode="full")
-                        process_drone_data(db, data)
+                        payloads.append(
+                            drone.scrape_detail(order.external_id, mode="full")
+                        )
                         processed += 1
-                    db.commit()
+                    process_drone_batch(db, payloads)
 
             # --- 3. ZOMBIES (Pedidos 'Pendientes' con > 6 horas) ---
             # Esto arregla el caso del pedido 106784 automáticamente
@@ -745,12 +1155,14 @@ def enrich_missing_data(self):
                     if not drone.driver:
                         drone.login()
 
+                    payloads = []
                     for order in zombies:
                         # Entramos a ver si ya cambió
-                        data = drone.scrape_detail(order.external_id, mode="full")
-                        process_drone_data(db, data)
+                        payloads.append(
+                            drone.scrape_detail(order.external_id, mode="full")
+                        )
                         processed += 1
-                    db.commit()
+                    process_drone_batch(db, payloads)
             # -------------------------------------------------------
 
             return f"Ciclo finalizado. Se intentó reparar {processed} pedidos."
@@ -890,6 +1302,7 @@ def sync_store_commissions(self):
                     store.company_name = s_data["company_name"]
                     store.name = s_data["name"]  # Aseguramos el nombre sin recortes
             db.commit()
+            entity_cache.invalidate("stores")
             # -----------------------------------------------------------
             updated = 0
             for s in stores:
@@ -902,6 +1315,8 @@ def sync_store_commissions(self):
                 except:
                     continue
             db.commit()
+            # La comisión entra en la ganancia de los KPIs (también días cerrados)
+            cache_service.bump_data_version()
             return f"Tiendas: {updated}"
         except Exception as e:
             logger.error(f"Error sync stores: {e}")
@@ -910,3 +1325,21 @@ def sync_store_commissions(self):
             if scraper:
                 scraper.close_driver()
             db.close()
+
+
+@shared_task(bind=True, soft_time_limit=600, time_limit=660)
+def close_trend_buckets(self):
+    """Congela los buckets intradía ya asentados (tendencias por hora / 15 min)."""
+    key = "celery_lock_trend_buckets"
+    with redis_lock(key, 900) as acquired:
+        if not acquired:
+            return "Trend buckets busy"
+        db = SessionLocal()
+        try:
+            inserted = trend_service.close_all_buckets(db)
+            return f"Buckets: {inserted}"
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error cerrando buckets de tendencia: {e}")
+        finally:
+            db.close()
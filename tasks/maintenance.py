@@ -3,14 +3,13 @@ import redis
 import time
 from datetime import datetime, timedelta, timezone
 from celery import shared_task
-from sqlalchemy import text, asc
 
 from app.core.config import settings
 from app.db.session import SessionLocal
-from app.db.base import Order, OrderStatusLog
+from app.db.base import Order
 from tasks.scraper.order_scraper import OrderScraper
 from tasks.scraper.drone_scraper import DroneScraper
-from tasks.celery_tasks import process_drone_data
+from tasks.celery_tasks import process_drone_batch
 
 
 # Configuración de Logging
@@ -25,7 +24,6 @@ def nightly_deep_clean(self):
     1. Rompe candados de Redis olvidados.
     1.5. Rescate de Pedidos Atascados (Zombies locales).
     2. Ejecuta auditoría profunda de las últimas 48h.
-    3. Saneamiento Quirúrgico de Logs (Elimina rebotes y basura).
     """
     logger.info("🏥 INICIANDO PROTOCOLO DE AUTOCURACIÓN NOCTURNA...")
 
@@ -70,6 +68,7 @@ def nightly_deep_clean(self):
                 f"⚠️ Se encontraron {len(stuck_orders)} pedidos atascados. Iniciando Dron Médico..."
             )
             drone_fix = DroneScraper()
+            payloads = []
             try:
                 if drone_fix.login():
                     for stuck in stuck_orders:
@@ -82,7 +81,7 @@ def nightly_deep_clean(self):
                                 stuck.external_id, mode="full"
                             )
                             if data:
-                                process_drone_data(db, data)
+                                payloads.append(data)
                         except Exception as e:
                             logger.error(
                                 f"❌ Fallo al destrabar #{stuck.external_id}: {e}"
@@ -91,6 +90,8 @@ def nightly_deep_clean(self):
                     logger.error("❌ El dron médico no pudo loguearse.")
             finally:
                 drone_fix.close_driver()  # Previene el error 'invalid session id'
+            # Guardado en bloque: un commit por lote en vez de uno por pedido
+            process_drone_batch(db, payloads)
         else:
             logger.info("✅ Cero pedidos atascados. Base de datos local al día.")
 
@@ -109,11 +110,17 @@ def nightly_deep_clean(self):
 
             if drone.login():
                 count = 0
+                payloads = []
+                # Pedidos locales de toda la auditoría en una sola consulta
+                local_orders = {
+                    o.external_id: o
+                    for o in db.query(Order).filter(
+                        Order.external_id.in_([item["id"] for item in items])
+                    )
+                }
                 for item in items:
                     eid = item["id"]
-                    local_order = (
-                        db.query(Order).filter(Order.external_id == eid).first()
-                    )
+                    local_order = local_orders.get(eid)
 
                     needs_repair = False
                     if not local_order:
@@ -144,11 +151,12 @@ def nightly_deep_clean(self):
                             data = drone.scrape_detail(eid, mode="full")
                             if data and not data.get("duration_text"):
                                 data["duration_text"] = item.get("duration", "")
-                            process_drone_data(db, data)
+                            payloads.append(data)
                         except Exception as scrape_err:
                             logger.error(f"Fallo reparando {eid}: {scrape_err}")
 
                 drone.close_driver()
+                process_drone_batch(db, payloads)
                 logger.info(f"✅ Auditoría finalizada. {count} pedidos corregidos.")
             else:
                 logger.error("❌ Dron no pudo loguearse para la auditoría.")
@@ -158,66 +166,10 @@ def nightly_deep_clean(self):
     except Exception as e:
         logger.error(f"❌ Error crítico en Auditoría de Datos: {e}")
 
-    # --- FASE 3: SANEAMIENTO INTELIGENTE DE LOGS (Eliminar Rebotes) ---
-    try:
-        logger.info("🧹 FASE 3: Iniciando Saneamiento Quirúrgico de Tiempos...")
-        orders = db.query(Order).all()
-        total_borrados = 0
-        pedidos_afectados = 0
-
-        for o in orders:
-            logs = (
-                db.query(OrderStatusLog)
-                .filter(OrderStatusLog.order_id == o.id)
-                .order_by(asc(OrderStatusLog.timestamp))
-                .all()
-            )
-
-            if len(logs) <= 1:
-                continue
-
-            logs_a_borrar = []
-            estados_vistos = set()
-            estado_final_alcanzado = False
-
-            for log in logs:
-                estado_actual = log.status.lower().strip()
-
-                if estado_final_alcanzado:
-                    logs_a_borrar.append(log)
-                    continue
-
-                if estado_actual in estados_vistos:
-                    logs_a_borrar.append(log)
-                    continue
-
-                estados_vistos.add(estado_actual)
-
-                if estado_actual in ["delivered", "canceled"]:
-                    estado_final_alcanzado = True
-
-            if logs_a_borrar:
-                logger.info(
-                    f"📦 Pedido #{o.external_id}: Borrando {len(logs_a_borrar)} logs (Rebotes/Zombies)."
-                )
-                for basura in logs_a_borrar:
-                    db.delete(basura)
-                total_borrados += len(logs_a_borrar)
-                pedidos_afectados += 1
-
-        if total_borrados > 0:
-            db.commit()
-            logger.info(
-                f"✅ Limpieza Quirúrgica completada. Se borraron {total_borrados} logs en {pedidos_afectados} pedidos."
-            )
-        else:
-            logger.info("✨ La Base de Datos está inmaculada. No hay rebotes.")
-
-    except Exception as e:
-        db.rollback()
-        logger.error(f"❌ Error en la Fase 3 de Saneamiento: {e}")
-    finally:
-        db.close()
+    # (La antigua Fase 3, saneamiento de logs, ya no hace falta: el ingestor
+    # solo registra avances legales y el índice único (order_id, status)
+    # rechaza los rebotes al escribir. Ver status_engine.)
+    db.close()
 
     logger.info("🏆 PROTOCOLO DE MANTENIMIENTO NOCTURNO COMPLETADO.")
     return "System Healthy"
@@ -0,0 +1,95 @@
+"""
+Número de consultas SQL de /api/data/orders (cabecera X-Query-Count).
+
+Necesita la base de datos de settings.DATABASE_URL: todo corre dentro de una
+transacción que se revierte al final, así que no deja datos. Si la base no
+responde, el test se salta.
+"""
+
+from datetime import date, datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app.api import deps
+from app.db.base import Base, Order, OrderItem, OrderStatusLog, Store, Customer, User
+from app.db.base import Driver
+from app.db.session import engine
+from main import app
+
+# Día sin pedidos reales: solo aparecen los sembrados por el test
+TEST_DAY = date(2001, 1, 1)
+
+
+@pytest.fixture
+def db():
+    try:
+        connection = engine.connect()
+    except OperationalError:
+        pytest.skip("Base de datos no disponible")
+    transaction = connection.begin()
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+    Base.metadata.create_all(bind=connection)
+    try:
+        yield session
+    finally:
+        session.close()
+        transaction.rollback()
+        connection.close()
+
+
+@pytest.fixture
+def client(db):
+    app.dependency_overrides[deps.get_db] = lambda: db
+    app.dependency_overrides[deps.get_current_user] = lambda: User(
+        username="test", role="admin"
+    )
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def _seed_orders(db: Session, start: int, count: int):
+    store = Store(external_id=f"store_test_{start}", name=f"Tienda Test {start}")
+    driver = Driver(external_id=f"driver_test_{start}", name=f"Driver Test {start}")
+    db.add_all([store, driver])
+    for i in range(start, start + count):
+        customer = Customer(external_id=f"cust_test_{i}", name=f"Cliente {i}")
+        order = Order(
+            external_id=f"test-{i}",
+            created_at=datetime.combine(TEST_DAY, datetime.min.time()),
+            local_date=TEST_DAY,
+            current_status="delivered",
+            total_amount=10.0,
+            store=store,
+            customer=customer,
+            driver=driver,
+        )
+        order.items = [
+            OrderItem(name="Acetaminofén", quantity=1, unit_price=2.0, total_price=2.0),
+            OrderItem(name="Ibuprofeno", quantity=2, unit_price=3.0, total_price=6.0),
+        ]
+        order.status_logs = [OrderStatusLog(status="delivered")]
+        db.add(order)
+    db.flush()
+
+
+def _query_count(client: TestClient, expected_orders: int) -> int:
+    response = client.get(
+        "/api/data/orders",
+        params={"start_date": TEST_DAY.isoformat(), "end_date": TEST_DAY.isoformat()},
+    )
+    assert response.status_code == 200
+    assert len(response.json()) == expected_orders
+    return int(response.headers["X-Query-Count"])
+
+
+def test_orders_query_count_does_not_grow_with_orders(client, db):
+    _seed_orders(db, 0, 3)
+    few = _query_count(client, 3)
+
+    _seed_orders(db, 3, 27)
+    many = _query_count(client, 30)
+
+    assert many == few
@@ -0,0 +1,25 @@
+from app.services.status_engine import STATUS_ORDER, can_transition
+
+
+def test_happy_path_is_accepted_step_by_step():
+    previous = None
+    for status in STATUS_ORDER:
+        assert can_transition(previous, status), f"{previous} -> {status}"
+        previous = status
+
+
+def test_processing_to_confirmed_is_forward():
+    assert can_transition("processing", "confirmed")
+    assert not can_transition("confirmed", "processing")
+
+
+def test_skipping_stages_and_canceling_are_allowed():
+    assert can_transition("pending", "on_the_way")
+    assert can_transition("driver_assigned", "canceled")
+
+
+def test_repeats_backwards_and_post_final_are_rejected():
+    assert not can_transition("processing", "processing")
+    assert not can_transition("on_the_way", "pending")
+    assert not can_transition("delivered", "canceled")
+    assert not can_transition("canceled", "pending")
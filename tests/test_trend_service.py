@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from app.services.trend_service import floor_bucket, raw_buckets_select
+
+
+def _compiled(granularity: int) -> str:
+    stmt = raw_buckets_select(
+        granularity, datetime(2026, 1, 1), datetime(2026, 1, 2)
+    )
+    return str(
+        stmt.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def test_bucket_minutes_use_integer_division():
+    sql = _compiled(15)
+    # Nada de NUMERIC: make_interval necesita un entero y el bucket, alinearse
+    assert "NUMERIC" not in sql.upper()
+    assert "make_interval" in sql
+
+
+def test_floor_bucket_aligns_to_granularity():
+    moment = datetime(2026, 1, 1, 10, 44, 59, 123)
+    assert floor_bucket(moment, 15) == datetime(2026, 1, 1, 10, 30)
+    assert floor_bucket(moment, 60) == datetime(2026, 1, 1, 10, 0)